@@ -0,0 +1,449 @@
+"""Async (ASGI) serving mode of the trivia API.
+
+Serves the same endpoints and JSON responses as the Flask resources Categories,
+Questions, CategoryQuestions and PlayQuiz, with async handlers on an asyncpg
+connection pool. A single process keeps thousands of requests in flight while
+they wait on PostgreSQL instead of blocking a worker per request.
+
+    pipenv install asyncpg uvicorn
+    uvicorn asgi:app --workers 4
+
+Configured with the same DEV_DB_URI as the Flask app, plus:
+    ASGI_DB_POOL_MIN_SIZE   connections opened at startup (default 5)
+    ASGI_DB_POOL_MAX_SIZE   connections at most (default 20)
+    ASGI_QUIZ_INDEX_TTL     seconds before the quiz id index is reloaded to pick up
+                            writes made by other processes (default 60)
+    DB_PGBOUNCER            true behind PgBouncer in transaction pooling mode, which
+                            can not keep prepared statements (default false)
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from urllib.parse import parse_qs
+
+from database import env_flag
+from flaskr.bulk import check
+from flaskr.dedup import content_hash
+from flaskr.pagination import QUESTIONS_PER_PAGE, decode_cursor, encode_cursor
+from flaskr.sampling import ALL_CATEGORIES, IdBucket
+from flaskr.search import TEXT_SEARCH_CONFIG, prefix_tsquery
+
+ASGI_DB_POOL_MIN_SIZE = int(os.getenv('ASGI_DB_POOL_MIN_SIZE', 5))
+ASGI_DB_POOL_MAX_SIZE = int(os.getenv('ASGI_DB_POOL_MAX_SIZE', 20))
+ASGI_QUIZ_INDEX_TTL = int(os.getenv('ASGI_QUIZ_INDEX_TTL', 60))
+
+QUESTION_COLUMNS = 'id, question, answer, category, difficulty'
+SEARCH_DOCUMENT = f"to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(question, '') || ' ' || coalesce(answer, ''))"
+# Like flaskr.stats.total: the counts of category_stats plus the questions it does not count
+TOTAL_QUESTIONS = (
+    'SELECT (SELECT coalesce(sum(questions), 0) FROM category_stats) '
+    '+ (SELECT count(id) FROM questions WHERE category IS NULL OR difficulty IS NULL)'
+)
+CATEGORY_STATS_UPSERT = (
+    'INSERT INTO category_stats (category, difficulty, questions) VALUES ($1, $2, $3) '
+    'ON CONFLICT (category, difficulty) DO UPDATE SET questions = category_stats.questions + excluded.questions'
+)
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,PUT,POST,DELETE,OPTIONS'),
+]
+
+
+def asyncpg_dsn(db_url):
+    """asyncpg takes plain postgresql:// URIs, without the SQLAlchemy driver suffix"""
+    return re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', db_url)
+
+
+def format_question(row):
+    return {
+        'id': row['id'],
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': row['category'],
+        'difficulty': row['difficulty'],
+    }
+
+
+class Request:
+    __slots__ = ('method', 'path', 'args', 'headers', 'body')
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {key: values[0] for key, values in parse_qs(scope['query_string'].decode()).items()}
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+        self.body = body
+
+    def arg(self, name, default=None, type=None):
+        """Like werkzeug's args.get: fall back to default when the value does not convert"""
+        value = self.args.get(name)
+        if value is None:
+            return default
+        try:
+            return type(value) if type is not None else value
+        except ValueError:
+            return default
+
+    def get_json(self):
+        """Like Flask's get_json(silent=True)"""
+        try:
+            return json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+
+class QuizIndex:
+    """Per-category question id buckets for picking quiz questions, like flaskr.sampling.
+    Reloaded every ASGI_QUIZ_INDEX_TTL seconds and updated by this process' own writes."""
+
+    def __init__(self):
+        self._buckets = None
+        self._loaded_at = 0
+        self._lock = None
+
+    async def buckets(self, pool):
+        if self._buckets is None or time.monotonic() - self._loaded_at > ASGI_QUIZ_INDEX_TTL:
+            # Created here so the lock belongs to the running event loop
+            self._lock = self._lock or asyncio.Lock()
+            async with self._lock:
+                if self._buckets is None or time.monotonic() - self._loaded_at > ASGI_QUIZ_INDEX_TTL:
+                    buckets = {ALL_CATEGORIES: IdBucket()}
+                    for row in await pool.fetch('SELECT id, category FROM questions'):
+                        buckets[ALL_CATEGORIES].add(row['id'])
+                        if row['category'] is not None:
+                            buckets.setdefault(row['category'], IdBucket()).add(row['id'])
+                    self._buckets, self._loaded_at = buckets, time.monotonic()
+        return self._buckets
+
+    def add(self, question_id, category):
+        if self._buckets is not None:
+            self._buckets[ALL_CATEGORIES].add(question_id)
+            if category is not None:
+                self._buckets.setdefault(category, IdBucket()).add(question_id)
+
+    def discard(self, question_id):
+        if self._buckets is not None:
+            for bucket in self._buckets.values():
+                bucket.discard(question_id)
+
+
+class TriviaASGI:
+    def __init__(self, db_url=None):
+        self.db_url = db_url
+        self.pool = None
+        self.quiz_index = QuizIndex()
+        self.routes = [
+            ('GET', re.compile(r'^/categories$'), self.categories),
+            ('GET', re.compile(r'^/categories/(?P<category_id>\d+)/questions$'), self.category_questions),
+            ('GET', re.compile(r'^/(questions)?$'), self.questions),
+            ('POST', re.compile(r'^/(questions)?$'), self.search_or_create_question),
+            ('DELETE', re.compile(r'^/(questions/)?(?P<questions_id>\d+)$'), self.delete_question),
+            ('POST', re.compile(r'^/quizzes$'), self.play_quiz),
+        ]
+
+    async def startup(self):
+        import asyncpg
+        self.pool = await asyncpg.create_pool(
+            asyncpg_dsn(self.db_url or os.getenv('DEV_DB_URI')),
+            min_size=ASGI_DB_POOL_MIN_SIZE,
+            max_size=ASGI_DB_POOL_MAX_SIZE,
+            statement_cache_size=0 if env_flag('DB_PGBOUNCER', False) else 100,
+        )
+
+    async def shutdown(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+
+        if request.method == 'OPTIONS':
+            payload, status, headers = None, 200, {}
+        else:
+            payload, status, headers = await self.dispatch(request)
+
+        raw_body = b'' if payload is None or status in (204, 304) else json.dumps(payload).encode()
+        raw_headers = CORS_HEADERS + [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+        if raw_body:
+            raw_headers.append((b'content-type', b'application/json'))
+        raw_headers.append((b'content-length', str(len(raw_body)).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+        await send({'type': 'http.response.body', 'body': raw_body})
+
+    async def dispatch(self, request):
+        path_matched = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            path_matched = True
+            if method == request.method:
+                kwargs = {name: int(value) for name, value in match.groupdict().items() if value is not None}
+                response = await handler(request, **kwargs)
+                return response if len(response) == 3 else (*response, {})
+        if path_matched:
+            return {'success': False, 'error': 405,
+                    'message': 'The request method is known by the server but has not been allowed '
+                               'and cannot be used.'}, 405, {}
+        return {'success': False, 'error': 404,
+                'message': 'The server can not find requested resource. '
+                           'The endpoint may be valid but the resource itself does not exist.'}, 404, {}
+
+    async def fetch_categories(self):
+        rows = await self.pool.fetch('SELECT id, type FROM categories ORDER BY id')
+        return {row['id']: row['type'] for row in rows}
+
+    async def page(self, request, where='TRUE', *params):
+        """Return (questions, next_cursor) for one page, like flaskr.pagination.paginate"""
+        cursor = request.arg('cursor')
+        if cursor:
+            params += (decode_cursor(cursor),)
+            where = f'{where} AND id > ${len(params)}'
+            offset = 0
+        else:
+            offset = (max(request.arg('page', 1, int), 1) - 1) * QUESTIONS_PER_PAGE
+        rows = await self.pool.fetch(
+            f'SELECT {QUESTION_COLUMNS} FROM questions WHERE {where} ORDER BY id '
+            f'LIMIT {QUESTIONS_PER_PAGE + 1} OFFSET {offset}',
+            *params
+        )
+        questions = [format_question(row) for row in rows[:QUESTIONS_PER_PAGE]]
+        next_cursor = encode_cursor(questions[-1]['id']) if len(rows) > QUESTIONS_PER_PAGE else None
+        return questions, next_cursor
+
+    async def categories(self, request):
+        fail_response = {
+            'status': 'fail',
+            'categories': {},
+            'message': 'The server can not find categories or no category exists yet.'
+        }
+        categories = await self.fetch_categories()
+        if not categories:
+            return fail_response, 400
+        digest = hashlib.sha1(json.dumps(sorted(categories.items())).encode()).hexdigest()
+        etag = f'"categories-{digest}"'
+        if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+            return None, 304, {'ETag': etag}
+        return {'status': 'success', 'categories': categories}, 200, {'ETag': etag}
+
+    async def questions(self, request):
+        fail_response = {
+            'status': 'fail',
+            'message': 'The server can not find questions or no question exists yet.'
+        }
+        try:
+            total_questions, categories = await asyncio.gather(
+                self.pool.fetchval(TOTAL_QUESTIONS),
+                self.fetch_categories()
+            )
+            if not total_questions:
+                # category_stats may not be built yet on a database that was never upgraded
+                total_questions = await self.pool.fetchval('SELECT count(id) FROM questions')
+            if not total_questions or not categories:
+                fail_response['message'] = 'No questions/categories retrieved from database.'
+                return fail_response, 400
+            questions, next_cursor = await self.page(request)
+        except ValueError:
+            return fail_response, 404
+        return {
+            'status': 'success',
+            'questions': questions,
+            'total_questions': total_questions,
+            'next_cursor': next_cursor,
+            'categories': categories,
+            'current_category': None
+        }, 200
+
+    async def search_or_create_question(self, request):
+        success_response = {
+            'status': 'success',
+            'question': '',
+            'answer': '',
+            'category': {},
+            'difficulty': int()
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'Error adding new question to database.'
+        }
+        post_data = request.get_json()
+        if not post_data or not isinstance(post_data, dict):
+            fail_response['message'] = 'None or invalid question format sent to server.'
+            return fail_response, 400
+
+        if (search_term := post_data.get('searchTerm', None)) is not None and not isinstance(search_term, str):
+            fail_response['message'] = 'searchTerm must be a string.'
+            return fail_response, 400
+        elif search_term:
+            tsquery = prefix_tsquery(search_term)
+            questions, total_questions, categories_ids = [], 0, set()
+            if tsquery:
+                match = f"{SEARCH_DOCUMENT} @@ to_tsquery('{TEXT_SEARCH_CONFIG}', $1)"
+                offset = (max(request.arg('page', 1, int), 1) - 1) * QUESTIONS_PER_PAGE
+                rows, total_questions, category_rows = await asyncio.gather(
+                    self.pool.fetch(
+                        f'SELECT {QUESTION_COLUMNS} FROM questions WHERE {match} '
+                        f"ORDER BY ts_rank({SEARCH_DOCUMENT}, to_tsquery('{TEXT_SEARCH_CONFIG}', $1)) DESC, id "
+                        f'LIMIT {QUESTIONS_PER_PAGE} OFFSET {offset}',
+                        tsquery
+                    ),
+                    self.pool.fetchval(f'SELECT count(id) FROM questions WHERE {match}', tsquery),
+                    self.pool.fetch(f'SELECT DISTINCT category FROM questions WHERE {match}', tsquery),
+                )
+                questions = [format_question(row) for row in rows]
+                categories_ids = {row['category'] for row in category_rows}
+            categories = await self.fetch_categories()
+            return {
+                'status': 'success',
+                'questions': questions,
+                'total_questions': total_questions,
+                'current_category': random.choice(list(categories_ids)) if categories_ids else None,
+                'categories': {
+                    category_id: category_type for category_id, category_type in categories.items()
+                    if category_id in categories_ids
+                },
+            }, 200
+
+        if not all([post_data.get(field, None) for field in ('question', 'answer', 'category', 'difficulty')]):
+            fail_response['message'] = 'Required question data fields not sent to server.'
+            return fail_response, 400
+        # Checked like the Flask app does, with the same messages
+        try:
+            row = check(post_data)
+        except ValueError as error:
+            fail_response['message'] = str(error)
+            return fail_response, 400
+        if row['category'] not in await self.fetch_categories():
+            fail_response['message'] = f"category {row['category']} does not exist."
+            return fail_response, 400
+        digest = content_hash(row['question'])
+        try:
+            async with self.pool.acquire() as connection, connection.transaction():
+                question_id = await connection.fetchval(
+                    'INSERT INTO questions (question, answer, category, difficulty, content_hash, updated_at) '
+                    "VALUES ($1, $2, $3, $4, $5, now() AT TIME ZONE 'utc') "
+                    'ON CONFLICT (content_hash) DO NOTHING RETURNING id',
+                    row['question'], row['answer'], row['category'], row['difficulty'], digest
+                )
+                if question_id is not None:
+                    await connection.execute(CATEGORY_STATS_UPSERT, row['category'], row['difficulty'], 1)
+        except Exception:
+            return fail_response, 500
+        if question_id is None:
+            fail_response['message'] = 'The same question already exists.'
+            fail_response['duplicate_of'] = await self.pool.fetchval(
+                'SELECT id FROM questions WHERE content_hash = $1', digest)
+            return fail_response, 409
+        self.quiz_index.add(question_id, row['category'])
+        success_response['question'] = row['question']
+        success_response['answer'] = row['answer']
+        success_response['category'] = row['category']
+        success_response['difficulty'] = row['difficulty']
+        return success_response, 201
+
+    async def delete_question(self, request, questions_id):
+        async with self.pool.acquire() as connection, connection.transaction():
+            deleted = await connection.fetchrow(
+                'DELETE FROM questions WHERE id = $1 RETURNING category, difficulty', questions_id)
+            if deleted is not None and deleted['category'] is not None and deleted['difficulty'] is not None:
+                await connection.execute(CATEGORY_STATS_UPSERT, deleted['category'], deleted['difficulty'], -1)
+        if deleted is None:
+            return {'status': 'fail', 'message': 'Target question does not exist or already deleted.'}, 404
+        self.quiz_index.discard(questions_id)
+        return None, 204
+
+    async def category_questions(self, request, category_id):
+        fail_response = {
+            'status': 'fail',
+            'message': 'Server can not find questions for requested category or the category does not exist.'
+        }
+        try:
+            total_questions = await self.pool.fetchval(
+                'SELECT count(id) FROM questions WHERE category = $1', category_id)
+            if not total_questions:
+                return fail_response, 400
+            questions, next_cursor = await self.page(request, 'category = $1', category_id)
+        except ValueError:
+            return fail_response, 404
+        return {
+            'status': 'success',
+            'questions': questions,
+            'total_questions': total_questions,
+            'next_cursor': next_cursor,
+            'current_category': category_id
+        }, 200
+
+    async def play_quiz(self, request):
+        success_response = {
+            'status': 'success',
+            'previousQuestions': [],
+            'forceEnd': False
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'Error. Server did not retrieve an un played quiz question.'
+        }
+        try:
+            frontend_request_data = request.get_json()
+            previous_questions = frontend_request_data.get('previous_questions')
+            quiz_category = frontend_request_data.get('quiz_category')
+            category = int(quiz_category['id']) if quiz_category['id'] else ALL_CATEGORIES
+            exclude = set(previous_questions)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return fail_response, 400
+
+        buckets = await self.quiz_index.buckets(self.pool)
+        success_response['previousQuestions'] = previous_questions
+        while True:
+            bucket = buckets.get(category)
+            question_id = bucket.choice(exclude) if bucket is not None else None
+            if question_id is None:
+                success_response['question'] = None
+                success_response['forceEnd'] = True
+                return success_response, 200
+            row = await self.pool.fetchrow('SELECT question, answer FROM questions WHERE id = $1', question_id)
+            if row is not None:
+                break
+            self.quiz_index.discard(question_id)
+
+        previous_questions.append(question_id)
+        success_response['question'] = {
+            'question': row['question'],
+            'answer': row['answer'],
+        }
+        return success_response, 200
+
+
+app = TriviaASGI()
@@ -0,0 +1,369 @@
+"""Load test and benchmark of the trivia API hot paths.
+
+Seeds a synthetic question bank into the database, drives the read endpoints at
+a given concurrency and prints throughput, p50/p95/p99 latency and peak RSS as
+JSON. The bank is generated from a fixed seed, so runs on different commits
+against the same database are comparable. An empty database is seeded right away;
+replacing a bank of another size takes --reset, and a database holding anything
+but a benchmark bank is never touched.
+
+    python benchmark.py --db-uri sqlite:////tmp/bench.db --questions 100000 --categories 20 \\
+        --concurrency 8 --requests 2000 --output before.json
+
+Requests go through the Flask test client in this process by default, so peak RSS
+includes the app. Pass --url to benchmark a running server (Flask, gunicorn or
+asgi.py) instead; the bank is still seeded through --db-uri, which must then be
+the database of that server. Set RESPONSE_CACHE=none to measure uncached reads.
+
+Scenarios:
+    questions           GET /questions on random pages
+    questions_cursor    GET /questions following next_cursor from the first page
+    search              POST /questions with a searchTerm from the bank vocabulary
+    category_questions  GET /categories/<id>/questions on random pages
+    quiz                POST /quizzes games of --quiz-rounds rounds in a random category
+
+--cold-start N measures startup instead: N fresh interpreters each time importing
+flaskr, create_app() and the first GET /categories, reported as p50/max in ms.
+Add --gunicorn to time a gunicorn server from spawn to its first 200 instead.
+
+    python benchmark.py --db-uri postgresql://localhost/trivia --cold-start 10
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+COLD_START_SCRIPT = """
+import json, time
+started = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+status = app.test_client().get('/categories').status_code
+served = time.perf_counter()
+print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                  'first_request': served - created, 'status': status}))
+"""
+SCENARIOS = ('questions', 'questions_cursor', 'search', 'category_questions', 'quiz')
+SYLLABLES = ('ba', 'ce', 'di', 'fo', 'gu', 'ha', 'je', 'ki', 'lo', 'mu', 'na', 'pe', 'ri', 'so', 'tu', 'vy')
+VOCABULARY_SIZE = 2000
+QUESTION_WORDS = 8
+
+
+def vocabulary(rng):
+    """Return VOCABULARY_SIZE distinct pseudo words built from SYLLABLES"""
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def synthetic_questions(count, category_ids, words, rng):
+    """Yield (line_number, record) pairs as bulk.import_questions takes them"""
+    for number in range(1, count + 1):
+        yield number, {
+            'question': ' '.join(rng.choice(words) for _ in range(QUESTION_WORDS)) + '?',
+            'answer': rng.choice(words),
+            'category': rng.choice(category_ids),
+            'difficulty': rng.randint(1, 5),
+        }
+
+
+def seed(app, questions, categories, seed_value=0, batch_size=5000, reset=False):
+    """Fill the database with a synthetic bank unless it already has one of this size.
+    An existing bank is only replaced with reset, and data the benchmark did not seed never.
+    Return (category_ids, vocabulary)"""
+    from flaskr import bulk, signals
+    from models import db, Category, Question
+
+    rng = random.Random(seed_value)
+    words = vocabulary(rng)
+    with app.app_context():
+        existing = Category.query.filter(Category.type.like('Benchmark %')).count()
+        total = Question.query.count()
+        if reset or existing != categories or total != questions:
+            foreign = Category.query.filter(~Category.type.like('Benchmark %')).count() \
+                + Question.query.filter(Question.category.is_(None)).count()
+            if foreign:
+                raise RuntimeError('The database holds questions or categories the benchmark did not seed, '
+                                   'point --db-uri to a dedicated database.')
+            if (existing or total) and not reset:
+                raise RuntimeError(f'The database holds a bank of {total} questions in {existing} categories, '
+                                   'pass --reset to replace it.')
+            Question.query.delete(synchronize_session=False)
+            Category.query.delete(synchronize_session=False)
+            db.session.commit()
+            db.session.add_all(Category(type=f'Benchmark {number}') for number in range(1, categories + 1))
+            db.session.commit()
+            signals.invalidate()
+            category_ids = [category_id for category_id, in db.session.query(Category.id).order_by(Category.id)]
+            summary = bulk.import_questions(
+                synthetic_questions(questions, category_ids, words, rng), batch_size)
+            if summary['rejected']:
+                raise RuntimeError(f"Seeding rejected {summary['rejected']} questions: {summary['errors'][:3]}")
+        category_ids = [category_id for category_id, in db.session.query(Category.id).order_by(Category.id)]
+    return category_ids, words
+
+
+class InProcessClient:
+    """Sends requests through the Flask test client, one client per thread"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    """Sends requests to a running server"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        http_request = urllib.request.Request(
+            self.url + path, data=data, method=method, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(http_request) as response:
+                return response.status, json.loads(response.read() or b'null')
+        except urllib.error.HTTPError as error:
+            return error.code, None
+
+
+class Scenarios:
+    """Each scenario sends one or more requests through timed(), which records their latency"""
+
+    def __init__(self, client, category_ids, words, questions, per_page, quiz_rounds):
+        self.client = client
+        self.category_ids = category_ids
+        self.words = words
+        self.pages = max(1, -(-questions // per_page))
+        self.category_pages = max(1, -(-questions // max(len(category_ids), 1) // per_page))
+        self.quiz_rounds = quiz_rounds
+
+    def timed(self, latencies, method, path, body=None):
+        started = time.perf_counter()
+        status, payload = self.client.request(method, path, body)
+        latencies.append(time.perf_counter() - started)
+        if status >= 400:
+            raise RuntimeError(f'{method} {path} answered {status}')
+        return payload
+
+    def questions(self, latencies, rng):
+        self.timed(latencies, 'GET', f'/questions?page={rng.randint(1, self.pages)}')
+
+    def questions_cursor(self, latencies, rng):
+        payload = self.timed(latencies, 'GET', '/questions')
+        for _ in range(rng.randint(1, 10)):
+            if not payload.get('next_cursor'):
+                break
+            payload = self.timed(latencies, 'GET', f"/questions?cursor={payload['next_cursor']}")
+
+    def search(self, latencies, rng):
+        self.timed(latencies, 'POST', '/questions', {'searchTerm': rng.choice(self.words)})
+
+    def category_questions(self, latencies, rng):
+        category_id = rng.choice(self.category_ids)
+        self.timed(latencies, 'GET', f'/categories/{category_id}/questions?page={rng.randint(1, self.category_pages)}')
+
+    def quiz(self, latencies, rng):
+        body = {'previous_questions': [], 'quiz_category': {'id': rng.choice(self.category_ids), 'type': 'click'}}
+        for _ in range(self.quiz_rounds):
+            payload = self.timed(latencies, 'POST', '/quizzes', body)
+            if payload['forceEnd']:
+                break
+            body['previous_questions'] = payload['previousQuestions']
+
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of an ordered list"""
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def run_scenario(scenario, requests, concurrency, seed_value=0):
+    """Run scenario until it sent at least requests requests over concurrency threads, return its report"""
+    latencies = []
+    errors = []
+    started = time.perf_counter()
+
+    def worker(number):
+        rng = random.Random(f'{seed_value}-{number}')
+        own = []
+        while len(latencies) + len(own) < requests:
+            try:
+                scenario(own, rng)
+            except Exception as error:
+                errors.append(str(error))
+                if len(errors) > requests:
+                    break
+            if len(own) >= 50:
+                latencies.extend(own)
+                own = []
+        latencies.extend(own)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    seconds = time.perf_counter() - started
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(len(ordered) / seconds, 1) if seconds else 0,
+        'latency_ms': {
+            'mean': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0,
+            'p50': round(percentile(ordered, 0.50) * 1000, 3),
+            'p95': round(percentile(ordered, 0.95) * 1000, 3),
+            'p99': round(percentile(ordered, 0.99) * 1000, 3),
+            'max': round(ordered[-1] * 1000, 3) if ordered else 0,
+        },
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(app, questions=10000, categories=20, concurrency=8, requests=1000, scenarios=SCENARIOS,
+        quiz_rounds=10, url=None, seed_value=0, reset=False):
+    """Seed the bank, run the scenarios one after the other and return the JSON report as a dict"""
+    from flaskr.pagination import QUESTIONS_PER_PAGE
+
+    seed_started = time.perf_counter()
+    category_ids, words = seed(app, questions, categories, seed_value, reset=reset)
+    seed_seconds = time.perf_counter() - seed_started
+
+    client = HttpClient(url) if url else InProcessClient(app)
+    runner = Scenarios(client, category_ids, words, questions, QUESTIONS_PER_PAGE, quiz_rounds)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+        'target': url or 'in-process',
+        'questions': questions,
+        'categories': categories,
+        'concurrency': concurrency,
+        'seed_seconds': round(seed_seconds, 3),
+        'scenarios': {},
+    }
+    for name in scenarios:
+        report['scenarios'][name] = run_scenario(getattr(runner, name), requests, concurrency, seed_value)
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+def cold_start(runs=5, gunicorn=False, timeout=60):
+    """Start the app runs times in fresh interpreters and return the startup report as a dict.
+    Measures import, create_app() and first request in process, or spawn to first 200 of gunicorn"""
+    backend = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        if not gunicorn:
+            output = subprocess.run(
+                [sys.executable, '-c', COLD_START_SCRIPT], cwd=backend, capture_output=True, text=True, check=True)
+            sample = json.loads(output.stdout.strip().splitlines()[-1])
+            sample['total'] = time.perf_counter() - started
+            samples.append(sample)
+            continue
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', 'flaskr:create_app()'],
+            cwd=backend, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                if server.poll() is not None or time.perf_counter() - started > timeout:
+                    raise RuntimeError('gunicorn did not answer GET /categories')
+                try:
+                    with urllib.request.urlopen(f'http://127.0.0.1:{port}/categories') as response:
+                        if response.status == 200:
+                            break
+                except (urllib.error.URLError, ConnectionError):
+                    time.sleep(0.01)
+            samples.append({'total': time.perf_counter() - started})
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {'commit': git_commit(), 'python': platform.python_version(),
+              'target': 'gunicorn' if gunicorn else 'in-process', 'runs': runs, 'startup_ms': {}}
+    for phase in samples[0]:
+        if phase == 'status':
+            continue
+        ordered = sorted(sample[phase] for sample in samples)
+        report['startup_ms'][phase] = {
+            'p50': round(percentile(ordered, 0.50) * 1000, 3),
+            'max': round(ordered[-1] * 1000, 3),
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-uri', required=True, help='dedicated database to seed, never DEV_DB_URI by default')
+    parser.add_argument('--url', help='benchmark a running server instead of the app in this process')
+    parser.add_argument('--questions', type=int, default=10000, help='size of the question bank')
+    parser.add_argument('--categories', type=int, default=20, help='number of categories')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--quiz-rounds', type=int, default=10, help='rounds per quiz game')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='run only these scenarios')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic bank and of the clients')
+    parser.add_argument('--reset', action='store_true', help='delete the benchmark bank and seed it again')
+    parser.add_argument('--cold-start', type=int, metavar='RUNS', help='measure startup over RUNS fresh processes')
+    parser.add_argument('--gunicorn', action='store_true', help='with --cold-start, time gunicorn to its first 200')
+    parser.add_argument('--output', help='write the JSON report to this file as well')
+    args = parser.parse_args(argv)
+
+    os.environ['DEV_DB_URI'] = args.db_uri
+    if args.cold_start:
+        report = cold_start(args.cold_start, args.gunicorn)
+    else:
+        from flaskr import create_app
+
+        report = run(
+            create_app(), args.questions, args.categories, args.concurrency, args.requests,
+            args.scenario or SCENARIOS, args.quiz_rounds, args.url, args.seed, args.reset)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
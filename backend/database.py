@@ -0,0 +1,190 @@
+"""Database engine configuration, read replica routing and connection pool metrics.
+
+Every setting is read from the environment next to DEV_DB_URI/TEST_DB_URI:
+    DB_POOL_SIZE             connections kept open per process (default 5)
+    DB_MAX_OVERFLOW          extra connections opened under load (default 10)
+    DB_POOL_TIMEOUT          seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE          seconds before a connection is replaced (default 1800)
+    DB_POOL_PRE_PING         test connections before use, true/false (default true)
+    DB_STATEMENT_TIMEOUT_MS  cancel statements running longer, 0 for no limit (default 0)
+    DB_PGBOUNCER             true when connecting through PgBouncer in transaction
+                             pooling mode (default false)
+    REPLICA_DB_URI           read replica that serves GET requests (default unset),
+                             except reads kept beyond the request, see primary()
+    DB_CREATE_SCHEMA         create missing tables when the app starts (default true).
+                             Turn it off in production, where every worker would
+                             otherwise check each table on boot, and create and
+                             upgrade the schema with flask db-upgrade instead
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+REPLICA_BIND = 'replica'
+READ_METHODS = ('GET', 'HEAD')
+
+
+def env_flag(name, default):
+    return os.getenv(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+
+DB_CREATE_SCHEMA = env_flag('DB_CREATE_SCHEMA', True)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a free connection"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_timeout()
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - started)
+
+
+class PoolMetrics:
+    """Process wide counters of connection checkouts from InstrumentedQueuePool pools"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+            self.timeouts = 0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self, engines):
+        """Return checkout wait metrics and the saturation of the pool of each named engine"""
+        with self._lock:
+            average = self.wait_seconds_total / self.checkouts if self.checkouts else 0
+            metrics = {
+                'checkouts': self.checkouts,
+                'checkout_wait_seconds_total': round(self.wait_seconds_total, 6),
+                'checkout_wait_seconds_avg': round(average, 6),
+                'checkout_wait_seconds_max': round(self.wait_seconds_max, 6),
+                'checkout_timeouts': self.timeouts,
+                'pools': {},
+            }
+        for name, engine in engines.items():
+            pool = engine.pool
+            if not isinstance(pool, QueuePool):
+                metrics['pools'][name] = {'pool': type(pool).__name__}
+                continue
+            capacity = pool.size() + max(pool._max_overflow, 0)
+            metrics['pools'][name] = {
+                'pool': type(pool).__name__,
+                'size': pool.size(),
+                'max_overflow': pool._max_overflow,
+                'checked_out': pool.checkedout(),
+                'idle': pool.checkedin(),
+                'saturation': round(pool.checkedout() / capacity, 3) if capacity else 0,
+            }
+        return metrics
+
+
+pool_metrics = PoolMetrics()
+
+
+def engine_options(db_url):
+    """Return create_engine keyword arguments for db_url from the environment"""
+    if not db_url or db_url.startswith('sqlite'):
+        # SQLite connections are local files, SQLAlchemy picks the right pool for them
+        return {}
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True),
+    }
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout and not env_flag('DB_PGBOUNCER', False):
+        # PgBouncer rejects startup options, see _set_local_statement_timeout for that mode
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+
+def configure(app, db_url):
+    """Put the engine options and the replica bind of db_url in app.config"""
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(db_url)
+    replica_url = os.getenv('REPLICA_DB_URI')
+    if replica_url:
+        app.config.setdefault('SQLALCHEMY_BINDS', {})[REPLICA_BIND] = replica_url
+
+
+@event.listens_for(Engine, 'begin')
+def _set_local_statement_timeout(connection):
+    """Behind PgBouncer in transaction pooling mode session settings would leak to other
+    clients sharing the server connection, so the timeout is set per transaction"""
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout and env_flag('DB_PGBOUNCER', False) and connection.dialect.name == 'postgresql':
+        connection.execute(f'SET LOCAL statement_timeout = {statement_timeout}')
+
+
+_routing = threading.local()
+
+
+@contextmanager
+def primary():
+    """Send the queries of the block to the primary database, even during a GET request.
+
+    For reads kept beyond the request, e.g. in-process indexes and cached responses: read
+    from a lagging replica right after a write, they would be kept as current and never
+    refreshed by that write."""
+    previous = getattr(_routing, 'primary', False)
+    _routing.primary = True
+    try:
+        yield
+    finally:
+        _routing.primary = previous
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the queries of GET requests to the read replica when one is configured.
+    Flushes, queries in a primary() block and every query outside a GET request go to the
+    primary database."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not getattr(_routing, 'primary', False) \
+                and has_request_context() and request.method in READ_METHODS:
+            state = get_state(self.app)
+            if REPLICA_BIND in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+                return state.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def engines(self, app=None):
+        """Return the engines created so far by name: primary and, if configured, replica"""
+        app = self.get_app(app)
+        engines = {'primary': self.get_engine(app)}
+        if REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {}):
+            engines[REPLICA_BIND] = self.get_engine(app, bind=REPLICA_BIND)
+        return engines
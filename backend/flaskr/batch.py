@@ -0,0 +1,204 @@
+"""Create, update and delete many questions in one request and one transaction.
+
+Operations are validated first, then written with one set-based statement per
+kind of operation: deletes, then updates, then creates. On PostgreSQL ids are
+sent as a single array parameter (WHERE id = ANY(...)) and updated or created
+rows as column arrays expanded by unnest(); elsewhere as one executemany each.
+
+Every operation gets its own result. Invalid operations are reported and skipped,
+the valid ones are committed together, or not at all if the write fails.
+"""
+import os
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import Integer, any_, bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from flaskr import bulk, dedup, signals, stats
+from flaskr.signals import QuestionRow
+from models import db, Question
+
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS', 10000))
+OPERATIONS = ('create', 'update', 'delete')
+WRITE_FIELDS = bulk.QUESTION_FIELDS + ('content_hash',)
+UNNEST = ('unnest(CAST(:question AS varchar[]), CAST(:answer AS varchar[]), CAST(:category AS integer[]), '
+          'CAST(:difficulty AS integer[]), CAST(:content_hash AS varchar[])')
+
+INSERT_FROM_ARRAYS = text(
+    f'INSERT INTO questions ({", ".join(WRITE_FIELDS)}, updated_at) '
+    f'SELECT v.*, CAST(:updated_at AS timestamp) FROM {UNNEST}) AS v({", ".join(WRITE_FIELDS)})'
+)
+UPDATE_FROM_ARRAYS = text(
+    f'UPDATE questions SET {", ".join(f"{field} = v.{field}" for field in WRITE_FIELDS)}, '
+    f'updated_at = CAST(:updated_at AS timestamp) '
+    f'FROM {UNNEST}, CAST(:id AS integer[])) AS v({", ".join(WRITE_FIELDS)}, id) WHERE questions.id = v.id'
+)
+
+
+def id_filter(connection, ids):
+    """Return a filter on Question.id: one array parameter on PostgreSQL, an IN list elsewhere"""
+    if connection.dialect.name == 'postgresql':
+        return Question.id == any_(bindparam('ids', list(ids), type_=ARRAY(Integer)))
+    return Question.id.in_(list(ids))
+
+
+def _delete(connection, ids):
+    connection.execute(Question.__table__.delete().where(id_filter(connection, ids)))
+
+
+def _update(connection, rows, updated_at):
+    if connection.dialect.name == 'postgresql':
+        parameters = {field: [row[field] for row in rows] for field in WRITE_FIELDS + ('id',)}
+        connection.execute(UPDATE_FROM_ARRAYS, updated_at=updated_at, **parameters)
+        return
+    table = Question.__table__
+    statement = table.update().where(table.c.id == bindparam('row_id')).values(
+        updated_at=updated_at, **{field: bindparam(f'row_{field}') for field in WRITE_FIELDS})
+    connection.execute(statement, [{f'row_{field}': value for field, value in row.items()} for row in rows])
+
+
+def _insert(connection, rows, updated_at):
+    if connection.dialect.name == 'postgresql':
+        parameters = {field: [row[field] for row in rows] for field in WRITE_FIELDS}
+        connection.execute(INSERT_FROM_ARRAYS, updated_at=updated_at, **parameters)
+        return
+    connection.execute(Question.__table__.insert(), [dict(row, updated_at=updated_at) for row in rows])
+
+
+def _question_row(question_id, row):
+    return QuestionRow(question_id, row['question'], row['answer'], row['category'], row['difficulty'])
+
+
+def _question_id(operation):
+    question_id = operation.get('id')
+    if isinstance(question_id, bool) or not str(question_id).isdigit():
+        raise ValueError('id must be an integer question id.')
+    return int(question_id)
+
+
+def apply_operations(operations):
+    """Validate and apply [{'op': 'create'|'update'|'delete', ...}] in one transaction.
+
+    create takes every question field, update the id and the fields to change, delete
+    the id. Return (results, committed): one result dict per operation in request order,
+    with its status, an HTTP like code, the question id and a message if it failed."""
+    results = [{'index': index, 'op': operation.get('op') if isinstance(operation, dict) else None}
+               for index, operation in enumerate(operations)]
+
+    def fail(index, code, message, **details):
+        results[index].update(status='fail', code=code, message=message, **details)
+
+    # Check the shape of every operation and collect the ids it refers to
+    parsed = []
+    claimed = {}
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+            fail(index, 400, f'op must be one of: {", ".join(OPERATIONS)}.')
+            continue
+        question_id = None
+        if operation['op'] != 'create':
+            try:
+                question_id = _question_id(operation)
+            except ValueError as error:
+                fail(index, 400, str(error))
+                continue
+            if question_id in claimed:
+                fail(index, 400, f'Question {question_id} is already changed by operation {claimed[question_id]}.')
+                continue
+            claimed[question_id] = index
+        if operation['op'] == 'update' and not any(field in operation for field in bulk.QUESTION_FIELDS):
+            fail(index, 400, f'update needs at least one of: {", ".join(bulk.QUESTION_FIELDS)}.')
+            continue
+        parsed.append((index, operation, question_id))
+
+    existing = {}
+    if claimed:
+        query = db.session.query(Question.id, Question.question, Question.answer, Question.category,
+                                 Question.difficulty).filter(id_filter(db.session.connection(), claimed))
+        existing = {row[0]: QuestionRow(*row) for row in query}
+
+    # Validate the rows as they will be written
+    deletes, writes = [], []
+    for index, operation, question_id in parsed:
+        if question_id is not None and question_id not in existing:
+            fail(index, 404, f'Question {question_id} does not exist.', id=question_id)
+            continue
+        if operation['op'] == 'delete':
+            deletes.append((index, existing[question_id]))
+            continue
+        record = operation
+        if operation['op'] == 'update':
+            record = {field: operation.get(field, getattr(existing[question_id], field))
+                      for field in bulk.QUESTION_FIELDS}
+        try:
+            row = bulk.validate(record)
+        except ValueError as error:
+            fail(index, 400, str(error), id=question_id)
+            continue
+        row['content_hash'] = dedup.content_hash(row['question'])
+        writes.append((index, question_id, row))
+
+    # A question text may only be written once and not over another question
+    deleted_ids = {row.id for _, row in deletes}
+    owners = {digest: owner for digest, owner in dedup.hash_owners([row['content_hash'] for *_, row in writes]).items()
+              if owner not in deleted_ids}
+    written = {}
+    updates, creates = [], []
+    for index, question_id, row in writes:
+        owner = owners.get(row['content_hash'])
+        if row['content_hash'] in written:
+            fail(index, 409, f"The same question is written by operation {written[row['content_hash']]}.",
+                 id=question_id)
+            continue
+        if owner is not None and owner != question_id:
+            fail(index, 409, 'The same question already exists.', id=question_id, duplicate_of=owner)
+            continue
+        written[row['content_hash']] = index
+        (creates if question_id is None else updates).append((index, question_id, row))
+
+    if not deletes and not updates and not creates:
+        return results, False
+
+    deltas = Counter()
+    changes = []
+    for _, row in deletes:
+        deltas[(row.category, row.difficulty)] -= 1
+        changes.append(('discard', row))
+    for _, question_id, row in updates:
+        old_row = existing[question_id]
+        deltas[(old_row.category, old_row.difficulty)] -= 1
+        deltas[(row['category'], row['difficulty'])] += 1
+        changes.extend([('discard', old_row), ('add', _question_row(question_id, row))])
+    for _, _, row in creates:
+        deltas[(row['category'], row['difficulty'])] += 1
+
+    updated_at = datetime.utcnow()
+    try:
+        connection = db.session.connection()
+        if deletes:
+            _delete(connection, [row.id for _, row in deletes])
+        if updates:
+            _update(connection, [dict(row, id=question_id) for _, question_id, row in updates], updated_at)
+        if creates:
+            _insert(connection, [row for *_, row in creates], updated_at)
+            created_ids = dedup.hash_owners([row['content_hash'] for *_, row in creates])
+        stats.apply(connection, deltas)
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        for index, *_ in deletes + updates + creates:
+            fail(index, 500, f'Batch write failed: {error.__class__.__name__}.')
+        return results, False
+
+    for index, row in deletes:
+        results[index].update(status='success', code=204, id=row.id)
+    for index, question_id, _ in updates:
+        results[index].update(status='success', code=200, id=question_id)
+    for index, _, row in creates:
+        question_id = created_ids[row['content_hash']]
+        results[index].update(status='success', code=201, id=question_id)
+        changes.append(('add', _question_row(question_id, row)))
+    # Core statements bypass the ORM events behind flaskr.signals, so the changes are replayed
+    signals.notify(changes)
+    return results, True
@@ -0,0 +1,291 @@
+import csv
+import io
+import json
+import os
+from collections import Counter
+from datetime import datetime, timezone
+
+import click
+from sqlalchemy import func
+
+from flaskr import dedup, signals, stats
+from flaskr.catalogue import category_catalogue
+from models import db, Question
+
+BULK_IMPORT_BATCH_SIZE = int(os.getenv('BULK_IMPORT_BATCH_SIZE', 1000))
+BULK_EXPORT_CHUNK_SIZE = int(os.getenv('BULK_EXPORT_CHUNK_SIZE', 1000))
+MAX_REPORTED_ERRORS = 100
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+
+def parse_ndjson(lines):
+    """Yield (line_number, record) for every non blank line of newline delimited json.
+    A line that is not UTF-8 text or not a json object is yielded as (line_number, ValueError)"""
+    for line_number, line in enumerate(lines, start=1):
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            record = json.loads(line)
+        except UnicodeDecodeError:
+            yield line_number, ValueError('Invalid UTF-8 text.')
+            continue
+        except ValueError as error:
+            yield line_number, ValueError(f'Invalid json: {error}')
+            continue
+        if not isinstance(record, dict):
+            yield line_number, ValueError('Each line must be a json object.')
+            continue
+        yield line_number, record
+
+
+def parse_csv(lines):
+    """Yield (line_number, record) for every data row of a csv with a header row.
+    A row spanning a line that is not UTF-8 text is yielded as (line_number, ValueError)"""
+    undecodable = set()
+
+    def text_lines():
+        for line_number, line in enumerate(lines, start=1):
+            if isinstance(line, bytes):
+                try:
+                    line = line.decode('utf-8')
+                except UnicodeDecodeError:
+                    undecodable.add(line_number)
+                    line = line.decode('utf-8', 'replace')
+            yield line
+
+    reader = csv.DictReader(text_lines())
+    last_line = 0
+    for record in reader:
+        if any(last_line < line_number <= reader.line_num for line_number in undecodable):
+            yield reader.line_num, ValueError('Invalid UTF-8 text.')
+        else:
+            yield reader.line_num, record
+        last_line = reader.line_num
+
+
+PARSERS = {'ndjson': parse_ndjson, 'csv': parse_csv}
+
+
+def _integer(value):
+    """Return value as an int: an int, an integral float or the text of an int, but not a bool"""
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError
+        return int(value)
+    if not isinstance(value, (int, str)):
+        raise ValueError
+    return int(value)
+
+
+def check(record):
+    """Return the row dict of record with every field checked but the existence of its category.
+    Raise ValueError for an invalid record"""
+    missing = [field for field in QUESTION_FIELDS
+               if record.get(field) is None or isinstance(record[field], str) and not record[field].strip()]
+    if missing:
+        raise ValueError(f'Missing required fields: {", ".join(missing)}.')
+    for field in ('question', 'answer'):
+        if not isinstance(record[field], str):
+            raise ValueError(f'{field} must be a string.')
+    try:
+        difficulty = _integer(record['difficulty'])
+    except ValueError:
+        raise ValueError('difficulty must be an integer.')
+    try:
+        category = _integer(record['category'])
+    except ValueError:
+        raise ValueError('category must be an integer category id.')
+    return {
+        'question': record['question'].strip(),
+        'answer': record['answer'].strip(),
+        'category': category,
+        'difficulty': difficulty,
+    }
+
+
+def validate(record):
+    """Return a row dict ready for the questions table. Raise ValueError for an invalid record"""
+    row = check(record)
+    if not category_catalogue.exists(row['category']):
+        raise ValueError(f"category {row['category']} does not exist.")
+    return row
+
+
+def _write_batch(rows):
+    """Write rows in the current transaction: COPY on PostgreSQL, a single executemany elsewhere"""
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # COPY skips the Python side column defaults, so updated_at is written explicitly
+        updated_at = datetime.utcnow().isoformat()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[field] for field in QUESTION_FIELDS] + [row['content_hash'], updated_at])
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY questions ({", ".join(QUESTION_FIELDS)}, content_hash, updated_at) '
+                'FROM STDIN WITH (FORMAT csv)',
+                buffer)
+    else:
+        connection.execute(Question.__table__.insert(), rows)
+    stats.apply(connection, Counter((row['category'], row['difficulty']) for row in rows))
+
+
+def import_questions(records, batch_size=BULK_IMPORT_BATCH_SIZE, similar=False):
+    """Validate (line_number, record) pairs as they stream in and insert the valid ones
+    in batches of batch_size, one transaction per batch.
+
+    Questions whose normalized text is already in the table or earlier in the import
+    are rejected as duplicates. With similar, questions similar to an existing one
+    are inserted and reported in similar, looked up once per batch.
+
+    Returns a summary dict with the inserted and rejected counts and the first
+    MAX_REPORTED_ERRORS errors and similar questions by line number. A batch that
+    fails to write is rolled back and reported, earlier batches stay committed."""
+    summary = {'inserted': 0, 'rejected': 0, 'errors': [], 'similar': []}
+    seen_hashes = {}
+
+    def reject(line_number, message):
+        summary['rejected'] += 1
+        if len(summary['errors']) < MAX_REPORTED_ERRORS:
+            summary['errors'].append({'line': line_number, 'message': message})
+
+    def deduplicate(batch):
+        for _, row in batch:
+            row['content_hash'] = dedup.content_hash(row['question'])
+        existing = dedup.existing_hashes(list({row['content_hash'] for _, row in batch}))
+        unique = []
+        for line_number, row in batch:
+            if row['content_hash'] in existing:
+                reject(line_number, 'Duplicate of an existing question.')
+            elif row['content_hash'] in seen_hashes:
+                reject(line_number, f"Duplicate of the question on line {seen_hashes[row['content_hash']]}.")
+            else:
+                seen_hashes[row['content_hash']] = line_number
+                unique.append((line_number, row))
+        if similar and unique and len(summary['similar']) < MAX_REPORTED_ERRORS:
+            matches = dedup.near_duplicates.similar_many([row['question'] for _, row in unique])
+            for (line_number, _), found in zip(unique, matches):
+                for question_id, similarity in found[:1]:
+                    summary['similar'].append({'line': line_number, 'question_id': question_id,
+                                               'similarity': similarity})
+            del summary['similar'][MAX_REPORTED_ERRORS:]
+        return unique
+
+    def flush(batch):
+        batch = deduplicate(batch)
+        if not batch:
+            return
+        try:
+            _write_batch([row for _, row in batch])
+            db.session.commit()
+            summary['inserted'] += len(batch)
+        except Exception as error:
+            db.session.rollback()
+            for line_number, _ in batch:
+                reject(line_number, f'Batch write failed: {error.__class__.__name__}.')
+            return
+        finally:
+            # Core inserts bypass the ORM events in-process indexes listen to
+            signals.invalidate()
+        written = db.session.query(Question.id, Question.question) \
+            .filter(Question.content_hash.in_([row['content_hash'] for _, row in batch]))
+        dedup.near_duplicates.add_many(written)
+
+    batch = []
+    for line_number, record in records:
+        if isinstance(record, Exception):
+            reject(line_number, str(record))
+            continue
+        try:
+            batch.append((line_number, validate(record)))
+        except ValueError as error:
+            reject(line_number, str(error))
+            continue
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return summary
+
+
+EXPORT_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+EXPORT_FIELDS = tuple(column.key for column in EXPORT_COLUMNS)
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def utc_naive(moment):
+    """Return moment as a naive UTC datetime, the way updated_at is stored"""
+    if moment is not None and moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def export_query(category=None, difficulty=None, modified_since=None):
+    """Return a column only query over the questions to export, ordered by id"""
+    query = db.session.query(*EXPORT_COLUMNS)
+    if category is not None:
+        query = query.filter(Question.category == category)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    if modified_since is not None:
+        query = query.filter(Question.updated_at > utc_naive(modified_since))
+    return query.order_by(Question.id)
+
+
+def last_modified(query):
+    """Return the latest updated_at among the rows of an export query, or None if it is empty"""
+    return query.with_entities(func.max(Question.updated_at)).order_by(None).scalar()
+
+
+def export_rows(query, export_format, chunk_size=BULK_EXPORT_CHUNK_SIZE):
+    """Yield the rows of an export query serialised as NDJSON or CSV text chunks.
+
+    yield_per makes psycopg2 use a server side cursor, so rows are fetched and sent
+    chunk_size at a time and memory stays flat whatever the size of the bank."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    if writer is not None:
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    for count, row in enumerate(query.yield_per(chunk_size), start=1):
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row))))
+            buffer.write('\n')
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def init_app(app):
+    @app.cli.command('import-questions')
+    @click.argument('source', type=click.File('r'))
+    @click.option('--format', 'source_format', type=click.Choice(sorted(PARSERS)),
+                  help='Input format. Guessed from the file extension when omitted.')
+    @click.option('--batch-size', default=BULK_IMPORT_BATCH_SIZE, show_default=True,
+                  help='Number of questions written per transaction.')
+    @click.option('--similar', is_flag=True, help='Report questions similar to existing ones.')
+    def import_questions_command(source, source_format, batch_size, similar):
+        """Import questions from an NDJSON or CSV file (use - for stdin)"""
+        if source_format is None:
+            source_format = 'csv' if source.name.lower().endswith('.csv') else 'ndjson'
+        summary = import_questions(PARSERS[source_format](source), batch_size, similar)
+        for error in summary['errors']:
+            click.echo(f"line {error['line']}: {error['message']}", err=True)
+        for match in summary['similar']:
+            click.echo(f"line {match['line']}: similar to question {match['question_id']} "
+                       f"({match['similarity']})", err=True)
+        click.echo(f"Imported {summary['inserted']} questions, rejected {summary['rejected']}.")
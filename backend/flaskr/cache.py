@@ -0,0 +1,300 @@
+import fcntl
+import functools
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+from database import primary
+from flaskr import signals
+from flaskr.catalogue import category_catalogue
+from flaskr.serialization import dumps
+
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'memory')
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_REDIS_URL = os.getenv('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR')
+RESPONSE_COALESCING = os.getenv('RESPONSE_COALESCING', 'true').lower() in ('1', 'true', 'yes', 'on')
+RESPONSE_COALESCING_TIMEOUT = float(os.getenv('RESPONSE_COALESCING_TIMEOUT', 30))
+
+ALL_QUESTIONS = 'questions'
+EPOCH = 'epoch'
+COUNTER_SLOTS = 4096
+COUNTER = struct.Struct('<Q')
+
+
+def category_scope(category_id):
+    return f'category:{category_id}'
+
+
+class SharedCounters:
+    """Generation counters shared by every process of a host through a memory mapped file.
+
+    Names are hashed into COUNTER_SLOTS slots, so reading a counter is a memory read;
+    two names sharing a slot only bump each other's generation. Increments hold an
+    exclusive lock on a file opened for the occasion, so they exclude the threads of a
+    process as well as the processes forked from the one that opened the counters."""
+
+    def __init__(self, path, slots=COUNTER_SLOTS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.slots = slots
+        with open(path, 'a+b') as counters_file:
+            if os.fstat(counters_file.fileno()).st_size < slots * COUNTER.size:
+                counters_file.truncate(slots * COUNTER.size)
+            self._mmap = mmap.mmap(counters_file.fileno(), slots * COUNTER.size)
+
+    def _offset(self, name):
+        return zlib.crc32(name.encode()) % self.slots * COUNTER.size
+
+    def get(self, names):
+        return [COUNTER.unpack_from(self._mmap, self._offset(name))[0] for name in names]
+
+    def incr(self, name):
+        offset = self._offset(name)
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                COUNTER.pack_into(self._mmap, offset, COUNTER.unpack_from(self._mmap, offset)[0] + 1)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class MemoryBackend:
+    """Per-process LRU store whose entries also expire after ttl seconds.
+    Generation counters are kept apart from the entries and are never evicted.
+
+    Counters are per process unless shared, a SharedCounters: then a write made by any
+    worker of the host bumps the generations every worker of the host reads."""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._counters = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def counters(self, names):
+        if self.shared is not None:
+            return self.shared.get(names)
+        with self._lock:
+            return [self._counters.get(name, 0) for name in names]
+
+    def incr(self, name):
+        if self.shared is not None:
+            self.shared.incr(name)
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+
+class RedisBackend:
+    """Store shared by every worker through Redis (or anything speaking its protocol).
+    Entries are json encoded and expire after ttl seconds, counters never expire."""
+
+    def __init__(self, url=RESPONSE_CACHE_REDIS_URL, ttl=RESPONSE_CACHE_TTL):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE=redis needs the redis package: pipenv install redis')
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(f'trivia:response:{key}')
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self._client.set(f'trivia:response:{key}', dumps(value), ex=self.ttl)
+
+    def counters(self, names):
+        return [int(value or 0) for value in self._client.mget([f'trivia:generation:{name}' for name in names])]
+
+    def incr(self, name):
+        self._client.incr(f'trivia:generation:{name}')
+
+
+BACKENDS = {'memory': MemoryBackend, 'redis': RedisBackend}
+
+
+class Flight:
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """Runs at most one computation per key at a time in this process.
+    Threads asking for a key already in flight wait for it and share its result."""
+
+    def __init__(self, timeout=RESPONSE_COALESCING_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.shared = 0
+
+    def do(self, key, compute):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            # A leader that failed or takes longer than timeout leaves the waiters to compute on their own
+            if flight.done.wait(self.timeout) and flight.result is not None:
+                with self._lock:
+                    self.shared += 1
+                return flight.result
+            return compute()
+        try:
+            flight.result = compute()
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class ResponseCache:
+    """Cache of successful read responses, invalidated by data generations.
+
+    Every cached response is keyed by its request (method, path, args, body) and the
+    current generation of each scope it reads: all questions, or one category.
+    Committed question writes bump the generations of the scopes they touch through
+    flaskr.signals, once per scope and commit, so no process serves a stale page: its key
+    is simply not asked for anymore and the entry ages out of the LRU/TTL store. The
+    memory backend keeps its generations in a SharedCounters file of RESPONSE_CACHE_DIR
+    (default a directory per database under the system temp directory), shared by the
+    workers of a host; only redis shares them between hosts.
+
+    Misses are coalesced: concurrent identical requests, i.e. with the same key, run
+    the view once and share its response instead of all querying the database after
+    an entry expires. That holds between the threads of a process, with or without a
+    backend, unless RESPONSE_COALESCING=false."""
+
+    def __init__(self):
+        self.backend = None
+        self.flights = None
+        # Scopes touched by the commit being replayed on this thread
+        self._touched = threading.local()
+
+    def init_app(self, app):
+        backend = app.config.setdefault('RESPONSE_CACHE', RESPONSE_CACHE)
+        if backend == 'memory':
+            directory = app.config.setdefault('RESPONSE_CACHE_DIR', RESPONSE_CACHE_DIR)
+            if directory is None:
+                # One directory per database, so apps on different databases never share generations
+                digest = hashlib.sha1(app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:12]
+                directory = os.path.join(tempfile.gettempdir(), f'trivia-cache-{digest}')
+            self.backend = MemoryBackend(shared=SharedCounters(os.path.join(directory, 'generations')))
+        else:
+            self.backend = BACKENDS[backend]() if backend in BACKENDS else None
+        coalescing = app.config.setdefault('RESPONSE_COALESCING', RESPONSE_COALESCING)
+        self.flights = SingleFlight(app.config.setdefault(
+            'RESPONSE_COALESCING_TIMEOUT', RESPONSE_COALESCING_TIMEOUT)) if coalescing else None
+        signals.connect(self)
+
+    def bump(self, *scopes):
+        if self.backend is not None:
+            for scope in scopes:
+                self.backend.incr(scope)
+
+    def add(self, row):
+        touched = getattr(self._touched, 'scopes', None)
+        if touched is None:
+            touched = self._touched.scopes = set()
+        touched.update((ALL_QUESTIONS, category_scope(row.category)))
+
+    discard = add
+
+    def committed(self):
+        touched, self._touched.scopes = getattr(self._touched, 'scopes', None), None
+        self.bump(*sorted(touched or ()))
+
+    def invalidate(self):
+        self.bump(EPOCH)
+
+    def key(self, scopes):
+        """Return the cache key of the current request reading scopes"""
+        scopes = [EPOCH] + list(scopes)
+        generations = self.backend.counters(scopes) if self.backend is not None else []
+        _, categories_etag = category_catalogue.get()
+        parts = [
+            request.method,
+            request.path,
+            sorted(request.args.items(multi=True)),
+            hashlib.sha1(request.get_data()).hexdigest(),
+            list(zip(scopes, generations)),
+            categories_etag,
+        ]
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def memoize(self, scopes, compute):
+        """Return the cached (data, code) response for the current request or compute and cache it.
+        Only 200 responses are cached."""
+        if self.backend is None and self.flights is None:
+            return compute()
+        key = self.key(scopes)
+        if self.backend is not None:
+            cached = self.backend.get(key)
+            if cached is not None:
+                return tuple(cached)
+
+        def compute_and_store():
+            if self.backend is None:
+                return compute()
+            # Cached under the current generations, the response must not come from a lagging replica
+            with primary():
+                data, code = compute()
+            if code == 200:
+                self.backend.set(key, [data, code])
+            return data, code
+
+        if self.flights is None:
+            return compute_and_store()
+        return self.flights.do(key, compute_and_store)
+
+    def cached(self, *scopes):
+        """Decorate a resource method to memoize its response.
+        A scope is a generation name or a callable of the view arguments returning one."""
+        def decorator(method):
+            @functools.wraps(method)
+            def wrapper(resource, *args, **kwargs):
+                names = [scope(**kwargs) if callable(scope) else scope for scope in scopes]
+                return self.memoize(names, lambda: method(resource, *args, **kwargs))
+            return wrapper
+        return decorator
+
+
+response_cache = ResponseCache()
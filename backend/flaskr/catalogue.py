@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from database import primary
+from models import Category
+
+CHANGED_KEY = 'categories_changed'
+CATEGORY_CATALOGUE_TTL = int(os.getenv('CATEGORY_CATALOGUE_TTL', 60))
+
+
+class CategoryCatalogue:
+    """In-memory copy of the categories table.
+
+    Categories almost never change, so they are read from the database once and
+    served from memory until a committed write to Category invalidates the copy.
+    Writes made by other processes are picked up when the copy is reloaded every
+    CATEGORY_CATALOGUE_TTL seconds, or right away by exists().
+    Every invalidation bumps version; etag is a digest of the content so it stays
+    the same across worker processes for the same categories."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._categories = None
+        self._etag = None
+        self._missing = set()
+        self._loaded_at = 0
+        self.ttl = CATEGORY_CATALOGUE_TTL
+        self.version = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.setdefault('CATEGORY_CATALOGUE_TTL', CATEGORY_CATALOGUE_TTL)
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._categories = None
+            self._etag = None
+            self.version += 1
+
+    def get(self):
+        """Return (categories, etag) where categories maps category id to type"""
+        with self._lock:
+            if self._categories is None or time.monotonic() - self._loaded_at > self.ttl:
+                with primary():
+                    categories = Category.query.order_by(Category.id).all()
+                self._categories = {category.id: category.type for category in categories}
+                digest = hashlib.sha1(json.dumps(sorted(self._categories.items())).encode()).hexdigest()
+                self._etag = f'categories-{digest}'
+                self._missing = set()
+                self._loaded_at = time.monotonic()
+            return self._categories, self._etag
+
+    def exists(self, category_id):
+        """Return whether category_id is the id of a category. An id missing from the copy is
+        looked up in the database once per reload, another process may have just added it"""
+        with self._lock:
+            if category_id in self.get()[0]:
+                return True
+            if category_id in self._missing:
+                return False
+            with primary():
+                category = Category.query.get(category_id)
+            if category is None:
+                self._missing.add(category_id)
+                return False
+            self.invalidate()
+            return True
+
+    def is_current(self, etag):
+        """Return whether etag, quoted or not, is the etag of the current categories"""
+        return bool(etag) and etag.strip('"') == self.get()[1]
+
+
+category_catalogue = CategoryCatalogue()
+
+
+def _mark_changed(mapper, connection, target):
+    object_session(target).info[CHANGED_KEY] = True
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Category, _event_name, _mark_changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop(CHANGED_KEY, False):
+        category_catalogue.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(CHANGED_KEY, None)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+@event.listens_for(Session, 'after_bulk_update')
+def _after_bulk_change(context):
+    if context.mapper.class_ is Category:
+        category_catalogue.invalidate()
@@ -0,0 +1,72 @@
+"""Negotiated gzip or brotli compression of API responses.
+
+Responses of at least RESPONSE_COMPRESSION_MIN_SIZE bytes are compressed with the
+best encoding the client accepts: brotli (br) when the brotli package is installed,
+else gzip. Smaller responses are sent as they are, compressing them would cost more
+time than it saves on the wire. Streamed responses, e.g. exports, and responses with
+an ETag, whose strong validator must change with the encoding, are left alone.
+Set RESPONSE_COMPRESSION=false when a proxy in front of the app compresses already.
+
+    pipenv install brotli
+"""
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'true').lower() in ('1', 'true', 'yes', 'on')
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv('RESPONSE_COMPRESSION_MIN_SIZE', 1024))
+GZIP_LEVEL = 6
+# Brotli levels above 5 cost much more CPU for little gain on small JSON bodies
+BROTLI_QUALITY = 5
+COMPRESSED_MIMETYPES = ('application/json', 'text/plain', 'text/csv', 'application/x-ndjson')
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def negotiate(accept_encodings):
+    """Return the encoding to use among those the client accepts, or None"""
+    if brotli is not None and accept_encodings.quality('br'):
+        return 'br'
+    if accept_encodings.quality('gzip'):
+        return 'gzip'
+    return None
+
+
+class Compression:
+    """Flask extension compressing the responses of the app"""
+
+    def __init__(self):
+        self.min_size = RESPONSE_COMPRESSION_MIN_SIZE
+
+    def init_app(self, app):
+        if not app.config.setdefault('RESPONSE_COMPRESSION', RESPONSE_COMPRESSION):
+            return
+        self.min_size = app.config.setdefault('RESPONSE_COMPRESSION_MIN_SIZE', RESPONSE_COMPRESSION_MIN_SIZE)
+        app.after_request(self._after_request)
+
+    def _after_request(self, response):
+        response.vary.add('Accept-Encoding')
+        if response.direct_passthrough or response.is_streamed \
+                or 'Content-Encoding' in response.headers or 'ETag' in response.headers \
+                or response.status_code < 200 or response.status_code in (204, 304) \
+                or response.mimetype not in COMPRESSED_MIMETYPES:
+            return response
+        encoding = negotiate(request.accept_encodings)
+        if encoding is None or response.content_length is None or response.content_length < self.min_size:
+            return response
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+compression = Compression()
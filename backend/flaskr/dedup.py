@@ -0,0 +1,354 @@
+"""Detection of duplicate and near duplicate questions.
+
+Exact duplicates: every question stores content_hash, the SHA-1 of its normalized
+text (lower case, punctuation dropped, whitespace collapsed), under a unique
+index. Finding an exact duplicate is one index lookup, and two writers racing to
+insert the same question can not both succeed.
+
+Near duplicates: NearDuplicateIndex is an in-process MinHash LSH index over the
+character shingles of the normalized text. Candidates sharing a band of their
+MinHash signature with a question are read back and compared by exact Jaccard
+similarity of their shingles, so only pairs similar above DEDUP_NEAR_THRESHOLD
+are reported. Near duplicates are only reported, e.g. "What is 2 + 2?" and
+"What is 2 + 3?" are legitimately different questions.
+
+Signatures use one permutation hashing: every shingle is hashed once, into one of
+the signature slots, instead of once per slot. The index is built in a background
+thread, so the first write of a worker does not wait for the whole table to be
+read; until it is ready no similar questions are reported.
+
+Set DEDUP_NEAR_DUPLICATES=false to skip the near duplicate index, which holds
+MINHASH_BANDS entries per question in memory.
+
+    flask report-duplicates
+"""
+import hashlib
+import os
+import re
+import threading
+import zlib
+
+import click
+from sqlalchemy import event
+
+from database import primary
+from flaskr import signals
+from models import db, Question
+
+DEDUP_NEAR_DUPLICATES = os.getenv('DEDUP_NEAR_DUPLICATES', 'true').lower() in ('1', 'true', 'yes', 'on')
+DEDUP_NEAR_THRESHOLD = float(os.getenv('DEDUP_NEAR_THRESHOLD', 0.75))
+DEDUP_NEAR_BACKGROUND_LOAD = os.getenv('DEDUP_NEAR_BACKGROUND_LOAD', 'true').lower() in ('1', 'true', 'yes', 'on')
+DEDUP_REPORT_BATCH_SIZE = int(os.getenv('DEDUP_REPORT_BATCH_SIZE', 5000))
+SHINGLE_SIZE = 3
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+MINHASH_SLOTS = MINHASH_BANDS * MINHASH_ROWS
+# Offset of a value borrowed from the next slot per slot of distance, above any value of a slot (2**32 / slots)
+MINHASH_ROTATION = (1 << 32) // MINHASH_SLOTS
+SIMILAR_QUERY_SIZE = 500
+
+PUNCTUATION = re.compile(r'[^\w\s]+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(text):
+    return WHITESPACE.sub(' ', PUNCTUATION.sub(' ', (text or '').lower())).strip()
+
+
+def content_hash(text):
+    """Return the digest identifying every spelling of the same question text"""
+    return hashlib.sha1(normalize(text).encode()).hexdigest()
+
+
+def shingles(text):
+    """Return the set of SHINGLE_SIZE character shingles of the normalized text"""
+    normalized = normalize(text)
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[start:start + SHINGLE_SIZE] for start in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def jaccard(first, second):
+    return len(first & second) / len(first | second) if first or second else 1.0
+
+
+def signature(question_shingles):
+    """Return the one permutation MinHash signature of a set of shingles.
+
+    Each shingle hash falls in slot hash % MINHASH_SLOTS, which keeps the minimum.
+    An empty slot borrows the value of the next filled one plus MINHASH_ROTATION per
+    slot of distance, so the signature still estimates Jaccard similarity."""
+    slots = [None] * MINHASH_SLOTS
+    for value in map(zlib.crc32, map(str.encode, question_shingles)):
+        slot, value = value % MINHASH_SLOTS, value // MINHASH_SLOTS
+        if slots[slot] is None or value < slots[slot]:
+            slots[slot] = value
+    if all(value is None for value in slots):
+        return [0] * MINHASH_SLOTS
+    filled = list(slots)
+    for slot in range(MINHASH_SLOTS):
+        distance = 0
+        while filled[(slot + distance) % MINHASH_SLOTS] is None:
+            distance += 1
+        slots[slot] = filled[(slot + distance) % MINHASH_SLOTS] + distance * MINHASH_ROTATION
+    return slots
+
+
+def band_keys(question_signature):
+    """Return the LSH keys of a signature, one per band of MINHASH_ROWS values"""
+    return [hash((band,) + tuple(question_signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+            for band in range(MINHASH_BANDS)]
+
+
+def read_questions(question_ids):
+    """Return {id: question text} of the existing questions among question_ids, SIMILAR_QUERY_SIZE ids per query"""
+    question_ids = sorted(question_ids)
+    texts = {}
+    for start in range(0, len(question_ids), SIMILAR_QUERY_SIZE):
+        chunk = question_ids[start:start + SIMILAR_QUERY_SIZE]
+        texts.update(db.session.query(Question.id, Question.question).filter(Question.id.in_(chunk)))
+    return texts
+
+
+def question_keys(question):
+    """Return the LSH keys of a question text"""
+    return band_keys(signature(shingles(question)))
+
+
+class NearDuplicateIndex:
+    """In-process MinHash LSH index of question ids, kept in sync through flaskr.signals.
+
+    The index is read from the database outside the lock, by a background thread unless
+    DEDUP_NEAR_BACKGROUND_LOAD=false, and the changes committed meanwhile are replayed
+    on it before it is swapped in.
+
+    Rows removed without a signal, e.g. by Query.delete(), are not dropped right away:
+    every candidate is read back from the database, so stale ids are simply not found
+    and dropped then. That is why invalidate() does not throw the index away."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = None
+        self._keys = None
+        # Changes committed while the index loads, None when it is not loading
+        self._pending = None
+        self._app = None
+        self._loader = None
+        self.enabled = DEDUP_NEAR_DUPLICATES
+        self.background_load = DEDUP_NEAR_BACKGROUND_LOAD
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config.setdefault('DEDUP_NEAR_DUPLICATES', DEDUP_NEAR_DUPLICATES)
+        self.background_load = app.config.setdefault('DEDUP_NEAR_BACKGROUND_LOAD', DEDUP_NEAR_BACKGROUND_LOAD)
+        with self._lock:
+            self._buckets = None
+            self._keys = None
+        signals.connect(self)
+
+    def load(self):
+        """Read every question and build the index, unless it is built or being built already"""
+        with self._lock:
+            if self._buckets is not None or self._pending is not None:
+                return
+            self._pending = []
+        buckets, keys = {}, {}
+        try:
+            with primary():
+                for question_id, question in db.session.query(Question.id, Question.question).yield_per(1000):
+                    self._index(question_id, question_keys(question), buckets, keys)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            pending, self._pending = self._pending, None
+            for question_id, keys_of_question in pending:
+                self._forget(question_id, buckets, keys)
+                if keys_of_question is not None:
+                    self._index(question_id, keys_of_question, buckets, keys)
+            self._buckets, self._keys = buckets, keys
+
+    def _load_in_background(self):
+        with self._lock:
+            if self._pending is not None or (self._loader is not None and self._loader.is_alive()):
+                return
+            self._loader = threading.Thread(target=self._load_worker, name='near-duplicates', daemon=True)
+            self._loader.start()
+
+    def _load_worker(self):
+        with self._app.app_context():
+            self.load()
+            db.session.remove()
+
+    def _ready(self):
+        """Return whether the index is loaded, loading it, in the background or not, if it is not"""
+        if self._buckets is None:
+            if self.background_load:
+                self._load_in_background()
+            else:
+                self.load()
+        return self._buckets is not None
+
+    @staticmethod
+    def _index(question_id, keys_of_question, buckets, keys):
+        keys[question_id] = keys_of_question
+        for key in keys_of_question:
+            buckets.setdefault(key, set()).add(question_id)
+
+    @staticmethod
+    def _forget(question_id, buckets, keys):
+        for key in keys.pop(question_id, ()):
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket.discard(question_id)
+                if not bucket:
+                    del buckets[key]
+
+    def _change(self, changes):
+        """Apply [(question_id, keys or None to remove it)] to the index, or keep them for the loading one"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(changes)
+            elif self._buckets is not None:
+                for question_id, keys_of_question in changes:
+                    self._forget(question_id, self._buckets, self._keys)
+                    if keys_of_question is not None:
+                        self._index(question_id, keys_of_question, self._buckets, self._keys)
+
+    def add(self, row):
+        self.add_many([(row.id, row.question)])
+
+    def add_many(self, rows):
+        """Index (id, question) pairs written without a signal, e.g. by a bulk import"""
+        if self.enabled and (self._buckets is not None or self._pending is not None):
+            # Keys are computed outside the lock, writers only hold it to update the buckets
+            self._change([(question_id, question_keys(question)) for question_id, question in rows])
+
+    def discard(self, row):
+        self._change([(row.id, None)])
+
+    def invalidate(self):
+        """Stale ids are dropped when they are looked up, see the class docstring"""
+
+    def similar(self, question, threshold=DEDUP_NEAR_THRESHOLD, exclude=()):
+        """Return [(question_id, similarity)] of the questions at least threshold similar to question,
+        most similar first"""
+        return [match for match in self.similar_many([question], threshold)[0] if match[0] not in exclude]
+
+    def similar_many(self, questions, threshold=DEDUP_NEAR_THRESHOLD):
+        """Return for each of questions the [(question_id, similarity)] of the indexed questions at
+        least threshold similar to it, most similar first. The candidates of every question are
+        read back together, SIMILAR_QUERY_SIZE ids per query"""
+        matches = [[] for _ in questions]
+        if not self.enabled or not questions or not self._ready():
+            return matches
+        questions_shingles = [shingles(question) for question in questions]
+        with self._lock:
+            candidates = [set().union(*(self._buckets.get(key, ()) for key in band_keys(signature(question_shingles))))
+                          for question_shingles in questions_shingles]
+        candidate_ids = set().union(*candidates)
+        texts = read_questions(candidate_ids)
+        stale_ids = [question_id for question_id in candidate_ids if question_id not in texts]
+        if stale_ids:
+            self._change([(question_id, None) for question_id in stale_ids])
+        candidate_shingles = {question_id: shingles(text) for question_id, text in texts.items()}
+        for number, question_shingles in enumerate(questions_shingles):
+            found = [(question_id, round(jaccard(question_shingles, candidate_shingles[question_id]), 3))
+                     for question_id in candidates[number] if question_id in candidate_shingles]
+            matches[number] = sorted((match for match in found if match[1] >= threshold),
+                                     key=lambda match: (-match[1], match[0]))
+        return matches
+
+
+near_duplicates = NearDuplicateIndex()
+
+
+def find_duplicate(question):
+    """Return the id of a question with the same normalized text, or None"""
+    return db.session.query(Question.id).filter(Question.content_hash == content_hash(question)).scalar()
+
+
+def hash_owners(hashes):
+    """Return {content_hash: question_id} for the content hashes already in the questions table"""
+    if not hashes:
+        return {}
+    return dict(db.session.query(Question.content_hash, Question.id).filter(Question.content_hash.in_(hashes)))
+
+
+def existing_hashes(hashes):
+    """Return the subset of content hashes already in the questions table"""
+    if not hashes:
+        return set()
+    return {digest for digest, in db.session.query(Question.content_hash).filter(Question.content_hash.in_(hashes))}
+
+
+@event.listens_for(Question, 'before_insert')
+@event.listens_for(Question, 'before_update')
+def _set_content_hash(mapper, connection, target):
+    target.content_hash = content_hash(target.question)
+
+
+def report_duplicates(batch_size=DEDUP_REPORT_BATCH_SIZE, threshold=DEDUP_NEAR_THRESHOLD, near=True):
+    """Scan the questions table in id order, batch_size rows per query, and yield
+    ('exact', id, original_id, 1.0) and ('near', id, similar_id, similarity) findings.
+    Every question is compared with the questions before it.
+
+    Only the content hashes and LSH band keys of the scanned questions are kept; the
+    texts of the candidates of a batch are read back with read_questions()."""
+    first_ids = {}
+    buckets = {}
+    last_id = 0
+    while True:
+        rows = db.session.query(Question.id, Question.question) \
+            .filter(Question.id > last_id).order_by(Question.id).limit(batch_size).all()
+        if not rows:
+            return
+        # (id, original id of an exact duplicate, shingles, ids of the earlier candidates)
+        scanned = []
+        for question_id, question in rows:
+            digest = content_hash(question)
+            if digest in first_ids:
+                scanned.append((question_id, first_ids[digest], None, ()))
+                continue
+            first_ids[digest] = question_id
+            if not near:
+                continue
+            question_shingles = shingles(question)
+            keys = band_keys(signature(question_shingles))
+            scanned.append((question_id, None, question_shingles,
+                            set().union(*(buckets.get(key, ()) for key in keys))))
+            for key in keys:
+                buckets.setdefault(key, set()).add(question_id)
+        known = {question_id: question_shingles for question_id, _, question_shingles, _ in scanned
+                 if question_shingles is not None}
+        earlier_ids = set().union(*(candidates for *_, candidates in scanned)) - set(known)
+        known.update((question_id, shingles(text)) for question_id, text in read_questions(earlier_ids).items())
+        for question_id, original_id, question_shingles, candidates in scanned:
+            if original_id is not None:
+                yield 'exact', question_id, original_id, 1.0
+                continue
+            matches = sorted(((round(jaccard(question_shingles, known[candidate]), 3), candidate)
+                              for candidate in candidates if candidate in known), reverse=True)
+            if matches and matches[0][0] >= threshold:
+                yield 'near', question_id, matches[0][1], matches[0][0]
+        last_id = rows[-1][0]
+        db.session.expunge_all()
+
+
+def init_app(app):
+    near_duplicates.init_app(app)
+
+    @app.cli.command('report-duplicates')
+    @click.option('--batch-size', default=DEDUP_REPORT_BATCH_SIZE, show_default=True,
+                  help='Number of questions read per query.')
+    @click.option('--threshold', default=DEDUP_NEAR_THRESHOLD, show_default=True,
+                  help='Lowest shingle similarity reported as a near duplicate.')
+    @click.option('--exact-only', is_flag=True, help='Report exact duplicates only.')
+    def report_duplicates_command(batch_size, threshold, exact_only):
+        """List duplicate and near duplicate questions"""
+        findings = 0
+        for kind, question_id, original_id, similarity in report_duplicates(batch_size, threshold, not exact_only):
+            findings += 1
+            click.echo(f'{kind}\t{question_id}\t{original_id}\t{similarity}')
+        click.echo(f'Found {findings} duplicate questions.', err=True)
@@ -0,0 +1,217 @@
+"""Per-request timing, SQL statement metrics, Server-Timing headers and /metrics.
+
+Off unless INSTRUMENTATION=true. When off no request hook or engine listener is
+registered and phase() returns a shared no-op context manager, so the only cost
+left in the hot paths is one ContextVar lookup per phase.
+
+A request is broken down into phases reported in the Server-Timing header:
+    sql        time spent executing SQL statements
+    hydrate    building and formatting Question objects from rows, without SQL time
+    serialize  encoding the response body as JSON
+    app        the whole request, from before_request to after_request
+Phases are exclusive of SQL time run inside them, so they add up to at most app.
+
+/metrics serves Prometheus text exposition histograms of request durations, SQL
+time and statement counts per resource and method, plus the connection pool
+metrics of database.pool_metrics. Metrics are kept per process.
+"""
+import bisect
+import contextlib
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database import pool_metrics
+from models import db
+
+INSTRUMENTATION = os.getenv('INSTRUMENTATION', 'false').lower() in ('1', 'true', 'yes', 'on')
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+_current = ContextVar('request_timings', default=None)
+NO_PHASE = contextlib.nullcontext()
+
+
+class RequestTimings:
+    __slots__ = ('started', 'sql_seconds', 'sql_statements', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_seconds = 0.0
+        self.sql_statements = 0
+        self.phases = {}
+
+
+class Phase:
+    """Adds the time spent in the block, minus the SQL time run inside it, to a named phase"""
+    __slots__ = ('timings', 'name', 'started', 'sql_seconds')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.sql_seconds = self.timings.sql_seconds
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started - (self.timings.sql_seconds - self.sql_seconds)
+        self.timings.phases[self.name] = self.timings.phases.get(self.name, 0.0) + elapsed
+        return False
+
+
+def phase(name):
+    """Return a context manager timing a phase of the current request, a no-op outside instrumented requests"""
+    timings = _current.get()
+    if timings is None:
+        return NO_PHASE
+    return Phase(timings, name)
+
+
+class Histogram:
+    """Prometheus histogram with one series per label values tuple"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, [list(counts), total, number])
+                            for labels, (counts, total, number) in self._series.items())
+        for labels, (counts, total, number) in series:
+            label_text = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {total}')
+            lines.append(f'{self.name}_count{{{label_text}}} {number}')
+        return lines
+
+
+class Instrumentation:
+    """Flask extension collecting the timings of every request of the app"""
+
+    def __init__(self):
+        self._listening = False
+        self.request_seconds = Histogram(
+            'trivia_request_duration_seconds', 'Time to serve a request.',
+            ('resource', 'method', 'status'), DURATION_BUCKETS)
+        self.sql_seconds = Histogram(
+            'trivia_request_sql_seconds', 'Time spent executing SQL statements per request.',
+            ('resource', 'method'), DURATION_BUCKETS)
+        self.sql_statements = Histogram(
+            'trivia_request_sql_statements', 'Number of SQL statements executed per request.',
+            ('resource', 'method'), STATEMENT_BUCKETS)
+        self.phase_seconds = Histogram(
+            'trivia_request_phase_seconds', 'Time spent in a phase of a request, SQL time excluded.',
+            ('resource', 'method', 'phase'), DURATION_BUCKETS)
+
+    def init_app(self, app):
+        if not app.config.setdefault('INSTRUMENTATION', INSTRUMENTATION):
+            return
+        self._listen_to_engines()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def _listen_to_engines(self):
+        if self._listening:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        self._listening = True
+
+    @staticmethod
+    def _before_request():
+        g.request_timings_token = _current.set(RequestTimings())
+
+    def _after_request(self, response):
+        timings = _current.get()
+        if timings is None:
+            return response
+        elapsed = time.perf_counter() - timings.started
+        resource = request.endpoint or 'unmatched'
+        method = request.method
+        self.request_seconds.observe((resource, method, str(response.status_code)), elapsed)
+        self.sql_seconds.observe((resource, method), timings.sql_seconds)
+        self.sql_statements.observe((resource, method), timings.sql_statements)
+        for name, seconds in timings.phases.items():
+            self.phase_seconds.observe((resource, method, name), seconds)
+
+        entries = [f'sql;dur={timings.sql_seconds * 1000:.3f};desc="{timings.sql_statements} statements"']
+        entries.extend(f'{name};dur={seconds * 1000:.3f}' for name, seconds in timings.phases.items())
+        entries.append(f'app;dur={elapsed * 1000:.3f}')
+        response.headers.add('Server-Timing', ', '.join(entries))
+        return response
+
+    @staticmethod
+    def _teardown_request(error=None):
+        token = g.pop('request_timings_token', None)
+        if token is not None:
+            _current.reset(token)
+
+    def exposition(self):
+        lines = []
+        for histogram in (self.request_seconds, self.sql_seconds, self.sql_statements, self.phase_seconds):
+            lines.extend(histogram.exposition())
+
+        pools = pool_metrics.snapshot(db.engines())
+        lines.extend([
+            '# HELP trivia_db_checkouts_total Connections checked out of the pool.',
+            '# TYPE trivia_db_checkouts_total counter',
+            f"trivia_db_checkouts_total {pools['checkouts']}",
+            '# HELP trivia_db_checkout_wait_seconds_total Time spent waiting for a free connection.',
+            '# TYPE trivia_db_checkout_wait_seconds_total counter',
+            f"trivia_db_checkout_wait_seconds_total {pools['checkout_wait_seconds_total']}",
+            '# HELP trivia_db_checkout_timeouts_total Checkouts that timed out waiting for a connection.',
+            '# TYPE trivia_db_checkout_timeouts_total counter',
+            f"trivia_db_checkout_timeouts_total {pools['checkout_timeouts']}",
+            '# HELP trivia_db_pool_saturation Checked out connections over pool capacity.',
+            '# TYPE trivia_db_pool_saturation gauge',
+        ])
+        lines.extend(f'trivia_db_pool_saturation{{pool="{name}"}} {pool["saturation"]}'
+                     for name, pool in pools['pools'].items() if 'saturation' in pool)
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        return Response(self.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _current.get()
+    started = conn.info.get('query_started')
+    if timings is not None and started:
+        timings.sql_seconds += time.perf_counter() - started.pop()
+        timings.sql_statements += 1
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,217 @@
+"""Schema migrations for databases created before the current models.
+
+db.create_all() only creates missing tables, it never changes an existing one.
+Every migration here brings an older questions table to the shape of the models
+and is written to be a no-op on a database that already has that shape, so a
+fresh database created by create_all() can be upgraded safely too. Tables missing
+altogether are created first, so with DB_CREATE_SCHEMA=false db-upgrade is also
+how a new database gets its schema. Applied versions are recorded in the
+schema_migrations table.
+
+Migrations are written to run against a live database: data is backfilled in
+small id range batches with a commit per batch, and indexes are built with
+CREATE INDEX CONCURRENTLY on PostgreSQL so writes are never blocked for long.
+
+    flask db-upgrade
+"""
+import os
+from datetime import datetime
+
+import click
+from sqlalchemy import Integer, inspect, text
+
+from flaskr import dedup, stats
+from flaskr.search import SEARCH_INDEX_DEFINITION
+from models import db, CategoryStats
+
+MIGRATIONS_TABLE = 'schema_migrations'
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 5000))
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register function(engine, batch_size) as the migration to schema version"""
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        return function
+    return register
+
+
+def _columns(engine, table):
+    return {column['name']: column for column in inspect(engine).get_columns(table)}
+
+
+def _is_postgresql(engine):
+    return engine.dialect.name == 'postgresql'
+
+
+def _create_index(engine, definition, unique=False):
+    """Create an index from 'name ON table (...)' unless it exists, without locking writes on PostgreSQL"""
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    if _is_postgresql(engine):
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').execute(
+                text(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS {definition}'))
+    else:
+        with engine.begin() as connection:
+            connection.execute(text(f'CREATE {kind} IF NOT EXISTS {definition}'))
+
+
+def _backfill(engine, statement, batch_size, **parameters):
+    """Run an UPDATE statement taking :low and :high over every id range of batch_size, one transaction each"""
+    with engine.connect() as connection:
+        low, high = connection.execute(text('SELECT min(id), max(id) FROM questions')).first()
+    if low is None:
+        return
+    for start in range(low - 1, high, batch_size):
+        with engine.begin() as connection:
+            connection.execute(text(statement), low=start, high=start + batch_size, **parameters)
+
+
+@migration(1, 'Add questions.updated_at')
+def add_updated_at(engine, batch_size):
+    """Existing questions get the time of the migration, so exports since an earlier time include them"""
+    if 'updated_at' not in _columns(engine, 'questions'):
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE questions ADD COLUMN updated_at TIMESTAMP'))
+    _backfill(
+        engine,
+        'UPDATE questions SET updated_at = :now WHERE id > :low AND id <= :high AND updated_at IS NULL',
+        batch_size,
+        now=datetime.utcnow()
+    )
+    _create_index(engine, 'ix_questions_updated_at ON questions (updated_at)')
+
+
+@migration(2, 'Add full text search index on questions')
+def add_search_index(engine, batch_size):
+    if _is_postgresql(engine):
+        _create_index(engine, SEARCH_INDEX_DEFINITION)
+
+
+@migration(3, 'Make questions.category an integer foreign key to categories.id')
+def category_foreign_key(engine, batch_size):
+    """Questions whose category does not match an existing category get a NULL category.
+
+    A text category column is replaced online: a new integer category_id column is
+    backfilled batch by batch, then a final transaction blocking writes catches up rows
+    written or recategorised meanwhile and swaps the columns. An integer category column only gets the
+    constraint, added NOT VALID and validated afterwards to avoid a long lock."""
+    columns = _columns(engine, 'questions')
+    if isinstance(columns['category']['type'], Integer):
+        if not _is_postgresql(engine):
+            return  # SQLite can not add a constraint to an existing column
+        foreign_keys = inspect(engine).get_foreign_keys('questions')
+        if any(key['constrained_columns'] == ['category'] for key in foreign_keys):
+            return
+        _backfill(
+            engine,
+            'UPDATE questions SET category = NULL WHERE id > :low AND id <= :high '
+            'AND category IS NOT NULL AND category NOT IN (SELECT id FROM categories)',
+            batch_size
+        )
+        with engine.begin() as connection:
+            connection.execute(text(
+                'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+                'FOREIGN KEY (category) REFERENCES categories (id) NOT VALID'))
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE questions VALIDATE CONSTRAINT questions_category_fkey'))
+        return
+
+    if 'category_id' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE questions ADD COLUMN category_id INTEGER REFERENCES categories (id)'))
+    matching_category = '(SELECT categories.id FROM categories ' \
+                        'WHERE CAST(categories.id AS VARCHAR) = questions.category)'
+    _backfill(
+        engine,
+        f'UPDATE questions SET category_id = {matching_category} WHERE id > :low AND id <= :high',
+        batch_size
+    )
+    with engine.begin() as connection:
+        if _is_postgresql(engine):
+            connection.execute(text('LOCK TABLE questions IN EXCLUSIVE MODE'))
+        connection.execute(text(
+            f'UPDATE questions SET category_id = {matching_category} '
+            'WHERE category_id IS NULL AND category IS NOT NULL '
+            'OR category_id IS NOT NULL AND (category IS NULL OR CAST(category_id AS VARCHAR) <> category)'))
+        connection.execute(text('ALTER TABLE questions DROP COLUMN category'))
+        connection.execute(text('ALTER TABLE questions RENAME COLUMN category_id TO category'))
+
+
+@migration(4, 'Index questions on (category, id) and (difficulty)')
+def add_question_indexes(engine, batch_size):
+    _create_index(engine, 'ix_questions_category ON questions (category, id)')
+    _create_index(engine, 'ix_questions_difficulty ON questions (difficulty)')
+
+
+@migration(5, 'Count questions per category and difficulty in category_stats')
+def add_category_stats(engine, batch_size):
+    CategoryStats.__table__.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        stats.rebuild(connection)
+
+
+@migration(6, 'Add questions.content_hash with a unique index')
+def add_content_hash(engine, batch_size):
+    """Existing duplicates keep a NULL content_hash after the oldest copy, so the unique index
+    can be built; list them with flask report-duplicates"""
+    if 'content_hash' not in _columns(engine, 'questions'):
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE questions ADD COLUMN content_hash VARCHAR(40)'))
+    with engine.connect() as connection:
+        low, high = connection.execute(text('SELECT min(id), max(id) FROM questions')).first()
+    for start in range(low - 1, high, batch_size) if low is not None else ():
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text('SELECT id, question FROM questions WHERE id > :low AND id <= :high AND content_hash IS NULL'),
+                low=start, high=start + batch_size).fetchall()
+            if rows:
+                connection.execute(
+                    text('UPDATE questions SET content_hash = :digest WHERE id = :id'),
+                    [{'id': question_id, 'digest': dedup.content_hash(question)} for question_id, question in rows])
+    with engine.begin() as connection:
+        connection.execute(text(
+            'UPDATE questions SET content_hash = NULL WHERE content_hash IS NOT NULL AND id NOT IN '
+            '(SELECT min(id) FROM questions WHERE content_hash IS NOT NULL GROUP BY content_hash)'))
+    _create_index(engine, 'ux_questions_content_hash ON questions (content_hash)', unique=True)
+
+
+def applied_versions(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} '
+            '(version INTEGER PRIMARY KEY, description VARCHAR, applied_at TIMESTAMP)'))
+        return {version for version, in connection.execute(text(f'SELECT version FROM {MIGRATIONS_TABLE}'))}
+
+
+def upgrade(engine, batch_size=MIGRATION_BATCH_SIZE, echo=lambda message: None):
+    """Create missing tables, then apply every migration not applied yet, in version order.
+    Return the applied versions"""
+    db.Model.metadata.create_all(engine)
+    done = applied_versions(engine)
+    applied = []
+    for version, description, function in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in done:
+            continue
+        echo(f'Applying {version}: {description}')
+        function(engine, batch_size)
+        with engine.begin() as connection:
+            connection.execute(
+                text(f'INSERT INTO {MIGRATIONS_TABLE} (version, description, applied_at) '
+                     'VALUES (:version, :description, :applied_at)'),
+                version=version, description=description, applied_at=datetime.utcnow()
+            )
+        applied.append(version)
+    return applied
+
+
+def init_app(app):
+    @app.cli.command('db-upgrade')
+    @click.option('--batch-size', default=MIGRATION_BATCH_SIZE, show_default=True,
+                  help='Number of rows backfilled per transaction.')
+    def upgrade_command(batch_size):
+        """Create or upgrade the database schema to the current models"""
+        applied = upgrade(db.engine, batch_size, echo=click.echo)
+        click.echo(f'Applied {len(applied)} migrations.' if applied else 'Database schema is up to date.')
@@ -0,0 +1,57 @@
+import base64
+import binascii
+import json
+
+from sqlalchemy import func
+
+from flaskr.instrumentation import phase
+from flaskr.projection import fetch_items
+from models import Question
+
+QUESTIONS_PER_PAGE = 10
+
+
+def encode_cursor(last_id):
+    """Return an opaque cursor pointing just after the question with id last_id"""
+    payload = json.dumps({'after': last_id}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the question id a cursor points after. Raise ValueError for a malformed cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded.encode()))['after']
+    except (binascii.Error, UnicodeDecodeError, TypeError, KeyError, json.JSONDecodeError):
+        raise ValueError(f'Invalid pagination cursor: {cursor!r}')
+    if not isinstance(last_id, int):
+        raise ValueError(f'Invalid pagination cursor: {cursor!r}')
+    return last_id
+
+
+def count(query):
+    """Return the number of rows matched by query with a single COUNT, without loading them"""
+    return query.with_entities(func.count(Question.id)).order_by(None).scalar()
+
+
+def paginate(request, query):
+    """Return (questions, next_cursor) for one page of an unordered Question query.
+    Questions are QuestionItems read without loading Question entities.
+
+    LIMIT/OFFSET is pushed down to the database for the `page` request arg. When a
+    `cursor` request arg is sent the page is read by keyset on Question.id instead,
+    which costs the same however deep into the table the page is.
+    One extra row is fetched to know whether a next page exists."""
+    query = query.order_by(Question.id)
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        query = query.filter(Question.id > decode_cursor(cursor))
+    else:
+        page = max(request.args.get('page', 1, int), 1)
+        query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    with phase('hydrate'):
+        rows = fetch_items(query.limit(QUESTIONS_PER_PAGE + 1))
+        questions = rows[:QUESTIONS_PER_PAGE]
+        next_cursor = encode_cursor(questions[-1].id) if len(rows) > QUESTIONS_PER_PAGE else None
+        return questions, next_cursor
@@ -0,0 +1,61 @@
+"""Column projected, ORM free reads of questions for the list endpoints.
+
+Loading Question entities costs an identity map entry, attribute instrumentation
+and a format() dict per row. List pages only need the five columns they return,
+so their rows are selected with a Core statement and kept in QuestionItem, a
+__slots__ dataclass that flaskr.serialization encodes without an intermediate dict.
+
+Clients needing fewer keys send a fields request arg, e.g. ?fields=id,question,
+and get questions with only those keys, see select_fields.
+"""
+from dataclasses import dataclass
+
+from models import db, Question
+
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+
+
+@dataclass
+class QuestionItem:
+    """A question of a list response, encoded as the same object as Question.format()"""
+    __slots__ = ('id', 'question', 'answer', 'category', 'difficulty')
+    id: int
+    question: str
+    answer: str
+    category: int
+    difficulty: int
+
+    def format(self):
+        return {
+            'id': self.id,
+            'question': self.question,
+            'answer': self.answer,
+            'category': self.category,
+            'difficulty': self.difficulty,
+        }
+
+
+def fetch_items(query):
+    """Return the QuestionItems of a Question query, reading only QUESTION_COLUMNS"""
+    statement = query.with_entities(*QUESTION_COLUMNS).statement
+    return [QuestionItem(*row) for row in db.session.execute(statement)]
+
+
+def requested_fields(args):
+    """Return the question fields listed in the comma separated fields request arg, or None
+    for all of them. Raise ValueError for an unknown field"""
+    value = args.get('fields')
+    if value is None:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in QuestionItem.__slots__]
+    if unknown or not fields:
+        raise ValueError(f'fields must be a comma separated list of: {", ".join(QuestionItem.__slots__)}.')
+    return fields
+
+
+def select_fields(items, fields):
+    """Return QuestionItems as dicts holding only fields, or unchanged when fields is None"""
+    if fields is None:
+        return items
+    return [{field: getattr(item, field) for field in fields} for item in items]
@@ -0,0 +1,151 @@
+import os
+import random
+import secrets
+import threading
+
+from flaskr.cache import MemoryBackend
+from flaskr.sampling import sampler
+from flaskr.snapshot import question_snapshots
+from models import Question
+
+QUIZ_SESSION_STORE = os.getenv('QUIZ_SESSION_STORE', 'memory')
+QUIZ_SESSION_LIMIT = int(os.getenv('QUIZ_SESSION_LIMIT', 10000))
+QUIZ_SESSION_TTL = int(os.getenv('QUIZ_SESSION_TTL', 3600))
+QUIZ_SESSION_REDIS_URL = os.getenv('QUIZ_SESSION_REDIS_URL', 'redis://localhost:6379/0')
+
+
+class LazyPermutation:
+    """A random permutation of ids generated one element at a time.
+
+    This is Fisher-Yates shuffling done lazily: each pop swaps a random remaining
+    position into the front. Swapped positions are kept in a small dict instead of
+    copying ids, so the ids tuple can be shared with every other session and a
+    session costs memory in proportion to the rounds played, not to the bank size."""
+    __slots__ = ('ids', 'position', 'swaps')
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.position = 0
+        self.swaps = {}
+
+    def __len__(self):
+        return len(self.ids) - self.position
+
+    def pop(self, rng=random):
+        """Return the next id of the permutation, or None once every id has been returned"""
+        if self.position >= len(self.ids):
+            return None
+        chosen = rng.randrange(self.position, len(self.ids))
+        question_id = self.swaps.pop(chosen, self.ids[chosen])
+        if chosen != self.position:
+            self.swaps[chosen] = self.swaps.pop(self.position, self.ids[self.position])
+        else:
+            self.swaps.pop(self.position, None)
+        self.position += 1
+        return question_id
+
+
+class MemoryQuizSessionStore:
+    """Sessions of this process, LRU bounded to max_sessions and expiring ttl seconds after last use"""
+
+    def __init__(self, max_sessions=QUIZ_SESSION_LIMIT, ttl=QUIZ_SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = MemoryBackend(max_entries=max_sessions, ttl=ttl)
+
+    def create(self, session_id, ids):
+        self._sessions.set(session_id, LazyPermutation(ids))
+
+    def pop(self, session_id):
+        """Return (question_id, remaining) or None for an unknown or expired session"""
+        with self._lock:
+            permutation = self._sessions.get(session_id)
+            if permutation is None:
+                return None
+            question_id = permutation.pop()
+            self._sessions.set(session_id, permutation)
+            return question_id, len(permutation)
+
+
+class RedisQuizSessionStore:
+    """Sessions shared by every worker through Redis.
+
+    The permutation is shuffled once when the session is created and stored as a
+    Redis list, so every round is a single LPOP whichever worker serves it."""
+
+    def __init__(self, url=QUIZ_SESSION_REDIS_URL, ttl=QUIZ_SESSION_TTL):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('QUIZ_SESSION_STORE=redis needs the redis package: pipenv install redis')
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+
+    def create(self, session_id, ids):
+        key = f'trivia:quiz:{session_id}'
+        shuffled = random.sample(ids, len(ids))
+        pipeline = self._client.pipeline()
+        # A sentinel keeps the key alive once every question has been popped
+        pipeline.rpush(key, *shuffled, 0)
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+
+    def pop(self, session_id):
+        key = f'trivia:quiz:{session_id}'
+        pipeline = self._client.pipeline()
+        pipeline.lpop(key)
+        pipeline.llen(key)
+        pipeline.expire(key, self.ttl)
+        question_id, remaining, _ = pipeline.execute()
+        if question_id is None:
+            return None
+        if int(question_id) == 0:
+            self._client.rpush(key, 0)
+            return None, 0
+        return int(question_id), max(remaining - 1, 0)
+
+
+STORES = {'memory': MemoryQuizSessionStore, 'redis': RedisQuizSessionStore}
+
+
+class QuizSessions:
+    """Server side quiz games.
+
+    A session holds a lazily consumed random permutation of the ids of a category,
+    taken from the sampler index, so the client never sends the questions it has
+    played and every round costs one pop and one primary key lookup."""
+
+    def __init__(self):
+        self.store = None
+
+    def init_app(self, app):
+        self.store = STORES[app.config.setdefault('QUIZ_SESSION_STORE', QUIZ_SESSION_STORE)]()
+
+    def create(self, category=None):
+        """Start a session over category (None for all categories). Return (session_id, total_questions)"""
+        ids = sampler.snapshot(category)
+        session_id = secrets.token_urlsafe(16)
+        self.store.create(session_id, ids)
+        return session_id, len(ids)
+
+    def next_question(self, session_id):
+        """Return (question, remaining) for the next unplayed question of the session,
+        (None, 0) when the game is over, or None for an unknown or expired session"""
+        while True:
+            popped = self.store.pop(session_id)
+            if popped is None:
+                return None
+            question_id, remaining = popped
+            if question_id is None:
+                return None, 0
+            question_snapshot = question_snapshots.current()
+            if question_snapshot is not None:
+                question = question_snapshot.get(question_id)
+            else:
+                question = Question.query.get(question_id)
+            # Questions deleted since the session started are skipped
+            if question is not None:
+                return question, remaining
+
+
+quiz_sessions = QuizSessions()
@@ -0,0 +1,570 @@
+"""Resources of the trivia API, routed by create_app"""
+import random
+
+from flask import Response, request, stream_with_context
+from flask_restful import Resource
+from sqlalchemy import exc
+
+from database import pool_metrics
+from flaskr import batch, bulk, dedup, stats
+from flaskr.cache import ALL_QUESTIONS, category_scope, response_cache
+from flaskr.catalogue import category_catalogue
+from flaskr.instrumentation import phase
+from flaskr.pagination import QUESTIONS_PER_PAGE, count, paginate
+from flaskr.projection import requested_fields, select_fields
+from flaskr.quiz_sessions import quiz_sessions
+from flaskr.sampling import (
+    QUIZ_MAX_BATCH, QUIZ_MODE_ADAPTIVE, QUIZ_MODE_UNIFORM, QUIZ_MODES, next_difficulty, sampler
+)
+from flaskr.search import search_questions
+from flaskr.serialization import output_json
+from flaskr.snapshot import question_snapshots
+from models import db, Question
+
+
+def output_timed_json(data, code, headers=None):
+    """JSON representation of every resource, timed as the serialize phase"""
+    with phase('serialize'):
+        return output_json(data, code, headers)
+
+
+class Categories(Resource):
+    payload_key = 'categories'
+
+    def get(self):
+        """Return json response: list of all categories
+        HTTP GET -> CRUD READ"""
+        success_response = {
+            'status': 'success',
+            self.payload_key: list()
+        }
+        fail_response = {
+            'status': 'fail',
+            self.payload_key: {},
+            'message': 'The server can not find categories or no category exists yet.'
+        }
+        try:
+            categories, etag = category_catalogue.get()
+            if not categories:
+                return fail_response, 400
+            elif request.if_none_match.contains(etag):
+                return Response(status=304, headers={'ETag': f'"{etag}"'})
+            else:
+                success_response[self.payload_key] = categories
+                return success_response, 200, {'ETag': f'"{etag}"'}
+        except exc.IntegrityError:
+            return fail_response, 404
+
+
+class Questions(Resource):
+
+    @response_cache.cached(ALL_QUESTIONS)
+    def get(self):
+        """Return json response: Paginated list of all questions
+        HTTP GET -> CRUD Read"""
+        success_response = {
+            'status': 'success',
+            'questions': [],
+            'total_questions': int(),
+            'next_cursor': None,
+            'categories': {},
+            'current_category': None
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'The server can not find questions or no question exists yet.'
+        }
+        try:
+            fields = requested_fields(request.args)
+        except ValueError as error:
+            fail_response['message'] = str(error)
+            return fail_response, 400
+        try:
+            question_snapshot = question_snapshots.current()
+            if question_snapshot is not None:
+                total_questions = question_snapshot.count()
+            else:
+                # category_stats may not be built yet on a database that was never upgraded
+                total_questions = stats.total() or count(Question.query)
+            categories, _ = category_catalogue.get()
+
+            if not total_questions or not categories:
+                fail_response['message'] = 'No questions/categories retrieved from database.'
+                return fail_response, 400
+            else:
+                questions, success_response['next_cursor'] = question_snapshot.paginate(
+                    request) if question_snapshot is not None else paginate(request, Question.query)
+                success_response['questions'] = select_fields(questions, fields)
+                success_response['total_questions'] = total_questions
+                # A client sending the etag of the categories it cached does not need them again
+                if category_catalogue.is_current(request.args.get('categories_etag')):
+                    del success_response['categories']
+                else:
+                    success_response['categories'] = categories
+                success_response['current_category'] = None
+                return success_response, 200
+        except ValueError:
+            return fail_response, 404
+
+    def post(self):
+        """Search questions or add (create) a question
+        If searching questions: return json response of paginated list of found questions. HTTP GET -> CRUD Read
+        If creating a question: return success json response"""
+        success_response = {
+            'status': 'success',
+            'question': '',
+            'answer': '',
+            'category': {},
+            'difficulty': int()
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'Error adding new question to database.'
+        }
+
+        post_data = request.get_json(silent=True)
+        if not post_data or not isinstance(post_data, dict):
+            fail_response['message'] = 'None or invalid question format sent to server.'
+            return fail_response, 400
+
+        if (search_term := post_data.get('searchTerm', None)) is not None and not isinstance(search_term, str):
+            fail_response['message'] = 'searchTerm must be a string.'
+            return fail_response, 400
+        elif search_term:
+            try:
+                fields = requested_fields(request.args)
+            except ValueError as error:
+                fail_response['message'] = str(error)
+                return fail_response, 400
+
+            def search():
+                questions, total_questions, categories_ids = search_questions(
+                    search_term, request.args.get('page', 1, int), QUESTIONS_PER_PAGE)
+                categories, _ = category_catalogue.get()
+                search_response = {
+                    'status': 'success',
+                    'questions': select_fields(questions, fields),
+                    'total_questions': total_questions,
+                    'current_category': random.choice(list(categories_ids)) if categories_ids else None
+                }
+                if not category_catalogue.is_current(request.args.get('categories_etag')):
+                    search_response['categories'] = {
+                        category_id: category_type for category_id, category_type in categories.items()
+                        if category_id in categories_ids
+                    }
+                return search_response, 200
+
+            # Search results are cached until the next committed question write
+            return response_cache.memoize([ALL_QUESTIONS], search)
+        # If creating a new question, verify all required data is in request payload
+        elif not all(
+                [post_data.get('question', None),
+                 post_data.get('answer', None),
+                 post_data.get('category', None),
+                 post_data.get('difficulty', None)]
+        ):
+            fail_response['message'] = 'Required question data fields not sent to server.'
+            return fail_response, 400
+
+        # Validated like imported questions: texts, an integer difficulty and an existing category
+        try:
+            row = bulk.validate(post_data)
+        except ValueError as error:
+            fail_response['message'] = str(error)
+            return fail_response, 400
+        # The same question, spelled differently or not, must not be asked twice
+        if (duplicate_id := dedup.find_duplicate(row['question'])) is not None:
+            fail_response['message'] = 'The same question already exists.'
+            fail_response['duplicate_of'] = duplicate_id
+            return fail_response, 409
+        # Create new question in db
+        else:
+            question = row['question']
+            answer = row['answer']
+            category = row['category']
+            difficulty = row['difficulty']
+            new_question = Question(
+                question=question,
+                answer=answer,
+                category=category,
+                difficulty=difficulty
+            )
+            similar_questions = dedup.near_duplicates.similar(question)
+            try:
+                new_question.insert()
+                success_response['question'] = question
+                success_response['answer'] = answer
+                success_response['category'] = category
+                success_response['difficulty'] = difficulty
+                success_response['similar_questions'] = [
+                    {'id': question_id, 'similarity': similarity} for question_id, similarity in similar_questions
+                ]
+                return success_response, 201
+            except exc.IntegrityError:
+                new_question.rollback()
+                # Another request may have inserted the same question meanwhile
+                if (duplicate_id := dedup.find_duplicate(question)) is not None:
+                    fail_response['message'] = 'The same question already exists.'
+                    fail_response['duplicate_of'] = duplicate_id
+                    return fail_response, 409
+                return fail_response, 500
+
+    def delete(self, questions_id):
+        """Delete a specific question
+        HTTP DELETE -> CRUD DELETE"""
+        success_response = {}
+        fail_response = {
+            'status': 'fail',
+            'message': 'Error deleting target question.'
+        }
+        try:
+            target_question = Question.query.filter(Question.id == questions_id).one_or_none()
+            if target_question is None:
+                fail_response['message'] = 'Target question does not exist or already deleted.'
+                return fail_response, 404
+            target_question.delete()
+            return None, 204
+        except exc.IntegrityError:
+            target_question.rollback()
+            return fail_response, 500
+
+
+class QuestionsBulk(Resource):
+
+    def post(self):
+        """Import many questions streamed in the request body as NDJSON or CSV
+        Rows are validated as they arrive and written in batches, one transaction per batch.
+        Pass similar=true to also report questions similar to existing ones.
+        HTTP POST -> CRUD CREATE"""
+        success_response = {
+            'status': 'success',
+            'inserted': int(),
+            'rejected': int(),
+            'errors': []
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'No valid question rows found in request body.'
+        }
+
+        source_format = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+        if source_format not in bulk.PARSERS:
+            fail_response['message'] = f'Unsupported import format. Use one of: {", ".join(bulk.PARSERS)}.'
+            return fail_response, 400
+        batch_size = max(request.args.get('batch_size', bulk.BULK_IMPORT_BATCH_SIZE, int), 1)
+        similar = request.args.get('similar', '').lower() in ('1', 'true', 'yes', 'on')
+
+        summary = bulk.import_questions(bulk.PARSERS[source_format](request.stream), batch_size, similar)
+        if not summary['inserted']:
+            fail_response.update(summary)
+            return fail_response, 400
+        success_response.update(summary)
+        return success_response, 201
+
+
+class QuestionsBatch(Resource):
+
+    def post(self):
+        """Create, update and delete many questions in one transaction
+        Takes {"operations": [...]} and returns one result per operation, in the same order.
+        HTTP POST -> CRUD CREATE, UPDATE and DELETE"""
+        success_response = {
+            'status': 'success',
+            'applied': int(),
+            'failed': int(),
+            'results': []
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'No operation of the batch could be applied.'
+        }
+
+        body = request.get_json(silent=True)
+        operations = body.get('operations') if isinstance(body, dict) else None
+        if not isinstance(operations, list) or not operations:
+            fail_response['message'] = 'A non empty list of operations must be sent to server.'
+            return fail_response, 400
+        if len(operations) > batch.BATCH_MAX_OPERATIONS:
+            fail_response['message'] = f'A batch can not have more than {batch.BATCH_MAX_OPERATIONS} operations.'
+            return fail_response, 400
+
+        results, committed = batch.apply_operations(operations)
+        applied = sum(result['status'] == 'success' for result in results)
+        if not committed:
+            fail_response['results'] = results
+            return fail_response, 500 if any(result['code'] == 500 for result in results) else 400
+        success_response['applied'] = applied
+        success_response['failed'] = len(results) - applied
+        success_response['results'] = results
+        return success_response, 200
+
+
+class QuestionsExport(Resource):
+
+    def get(self):
+        """Stream the question bank as NDJSON or CSV, optionally filtered by category and difficulty
+        With an If-Modified-Since header only questions created or updated after that time are sent.
+        HTTP GET -> CRUD READ"""
+        fail_response = {
+            'status': 'fail',
+            'message': 'Unsupported export format. Use one of: ndjson, csv.'
+        }
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in bulk.EXPORT_MIMETYPES:
+            return fail_response, 400
+
+        query = bulk.export_query(
+            category=request.args.get('category', None, int),
+            difficulty=request.args.get('difficulty', None, int),
+            modified_since=request.if_modified_since
+        )
+        last_modified = bulk.last_modified(query)
+        if request.if_modified_since is not None and last_modified is None:
+            return Response(status=304)
+
+        response = Response(
+            stream_with_context(bulk.export_rows(query, export_format)),
+            mimetype=bulk.EXPORT_MIMETYPES[export_format]
+        )
+        response.last_modified = last_modified
+        response.headers['Content-Disposition'] = f'attachment; filename=questions.{export_format}'
+        return response
+
+
+class CategoryStatistics(Resource):
+
+    @response_cache.cached(ALL_QUESTIONS)
+    def get(self):
+        """Return json response: number of questions of every category, in total and by difficulty
+        HTTP GET -> CRUD READ"""
+        success_response = {
+            'status': 'success',
+            'categories': [],
+            'total_questions': int()
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'The server can not find categories or no category exists yet.'
+        }
+        categories, _ = category_catalogue.get()
+        if not categories:
+            return fail_response, 400
+
+        counts = stats.get()
+        for category_id, category_type in categories.items():
+            difficulties = counts.get(category_id, {})
+            success_response['categories'].append({
+                'id': category_id,
+                'type': category_type,
+                'total_questions': sum(difficulties.values()),
+                'difficulties': difficulties
+            })
+        success_response['total_questions'] = sum(
+            category['total_questions'] for category in success_response['categories'])
+        return success_response, 200
+
+
+class CategoryQuestions(Resource):
+
+    @response_cache.cached(lambda category_id: category_scope(category_id))
+    def get(self, category_id):
+        """Return json response with list of questions base on a category.
+        HTTP GET -> CRUD READ"""
+
+        success_response = {
+            'status': 'success',
+            'questions': [],
+            'total_questions': int(),
+            'next_cursor': None,
+            'current_category': None
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'Server can not find questions for requested category or the category does not exist.'
+        }
+        try:
+            fields = requested_fields(request.args)
+        except ValueError as error:
+            fail_response['message'] = str(error)
+            return fail_response, 400
+        try:
+            question_snapshot = question_snapshots.current()
+            questions = Question.query.filter(Question.category == category_id)
+            if question_snapshot is not None:
+                total_questions = question_snapshot.count(category_id)
+            else:
+                # category_stats may not be built yet on a database that was never upgraded
+                total_questions = stats.total(category_id) or count(questions)
+
+            if not total_questions:
+                return fail_response, 400
+            else:
+                page, success_response['next_cursor'] = question_snapshot.paginate(
+                    request, category_id) if question_snapshot is not None else paginate(request, questions)
+                success_response['questions'] = select_fields(page, fields)
+                success_response['total_questions'] = total_questions
+                success_response['current_category'] = category_id
+                return success_response, 200
+        except ValueError:
+            return fail_response, 404
+
+
+class PlayQuiz(Resource):
+    def post(self):
+        """ HTTP POST -> CRUD READ
+        Returns response object with questions to play the quiz game.
+        This endpoint takes category and previous questions played and
+        return a random questions within the given category, if provided,
+        and that is not played yet.
+        With a count, up to count unplayed questions are returned at once in questions,
+        so a whole game can be fetched in one request.
+        In adaptive mode the client also sends the difficulty of the last question and
+        whether it was answered correctly, and the next question is picked one
+        difficulty up after a correct answer and one down after a wrong one."""
+
+        success_response = {
+            'status': 'success',
+            'previousQuestions': [],
+            'forceEnd': False
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'Error. Server did not retrieve an un played quiz question.'
+        }
+
+        try:
+            frontend_request_data = request.get_json(silent=True)
+            previous_questions = frontend_request_data.get('previous_questions')
+            quiz_category = frontend_request_data.get('quiz_category')
+            play_all_categories = True if not quiz_category['id'] else False
+            category = None if play_all_categories else quiz_category['id']
+
+            mode = frontend_request_data.get('mode', QUIZ_MODE_UNIFORM)
+            if mode not in QUIZ_MODES:
+                return fail_response, 400
+            difficulty = None
+            if mode == QUIZ_MODE_ADAPTIVE:
+                difficulty = next_difficulty(
+                    frontend_request_data.get('difficulty'),
+                    frontend_request_data.get('correct'),
+                    sampler.difficulties(category)
+                )
+
+            batch_size = frontend_request_data.get('count')
+            if batch_size is not None and (isinstance(batch_size, bool) or not isinstance(batch_size, int)
+                                           or not 1 <= batch_size <= QUIZ_MAX_BATCH):
+                fail_response['message'] = f'count must be an integer between 1 and {QUIZ_MAX_BATCH}.'
+                return fail_response, 400
+
+            new_questions = sampler.sample_many(
+                category=category,
+                exclude=previous_questions,
+                count=1 if batch_size is None else batch_size,
+                difficulty=difficulty
+            )
+
+            success_response['previousQuestions'] = previous_questions
+            if not new_questions:
+                success_response['question'] = None
+                success_response['forceEnd'] = True
+                if batch_size is not None:
+                    success_response['questions'] = []
+                return success_response, 200
+
+            played = []
+            for new_question in new_questions:
+                previous_questions.append(new_question.id)
+                played.append({
+                    'question': new_question.question,
+                    'answer': new_question.answer,
+                })
+                if mode == QUIZ_MODE_ADAPTIVE:
+                    played[-1]['difficulty'] = new_question.difficulty
+            success_response['question'] = played[0]
+            if batch_size is not None:
+                success_response['questions'] = played
+            return success_response, 200
+        except:
+            return fail_response, 400
+
+
+class PlayQuizSession(Resource):
+    def post(self):
+        """ HTTP POST -> CRUD CREATE
+        Starts a server side quiz game within the given category, or all categories if no
+        category id is given. The server remembers which questions are played, so the client
+        only sends the returned session id to get the next question."""
+        success_response = {
+            'status': 'success',
+            'session_id': None,
+            'total_questions': int(),
+            'expires_in': quiz_sessions.store.ttl
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'Error. Server could not start a quiz session for the given category.'
+        }
+        try:
+            quiz_category = (request.get_json(silent=True) or {}).get('quiz_category') or {}
+            category = int(quiz_category['id']) if quiz_category.get('id') else None
+        except (AttributeError, TypeError, ValueError):
+            return fail_response, 400
+
+        success_response['session_id'], success_response['total_questions'] = quiz_sessions.create(category)
+        return success_response, 201
+
+
+class PlayQuizSessionNext(Resource):
+    def post(self, session_id):
+        """ HTTP POST -> CRUD READ
+        Returns the next random question of a quiz session that is not played yet."""
+        success_response = {
+            'status': 'success',
+            'question': None,
+            'remaining': int(),
+            'forceEnd': False
+        }
+        fail_response = {
+            'status': 'fail',
+            'message': 'Quiz session does not exist or has expired.'
+        }
+        next_question = quiz_sessions.next_question(session_id)
+        if next_question is None:
+            return fail_response, 404
+
+        question, success_response['remaining'] = next_question
+        if question is None:
+            success_response['forceEnd'] = True
+        else:
+            success_response['question'] = {
+                'id': question.id,
+                'question': question.question,
+                'answer': question.answer,
+            }
+        return success_response, 200
+
+
+class DatabasePool(Resource):
+    def get(self):
+        """Return json response: connection checkout wait and pool saturation of this process
+        HTTP GET -> CRUD READ"""
+        return {
+            'status': 'success',
+            'database_pool': pool_metrics.snapshot(db.engines())
+        }, 200
+
+
+# (resource, *urls) in the order they are added to the Api
+ROUTES = (
+    (Categories, '/categories'),
+    (CategoryStatistics, '/categories/stats'),
+    (CategoryQuestions, '/categories/<int:category_id>/questions'),
+    (Questions, '/', '/questions', '/questions/<int:questions_id>'),
+    (QuestionsBulk, '/questions/bulk'),
+    (QuestionsBatch, '/questions/batch'),
+    (QuestionsExport, '/questions/export'),
+    (PlayQuiz, '/quizzes'),
+    (PlayQuizSession, '/quizzes/sessions'),
+    (PlayQuizSessionNext, '/quizzes/sessions/<string:session_id>/next'),
+    (DatabasePool, '/db/pool'),
+)
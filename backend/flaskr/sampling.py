@@ -0,0 +1,231 @@
+import os
+import random
+import threading
+import time
+
+from database import primary
+from flaskr import signals
+from flaskr.projection import fetch_items
+from flaskr.snapshot import question_snapshots
+from models import db, Question
+
+ALL_CATEGORIES = 'all'
+MAX_REJECTIONS = 32
+QUIZ_MAX_BATCH = int(os.getenv('QUIZ_MAX_BATCH', 50))
+QUIZ_INDEX_TTL = int(os.getenv('QUIZ_INDEX_TTL', 60))
+
+QUIZ_MODE_UNIFORM = 'uniform'
+QUIZ_MODE_ADAPTIVE = 'adaptive'
+QUIZ_MODES = (QUIZ_MODE_UNIFORM, QUIZ_MODE_ADAPTIVE)
+
+
+class IdBucket:
+    """A set of question ids with O(1) add, discard and uniform random pick"""
+    __slots__ = ('ids', 'positions', '_snapshot')
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        self._snapshot = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, question_id):
+        return question_id in self.positions
+
+    def add(self, question_id):
+        if question_id not in self.positions:
+            self.positions[question_id] = len(self.ids)
+            self.ids.append(question_id)
+            self._snapshot = None
+
+    def discard(self, question_id):
+        """Swap the id with the last one and pop it, so no list shifting is needed"""
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        self._snapshot = None
+        last_id = self.ids.pop()
+        if position < len(self.ids):
+            self.ids[position] = last_id
+            self.positions[last_id] = position
+
+    def snapshot(self):
+        """Return the ids as a tuple, shared by every caller until the bucket changes"""
+        if self._snapshot is None:
+            self._snapshot = tuple(self.ids)
+        return self._snapshot
+
+    def choice(self, exclude, rng=random):
+        """Return a random id not in exclude, or None if every id is excluded.
+
+        Rejection sampling costs O(1) expected time while most ids are still unplayed.
+        Only when rejections keep failing, i.e. the bucket is almost or fully played
+        out, the remaining ids are listed and picked from directly."""
+        if not self.ids:
+            return None
+        for _ in range(MAX_REJECTIONS):
+            question_id = self.ids[rng.randrange(len(self.ids))]
+            if question_id not in exclude:
+                return question_id
+        remaining = [question_id for question_id in self.ids if question_id not in exclude]
+        return rng.choice(remaining) if remaining else None
+
+
+def next_difficulty(difficulty, correct, difficulties):
+    """Return the target difficulty of the next adaptive round among the available difficulties.
+
+    The first round (no difficulty answered yet) targets the median difficulty,
+    then every correct answer moves the target one step up and every wrong one
+    one step down, within the lowest and highest available difficulty."""
+    if not difficulties:
+        return None
+    if difficulty is None or correct is None:
+        return difficulties[len(difficulties) // 2]
+    target = int(difficulty) + (1 if correct else -1)
+    return min(max(target, difficulties[0]), difficulties[-1])
+
+
+class QuestionSampler:
+    """In-process index of question ids per category and per (category, difficulty) used to pick quiz questions.
+
+    The index is loaded from the database (ids, categories and difficulties only) on first use
+    and then kept in sync with committed inserts and deletes through flaskr.signals. Writes made by
+    other processes, e.g. the other gunicorn workers, are picked up when it is reloaded every
+    QUIZ_INDEX_TTL seconds.
+    Picking a question costs the same whatever the size of the bank or the category:
+    one random pick in the bucket and one primary key lookup."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = None
+        self._loaded_at = 0
+        self.ttl = QUIZ_INDEX_TTL
+
+    def init_app(self, app):
+        self.ttl = app.config.setdefault('QUIZ_INDEX_TTL', QUIZ_INDEX_TTL)
+        self.invalidate()
+        signals.connect(self)
+
+    @staticmethod
+    def bucket_key(category, difficulty=None):
+        key = ALL_CATEGORIES if category is None else int(category)
+        return key if difficulty is None else (key, int(difficulty))
+
+    def _keys(self, category, difficulty):
+        """Return the keys of every bucket a question of category and difficulty belongs to"""
+        keys = [ALL_CATEGORIES, self.bucket_key(category)]
+        if difficulty is not None:
+            keys.extend((self.bucket_key(None, difficulty), self.bucket_key(category, difficulty)))
+        return keys
+
+    def invalidate(self):
+        with self._lock:
+            self._buckets = None
+
+    def _load(self):
+        buckets = {ALL_CATEGORIES: IdBucket()}
+        with primary():
+            rows = db.session.query(Question.id, Question.category, Question.difficulty).all()
+        for question_id, category, difficulty in rows:
+            for key in self._keys(category, difficulty):
+                buckets.setdefault(key, IdBucket()).add(question_id)
+        return buckets
+
+    def _bucket(self, category, difficulty=None):
+        with self._lock:
+            if self._buckets is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._buckets, self._loaded_at = self._load(), time.monotonic()
+            return self._buckets.get(self.bucket_key(category, difficulty))
+
+    def add(self, row):
+        with self._lock:
+            if self._buckets is not None:
+                for key in self._keys(row.category, row.difficulty):
+                    self._buckets.setdefault(key, IdBucket()).add(row.id)
+
+    def discard(self, row):
+        with self._lock:
+            if self._buckets is not None:
+                for key in self._keys(row.category, row.difficulty):
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.discard(row.id)
+
+    def snapshot(self, category=None):
+        """Return an immutable tuple of the question ids of category (None for all categories)"""
+        if (question_snapshot := question_snapshots.current()) is not None:
+            return question_snapshot.ids_of(category)
+        with self._lock:
+            bucket = self._bucket(category)
+            return bucket.snapshot() if bucket is not None else ()
+
+    def difficulties(self, category=None):
+        """Return the sorted difficulties that have questions in category (None for all categories)"""
+        if (question_snapshot := question_snapshots.current()) is not None:
+            return question_snapshot.difficulties(category)
+        category_key = self.bucket_key(category)
+        with self._lock:
+            self._bucket(category)
+            return sorted(key[1] for key, bucket in self._buckets.items()
+                          if isinstance(key, tuple) and key[0] == category_key and len(bucket))
+
+    def sample(self, category=None, exclude=(), difficulty=None):
+        """Return a random question of category (None for all categories) whose id is not in exclude,
+        or None when every question has been played. See sample_many for difficulty"""
+        questions = self.sample_many(category, exclude, 1, difficulty)
+        return questions[0] if questions else None
+
+    def sample_many(self, category=None, exclude=(), count=1, difficulty=None):
+        """Return up to count distinct random questions of category (None for all categories) whose ids
+        are not in exclude, as QuestionItems read in a single primary key query.
+        Fewer questions are returned only when fewer are left unplayed.
+
+        With a difficulty the questions are picked from that difficulty, then from the nearest
+        difficulties that still have unplayed questions, the easier one first on a tie.
+        With a question snapshot the questions are picked from it, without any query."""
+        exclude = set(exclude)
+        if difficulty is None:
+            bands = [None]
+        else:
+            bands = sorted(self.difficulties(category), key=lambda band: (abs(band - difficulty), band))
+        questions = []
+        question_snapshot = question_snapshots.current()
+        for band in bands:
+            if question_snapshot is not None:
+                questions.extend(question_snapshot.sample(category, band, exclude, count - len(questions)))
+                continue
+            while len(questions) < count:
+                ids = self._pick(category, band, exclude, count - len(questions))
+                if not ids:
+                    break
+                rows = {item.id: item for item in fetch_items(Question.query.filter(Question.id.in_(ids)))}
+                questions.extend(rows[question_id] for question_id in ids if question_id in rows)
+                # Rows gone (e.g. deleted by another process) are dropped from the index and picked again
+                self._drop([question_id for question_id in ids if question_id not in rows])
+        return questions
+
+    def _pick(self, category, difficulty, exclude, count):
+        """Pick up to count ids of a bucket that are not in exclude, adding them to exclude"""
+        ids = []
+        with self._lock:
+            bucket = self._bucket(category, difficulty)
+            while bucket is not None and len(ids) < count:
+                question_id = bucket.choice(exclude)
+                if question_id is None:
+                    break
+                exclude.add(question_id)
+                ids.append(question_id)
+        return ids
+
+    def _drop(self, question_ids):
+        if not question_ids:
+            return
+        with self._lock:
+            for bucket in (self._buckets or {}).values():
+                for question_id in question_ids:
+                    bucket.discard(question_id)
+
+
+sampler = QuestionSampler()
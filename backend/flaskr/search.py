@@ -0,0 +1,185 @@
+import bisect
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import DDL, event, func
+
+from database import primary
+from flaskr import signals
+from flaskr.instrumentation import phase
+from flaskr.projection import fetch_items
+from models import db, Question
+
+TOKEN_PATTERN = re.compile(r'\w+')
+TEXT_SEARCH_CONFIG = 'english'
+# The stop words of PostgreSQL's english text search configuration (english.stop), which
+# to_tsquery drops. Query tokens skip them on every backend, so they search alike.
+STOP_WORDS = frozenset('''
+    i me my myself we our ours ourselves you your yours yourself yourselves he him his himself she her hers
+    herself it its itself they them their theirs themselves what which who whom this that these those am is are
+    was were be been being have has had having do does did doing a an the and but if or because as until while
+    of at by for with about against between into through during before after above below to from up down in out
+    on off over under again further then once here there when where why how all any both each few more most
+    other some such no nor not only own same so than too very s t can will just don should now
+'''.split())
+SEARCH_INDEX_TTL = int(os.getenv('SEARCH_INDEX_TTL', 60))
+
+# Expression GIN index serving full text search over question and answer on PostgreSQL.
+# Other dialects (SQLite test runs) search the in-process InvertedIndex instead.
+SEARCH_DOCUMENT = func.to_tsvector(
+    TEXT_SEARCH_CONFIG,
+    func.coalesce(Question.question, '') + ' ' + func.coalesce(Question.answer, '')
+)
+SEARCH_INDEX_DEFINITION = (
+    "ix_questions_search ON questions USING gin "
+    f"(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(question, '') || ' ' || coalesce(answer, '')))"
+)
+event.listen(
+    Question.__table__,
+    'after_create',
+    DDL(f'CREATE INDEX IF NOT EXISTS {SEARCH_INDEX_DEFINITION}').execute_if(dialect='postgresql')
+)
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def query_tokens(search_term):
+    """Return the tokens of a search term that are searched, i.e. not stop words.
+    A term without any, e.g. blank, punctuation or 'the', matches no question"""
+    return [token for token in tokenize(search_term) if token not in STOP_WORDS]
+
+
+def prefix_tsquery(search_term):
+    """Turn a search term into a tsquery matching every word of the term as a prefix,
+    so a partially typed word like 'ques' still finds 'question'"""
+    return ' & '.join(f'{token}:*' for token in query_tokens(search_term))
+
+
+class InvertedIndex:
+    """In-process token -> question ids index over question and answer text.
+
+    Used as the search backend where PostgreSQL full text search is not available.
+    Loaded on first search and kept in sync through flaskr.signals, and reloaded every
+    SEARCH_INDEX_TTL seconds to pick up the writes of other processes."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = None
+        self._documents = None
+        self._vocabulary = None
+        self._loaded_at = 0
+        self.ttl = SEARCH_INDEX_TTL
+
+    def init_app(self, app):
+        self.ttl = app.config.setdefault('SEARCH_INDEX_TTL', SEARCH_INDEX_TTL)
+        self.invalidate()
+        signals.connect(self)
+
+    def invalidate(self):
+        with self._lock:
+            self._postings = None
+            self._documents = None
+            self._vocabulary = None
+
+    def _ensure_loaded(self):
+        if self._postings is None or time.monotonic() - self._loaded_at > self.ttl:
+            self._postings, self._documents, self._vocabulary = {}, {}, None
+            self._loaded_at = time.monotonic()
+            with primary():
+                rows = db.session.query(Question.id, Question.question, Question.answer, Question.category).all()
+            for row in rows:
+                self._index(row)
+
+    def _index(self, row):
+        tokens = Counter(tokenize(row.question) + tokenize(row.answer))
+        self._documents[row.id] = (tokens, row.category)
+        for token in tokens:
+            if token not in self._postings:
+                self._postings[token] = set()
+                self._vocabulary = None
+            self._postings[token].add(row.id)
+
+    def add(self, row):
+        with self._lock:
+            if self._postings is not None:
+                self.discard(row)
+                self._index(row)
+
+    def discard(self, row):
+        with self._lock:
+            if self._postings is None:
+                return
+            document = self._documents.pop(row.id, None)
+            if document is None:
+                return
+            for token in document[0]:
+                postings = self._postings[token]
+                postings.discard(row.id)
+                if not postings:
+                    del self._postings[token]
+                    self._vocabulary = None
+
+    def _tokens_with_prefix(self, prefix):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        end = bisect.bisect_left(self._vocabulary, prefix + '\U0010ffff')
+        return self._vocabulary[start:end]
+
+    def search(self, search_term):
+        """Return [(id, category)] of questions matching every word of search_term as a prefix,
+        best matches first"""
+        searched_tokens = query_tokens(search_term)
+        if not searched_tokens:
+            return []
+        with self._lock:
+            self._ensure_loaded()
+            matched_tokens = [self._tokens_with_prefix(token) for token in searched_tokens]
+            candidates = None
+            for tokens in sorted(matched_tokens, key=len):
+                ids = set().union(*(self._postings[token] for token in tokens))
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    return []
+            scored = []
+            for question_id in candidates:
+                document_tokens, category = self._documents[question_id]
+                score = sum(document_tokens[token] for tokens in matched_tokens for token in tokens)
+                scored.append((-score, question_id, category))
+        scored.sort()
+        return [(question_id, category) for _, question_id, category in scored]
+
+
+search_index = InvertedIndex()
+
+
+def search_questions(search_term, page, per_page):
+    """Return (questions, total_questions, categories_ids) for one page of ranked search results.
+
+    On PostgreSQL the match, ranking and LIMIT all run in the database against the
+    ix_questions_search GIN index. Elsewhere the InvertedIndex finds and ranks the
+    matching ids and only the page rows are read from the database."""
+    if not query_tokens(search_term):
+        return [], 0, set()
+    offset = (max(page, 1) - 1) * per_page
+    if db.engine.dialect.name == 'postgresql':
+        tsquery = func.to_tsquery(TEXT_SEARCH_CONFIG, prefix_tsquery(search_term))
+        matches = Question.query.filter(SEARCH_DOCUMENT.op('@@')(tsquery))
+        with phase('hydrate'):
+            questions = fetch_items(matches.order_by(func.ts_rank(SEARCH_DOCUMENT, tsquery).desc(), Question.id)
+                                    .offset(offset).limit(per_page))
+        total_questions = matches.with_entities(func.count(Question.id)).scalar()
+        categories_ids = {category for category, in matches.with_entities(Question.category).distinct()}
+        return questions, total_questions, categories_ids
+
+    results = search_index.search(search_term)
+    page_ids = [question_id for question_id, _ in results[offset:offset + per_page]]
+    with phase('hydrate'):
+        rows = {question.id: question for question in fetch_items(Question.query.filter(Question.id.in_(page_ids)))}
+        questions = [rows[question_id] for question_id in page_ids if question_id in rows]
+    return questions, len(results), {category for _, category in results}
@@ -0,0 +1,102 @@
+"""Commit-time notifications about writes to the questions table.
+
+In-process indexes over the question bank subscribe here instead of hooking
+SQLAlchemy events themselves. A receiver is any object with these methods:
+    add(row)        a question row was committed
+    discard(row)    a question row was deleted (or replaced by an update)
+    invalidate()    changes happened that can not be replayed row by row,
+                    e.g. Query.delete() or a Core bulk insert; rebuild lazily
+and may have this one, for work to do once per commit rather than once per row:
+    committed()     the rows of a commit were all replayed
+Rows are QuestionRow tuples, so receivers never touch session-bound ORM objects.
+"""
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, attributes, object_session
+
+from models import Question
+
+QuestionRow = namedtuple('QuestionRow', ['id', 'question', 'answer', 'category', 'difficulty'])
+
+PENDING_KEY = 'pending_question_changes'
+
+_receivers = []
+
+
+def connect(receiver):
+    """Subscribe receiver to question bank changes"""
+    if receiver not in _receivers:
+        _receivers.append(receiver)
+    return receiver
+
+
+def invalidate():
+    """Tell every receiver its view of the question bank can not be trusted anymore"""
+    for receiver in _receivers:
+        receiver.invalidate()
+
+
+def _row(question):
+    return QuestionRow(question.id, question.question, question.answer, question.category, question.difficulty)
+
+
+def _old_row(question):
+    """Return the row as it was before the pending update of question"""
+    values = {}
+    for field in QuestionRow._fields:
+        history = attributes.get_history(question, field)
+        values[field] = history.deleted[0] if history.deleted else getattr(question, field)
+    return QuestionRow(**values)
+
+
+def _queue(question, *changes):
+    session = object_session(question)
+    session.info.setdefault(PENDING_KEY, []).extend(changes)
+
+
+@event.listens_for(Question, 'after_insert')
+def _after_insert(mapper, connection, target):
+    _queue(target, ('add', _row(target)))
+
+
+@event.listens_for(Question, 'after_update')
+def _after_update(mapper, connection, target):
+    old_row, new_row = _old_row(target), _row(target)
+    if old_row != new_row:
+        _queue(target, ('discard', old_row), ('add', new_row))
+
+
+@event.listens_for(Question, 'after_delete')
+def _after_delete(mapper, connection, target):
+    _queue(target, ('discard', _row(target)))
+
+
+def notify(changes):
+    """Replay committed (action, row) changes, action being 'add' or 'discard', to every receiver.
+    For writes that bypass the ORM but know exactly which rows they changed"""
+    if not changes:
+        return
+    for action, row in changes:
+        for receiver in _receivers:
+            getattr(receiver, action)(row)
+    for receiver in _receivers:
+        if hasattr(receiver, 'committed'):
+            receiver.committed()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    notify(session.info.pop(PENDING_KEY, ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+@event.listens_for(Session, 'after_bulk_update')
+def _after_bulk_change(context):
+    if context.mapper.class_ is Question:
+        invalidate()
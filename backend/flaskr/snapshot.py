@@ -0,0 +1,420 @@
+"""Read-mostly snapshot of the question bank shared by every worker process of a host.
+
+Off unless QUESTION_SNAPSHOT=true. The questions table is exported to a compact
+file of fixed width arrays (ids, categories, difficulties, text offsets and the
+orders by category and difficulty) followed by one UTF-8 text blob. Workers mmap
+the file read-only, so the operating system keeps one copy of it per host in its
+page cache however many workers read it, and question pages, category pages and
+quiz picks are served from it without querying the database.
+
+The snapshot directory (QUESTION_SNAPSHOT_DIR) holds the snapshot files and a
+CURRENT pointer file naming the current generation and its snapshot file:
+    - a commit writing questions, seen through flaskr.signals, bumps the generation
+      once and clears the file of CURRENT, so every worker of the host stops reading the
+      old snapshot at its next request and reads the database meanwhile;
+    - the first worker needing the snapshot then builds it in a background thread
+      and, if no write happened during the build, swaps it in by replacing CURRENT.
+CURRENT and the snapshot files are only ever replaced with os.replace(), so readers
+see either the old or the new snapshot, never a partial one. Writes made on other
+hosts are only seen after QUESTION_SNAPSHOT_MAX_AGE seconds (0, the default, for never).
+
+    flask build-question-snapshot
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+import click
+
+from database import env_flag
+from flaskr import signals
+from flaskr.pagination import QUESTIONS_PER_PAGE, decode_cursor, encode_cursor
+from flaskr.projection import QUESTION_COLUMNS, QuestionItem
+from models import db, Question
+
+QUESTION_SNAPSHOT = env_flag('QUESTION_SNAPSHOT', False)
+QUESTION_SNAPSHOT_DIR = os.getenv('QUESTION_SNAPSHOT_DIR')
+QUESTION_SNAPSHOT_MAX_AGE = int(os.getenv('QUESTION_SNAPSHOT_MAX_AGE', 0))
+SNAPSHOT_BUILD_BATCH_SIZE = 5000
+MAX_REJECTIONS = 32
+
+MAGIC = b'TRIVIAQ1'
+# magic, generation, built at (unix time), number of questions, length of the json directory
+HEADER = struct.Struct('<8sQdQQ')
+NULL = -1
+
+
+def _padded(length):
+    return length + (-length % 8)
+
+
+class Snapshot:
+    """A mapped snapshot file. Every question is a position in the id ordered arrays.
+
+    Orders are arrays of positions sorted by (category, id), (category, difficulty, id)
+    and (difficulty, id); the directory maps each category, (category, difficulty) and
+    difficulty to its [start, end) range in the matching order."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, self.built_at, self.size, directory_length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a question snapshot')
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+        directory = json.loads(bytes(view[offset:offset + directory_length]))
+        offset += _padded(directory_length)
+
+        def section(type_code, length):
+            nonlocal offset
+            end = offset + length * struct.calcsize(type_code)
+            part = view[offset:end].cast(type_code)
+            offset = end
+            return part
+
+        size = self.size
+        self.ids = section('q', size)
+        self.question_starts = section('q', size + 1)
+        self.answer_starts = section('q', size)
+        self.categories = section('i', size)
+        self.difficulties_of = section('i', size)
+        self.by_category = section('i', size)
+        self.by_category_difficulty = section('i', size)
+        self.by_difficulty = section('i', size)
+        self.text = view[offset:]
+
+        self._ranges = {}
+        for category, bounds in directory['categories'].items():
+            self._ranges[int(category)] = (self.by_category, *bounds)
+        for key, bounds in directory['category_difficulties'].items():
+            category, difficulty = key.split(':')
+            self._ranges[(int(category), int(difficulty))] = (self.by_category_difficulty, *bounds)
+        for difficulty, bounds in directory['difficulties'].items():
+            self._ranges[(None, int(difficulty))] = (self.by_difficulty, *bounds)
+
+    def item(self, position):
+        question_start, answer_start = self.question_starts[position], self.answer_starts[position]
+        category, difficulty = self.categories[position], self.difficulties_of[position]
+        return QuestionItem(
+            self.ids[position],
+            str(self.text[question_start:answer_start], 'utf-8'),
+            str(self.text[answer_start:self.question_starts[position + 1]], 'utf-8'),
+            None if category == NULL else category,
+            None if difficulty == NULL else difficulty,
+        )
+
+    def _order(self, category=None, difficulty=None):
+        """Return (order, start, end): the positions of the bucket are order[start:end], or
+        range(start, end) when order is None. Empty buckets are (None, 0, 0)"""
+        if category is None and difficulty is None:
+            return None, 0, self.size
+        key = int(category) if difficulty is None else (None if category is None else int(category), int(difficulty))
+        return self._ranges.get(key, (None, 0, 0))
+
+    def count(self, category=None):
+        _, start, end = self._order(category)
+        return end - start
+
+    def get(self, question_id):
+        """Return the QuestionItem of question_id, or None if it is not in the snapshot"""
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[middle] < question_id:
+                low = middle + 1
+            else:
+                high = middle
+        return self.item(low) if low < self.size and self.ids[low] == question_id else None
+
+    def ids_of(self, category=None):
+        """Return the ids of a category (None for all categories) as a tuple"""
+        order, start, end = self._order(category)
+        if order is None:
+            return tuple(self.ids[start:end])
+        return tuple(self.ids[position] for position in order[start:end])
+
+    def paginate(self, request, category=None):
+        """Return (questions, next_cursor) for one page of a category (None for all categories),
+        with the page and cursor request args of pagination.paginate"""
+        order, start, end = self._order(category)
+        position_at = (lambda index: index) if order is None else order.__getitem__
+        cursor = request.args.get('cursor', None)
+        if cursor:
+            last_id = decode_cursor(cursor)
+            low, high = start, end
+            while low < high:
+                middle = (low + high) // 2
+                if self.ids[position_at(middle)] <= last_id:
+                    low = middle + 1
+                else:
+                    high = middle
+            first = low
+        else:
+            page = max(request.args.get('page', 1, int), 1)
+            first = start + (page - 1) * QUESTIONS_PER_PAGE
+        last = min(first + QUESTIONS_PER_PAGE, end)
+        questions = [self.item(position_at(index)) for index in range(first, last)]
+        next_cursor = encode_cursor(questions[-1].id) if questions and last < end else None
+        return questions, next_cursor
+
+    def difficulties(self, category=None):
+        """Return the sorted difficulties that have questions in category (None for all categories)"""
+        category_key = None if category is None else int(category)
+        return sorted(key[1] for key in self._ranges if isinstance(key, tuple) and key[0] == category_key)
+
+    def sample(self, category, difficulty, exclude, count, rng=random):
+        """Return up to count random QuestionItems of a bucket whose ids are not in exclude,
+        adding their ids to exclude. Same rejection sampling as sampling.IdBucket.choice"""
+        order, start, end = self._order(category, difficulty)
+        position_at = (lambda index: index) if order is None else order.__getitem__
+        questions = []
+        remaining = None
+        while len(questions) < count and start < end:
+            for _ in range(MAX_REJECTIONS):
+                position = position_at(rng.randrange(start, end))
+                if self.ids[position] not in exclude:
+                    break
+            else:
+                if remaining is None:
+                    remaining = [position_at(index) for index in range(start, end)]
+                remaining = [position for position in remaining if self.ids[position] not in exclude]
+                if not remaining:
+                    break
+                position = rng.choice(remaining)
+            exclude.add(self.ids[position])
+            questions.append(self.item(position))
+        return questions
+
+
+def write_snapshot(path, rows, generation):
+    """Write (id, question, answer, category, difficulty) rows, in id order, as a snapshot file at path"""
+    ids, categories, difficulties = array('q'), array('i'), array('i')
+    question_starts, answer_starts = array('q'), array('q')
+    with tempfile.TemporaryFile(dir=os.path.dirname(path)) as text:
+        offset = 0
+        for question_id, question, answer, category, difficulty in rows:
+            question, answer = (question or '').encode(), (answer or '').encode()
+            ids.append(question_id)
+            categories.append(NULL if category is None else category)
+            difficulties.append(NULL if difficulty is None else difficulty)
+            question_starts.append(offset)
+            answer_starts.append(offset + len(question))
+            text.write(question)
+            text.write(answer)
+            offset += len(question) + len(answer)
+        question_starts.append(offset)
+
+        positions = range(len(ids))
+        # sorted() is stable and positions are in id order, so ties stay in id order
+        by_category = array('i', sorted(positions, key=categories.__getitem__))
+        by_category_difficulty = array(
+            'i', sorted(positions, key=lambda position: (categories[position], difficulties[position])))
+        by_difficulty = array('i', sorted(positions, key=difficulties.__getitem__))
+        directory = {
+            'categories': _ranges(by_category, lambda position: categories[position]),
+            'category_difficulties': _ranges(
+                by_category_difficulty, lambda position: (categories[position], difficulties[position])),
+            'difficulties': _ranges(by_difficulty, lambda position: difficulties[position]),
+        }
+        directory_json = json.dumps(directory).encode()
+
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(MAGIC, generation, time.time(), len(ids), len(directory_json)))
+            snapshot_file.write(directory_json.ljust(_padded(len(directory_json)), b' '))
+            for part in (ids, question_starts, answer_starts, categories, difficulties,
+                         by_category, by_category_difficulty, by_difficulty):
+                part.tofile(snapshot_file)
+            text.seek(0)
+            shutil.copyfileobj(text, snapshot_file)
+
+
+def _ranges(order, key_of):
+    """Return {key: [start, end]} of the runs of equal keys in order, keys with a NULL part left out"""
+    ranges = {}
+    start = 0
+    for index in range(1, len(order) + 1):
+        if index < len(order) and key_of(order[index]) == key_of(order[start]):
+            continue
+        key = key_of(order[start])
+        parts = key if isinstance(key, tuple) else (key,)
+        if NULL not in parts:
+            ranges[':'.join(map(str, parts))] = [start, index]
+        start = index
+    return ranges
+
+
+class QuestionSnapshots:
+    """Flask extension serving the current snapshot of the host, see the module docstring"""
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.max_age = QUESTION_SNAPSHOT_MAX_AGE
+        self._app = None
+        self._lock = threading.Lock()
+        self._pointer_key = None
+        self._snapshot = None
+        self._building = False
+
+    def init_app(self, app):
+        self.enabled = app.config.setdefault('QUESTION_SNAPSHOT', QUESTION_SNAPSHOT)
+        self.max_age = app.config.setdefault('QUESTION_SNAPSHOT_MAX_AGE', QUESTION_SNAPSHOT_MAX_AGE)
+        directory = app.config.setdefault('QUESTION_SNAPSHOT_DIR', QUESTION_SNAPSHOT_DIR)
+        if directory is None:
+            # One directory per database, so apps on different databases never share a snapshot
+            digest = hashlib.sha1(app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:12]
+            directory = os.path.join(tempfile.gettempdir(), f'trivia-snapshot-{digest}')
+        self.directory = directory
+        self._app = app
+        with self._lock:
+            self._pointer_key = None
+            self._snapshot = None
+        signals.connect(self)
+
+        @app.cli.command('build-question-snapshot')
+        def build_command():
+            """Export the questions table to a new snapshot and make it current"""
+            self.bump()
+            generation = self.build()
+            click.echo(f'Built question snapshot generation {generation}.')
+
+    @property
+    def _pointer_path(self):
+        return os.path.join(self.directory, 'CURRENT')
+
+    @contextmanager
+    def _locked(self, name='pointer.lock', blocking=True):
+        """Hold an exclusive lock shared with the other processes of the host. Yield whether it was acquired"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_pointer(self):
+        try:
+            with open(self._pointer_path) as pointer_file:
+                return json.load(pointer_file)
+        except (FileNotFoundError, ValueError):
+            return {'generation': 0, 'file': None}
+
+    def _write_pointer(self, pointer):
+        temporary = f'{self._pointer_path}.{os.getpid()}.{threading.get_ident()}'
+        with open(temporary, 'w') as pointer_file:
+            json.dump(pointer, pointer_file)
+        os.replace(temporary, self._pointer_path)
+
+    def current(self):
+        """Return the current Snapshot, or None when snapshots are off or the current one is not built yet.
+        Costs one stat() of CURRENT while the snapshot does not change"""
+        if not self.enabled:
+            return None
+        try:
+            stat = os.stat(self._pointer_path)
+            pointer_key = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pointer_key = None
+        with self._lock:
+            if pointer_key is None or pointer_key != self._pointer_key:
+                self._pointer_key = pointer_key
+                self._snapshot = None
+                pointer = self._read_pointer() if pointer_key is not None else {'file': None}
+                if pointer['file'] is not None:
+                    try:
+                        self._snapshot = Snapshot(os.path.join(self.directory, pointer['file']))
+                    except (OSError, ValueError):
+                        self._snapshot = None
+            snapshot = self._snapshot
+        if snapshot is not None and self.max_age and time.time() - snapshot.built_at > self.max_age:
+            self.bump()
+            snapshot = None
+        if snapshot is None:
+            self._build_in_background()
+        return snapshot
+
+    def bump(self):
+        """Start a new generation: no process reads the current snapshot anymore"""
+        with self._locked():
+            self._write_pointer({'generation': self._read_pointer()['generation'] + 1, 'file': None})
+        with self._lock:
+            self._pointer_key = None
+            self._snapshot = None
+
+    def add(self, row):
+        """Rows are not replayed, the generation is bumped once per commit by committed()"""
+
+    discard = add
+
+    def committed(self):
+        if self.enabled:
+            self.bump()
+
+    def invalidate(self):
+        if self.enabled:
+            self.bump()
+
+    def build(self):
+        """Export the questions table as the snapshot of the current generation and swap it in
+        unless a write started a newer generation meanwhile. Return the built generation"""
+        with self._locked('build.lock'):
+            return self._build()
+
+    def _build(self):
+        generation = self._read_pointer()['generation']
+        path = os.path.join(self.directory, f'questions-{generation}.snapshot')
+        temporary = f'{path}.{os.getpid()}.tmp'
+        rows = db.session.query(*QUESTION_COLUMNS).order_by(Question.id).yield_per(SNAPSHOT_BUILD_BATCH_SIZE)
+        try:
+            write_snapshot(temporary, rows, generation)
+        finally:
+            db.session.rollback()
+        with self._locked():
+            if self._read_pointer()['generation'] != generation:
+                os.unlink(temporary)
+                return generation
+            os.replace(temporary, path)
+            self._write_pointer({'generation': generation, 'file': os.path.basename(path)})
+        # Processes still mapping older snapshots keep them readable until they swap
+        for name in os.listdir(self.directory):
+            if name.startswith('questions-') and name.endswith('.snapshot') and name != os.path.basename(path):
+                os.unlink(os.path.join(self.directory, name))
+        return generation
+
+    def _build_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._build_worker, name='question-snapshot', daemon=True).start()
+
+    def _build_worker(self):
+        try:
+            with self._app.app_context():
+                # A process already building for the host holds build.lock, this one has nothing to do
+                with self._locked('build.lock', blocking=False) as acquired:
+                    if acquired and self._read_pointer()['file'] is None:
+                        self._build()
+                db.session.remove()
+        finally:
+            with self._lock:
+                self._building = False
+
+
+question_snapshots = QuestionSnapshots()
@@ -0,0 +1,109 @@
+"""Per category question counts kept in the category_stats table.
+
+category_stats holds one row per (category, difficulty) with its number of
+questions. It is updated in the same transaction as the questions it counts:
+ORM inserts, updates and deletes of Question adjust it from mapper events, bulk
+imports add the counts of each batch, and Query.delete()/update() on Question
+recount it. Questions without a category or difficulty are not counted.
+
+If the counts ever drift, e.g. after writes made outside the app, recount them:
+    flask rebuild-category-stats
+"""
+from collections import Counter
+
+import click
+from sqlalchemy import event, func, or_, text
+from sqlalchemy.orm import Session, attributes
+
+from models import db, CategoryStats, Question
+
+UPSERT = text(
+    'INSERT INTO category_stats (category, difficulty, questions) VALUES (:category, :difficulty, :delta) '
+    'ON CONFLICT (category, difficulty) DO UPDATE SET questions = category_stats.questions + excluded.questions'
+)
+
+
+def apply(connection, deltas):
+    """Add deltas, a mapping of (category, difficulty) to a question count change, in the transaction of connection"""
+    parameters = [
+        {'category': category, 'difficulty': difficulty, 'delta': delta}
+        for (category, difficulty), delta in deltas.items()
+        if delta and category is not None and difficulty is not None
+    ]
+    if parameters:
+        connection.execute(UPSERT, parameters)
+
+
+def rebuild(connection):
+    """Recount category_stats from the questions table in the transaction of connection"""
+    table = CategoryStats.__table__
+    counts = db.select([Question.category, Question.difficulty, func.count(Question.id)]) \
+        .where(Question.category.isnot(None)) \
+        .where(Question.difficulty.isnot(None)) \
+        .group_by(Question.category, Question.difficulty)
+    connection.execute(table.delete())
+    connection.execute(table.insert().from_select(['category', 'difficulty', 'questions'], counts))
+
+
+def get():
+    """Return {category_id: {difficulty: questions}} for every category that has questions"""
+    stats = {}
+    rows = db.session.query(CategoryStats.category, CategoryStats.difficulty, CategoryStats.questions) \
+        .filter(CategoryStats.questions > 0) \
+        .order_by(CategoryStats.category, CategoryStats.difficulty)
+    for category, difficulty, questions in rows:
+        stats.setdefault(category, {})[difficulty] = questions
+    return stats
+
+
+def total(category_id=None):
+    """Return the number of questions of a category, or of every question with None, read from
+    category_stats. The questions it does not count, without a category or difficulty, are
+    counted in the questions table through its category and difficulty indexes"""
+    counted = db.session.query(func.coalesce(func.sum(CategoryStats.questions), 0))
+    uncounted = db.session.query(func.count(Question.id))
+    if category_id is None:
+        uncounted = uncounted.filter(or_(Question.category.is_(None), Question.difficulty.is_(None)))
+    else:
+        counted = counted.filter(CategoryStats.category == category_id)
+        uncounted = uncounted.filter(Question.category == category_id, Question.difficulty.is_(None))
+    return counted.scalar() + uncounted.scalar()
+
+
+@event.listens_for(Question, 'after_insert')
+def _after_insert(mapper, connection, target):
+    apply(connection, {(target.category, target.difficulty): 1})
+
+
+@event.listens_for(Question, 'after_update')
+def _after_update(mapper, connection, target):
+    category = attributes.get_history(target, 'category')
+    difficulty = attributes.get_history(target, 'difficulty')
+    if not category.has_changes() and not difficulty.has_changes():
+        return
+    old_key = (category.deleted[0] if category.deleted else target.category,
+               difficulty.deleted[0] if difficulty.deleted else target.difficulty)
+    deltas = Counter({old_key: -1})
+    deltas[(target.category, target.difficulty)] += 1
+    apply(connection, deltas)
+
+
+@event.listens_for(Question, 'after_delete')
+def _after_delete(mapper, connection, target):
+    apply(connection, {(target.category, target.difficulty): -1})
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+@event.listens_for(Session, 'after_bulk_update')
+def _after_bulk_change(context):
+    if context.mapper.class_ is Question:
+        rebuild(context.session.connection())
+
+
+def init_app(app):
+    @app.cli.command('rebuild-category-stats')
+    def rebuild_command():
+        """Recount the questions of every category and difficulty"""
+        with db.engine.begin() as connection:
+            rebuild(connection)
+        click.echo('Rebuilt category statistics.')
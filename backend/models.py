@@ -1,27 +1,41 @@
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String
+from datetime import datetime
 
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String
 
-db = SQLAlchemy()
+import database
+
+
+db = database.RoutingSQLAlchemy()
 
 
 def setup_db(app, db_url):
-    """Bind Flask App and SQLAlchemy ORM"""
+    """Bind Flask App and SQLAlchemy ORM.
+    Missing tables are created unless DB_CREATE_SCHEMA is off, see database.py"""
     app.config["SQLALCHEMY_DATABASE_URI"] = db_url
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    database.configure(app, db_url)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if app.config.setdefault("DB_CREATE_SCHEMA", database.DB_CREATE_SCHEMA):
+        db.create_all()
 
 
 class Question(db.Model):
     __tablename__ = "questions"
+    __table_args__ = (
+        Index("ix_questions_category", "category", "id"),
+        Index("ix_questions_difficulty", "difficulty"),
+        Index("ux_questions_content_hash", "content_hash", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey("categories.id"))
     difficulty = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # SHA-1 of the normalized question text, set by flaskr.dedup
+    content_hash = Column(String(40))
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -32,16 +46,17 @@ class Question(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        return self
 
     def update(self):
-        db.session.commit(self)
+        db.session.commit()
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
 
     def rollback(self):
-        db.session.rollback(self)
+        db.session.rollback()
 
     def format(self):
         return {
@@ -65,6 +80,7 @@ class Category(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        return self
 
     def update(self):
         db.session.commit()
@@ -75,3 +91,12 @@ class Category(db.Model):
 
     def format(self):
         return {"id": self.id, "type": self.type}
+
+
+class CategoryStats(db.Model):
+    """Number of questions per category and difficulty, kept up to date by flaskr.stats"""
+    __tablename__ = "category_stats"
+
+    category = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), primary_key=True)
+    difficulty = Column(Integer, primary_key=True)
+    questions = Column(Integer, nullable=False, default=0)
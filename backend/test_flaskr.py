@@ -1,76 +1,181 @@
+import asyncio
+import gzip
+import importlib.util
 import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+from concurrent.futures import ThreadPoolExecutor
 
-from flask_sqlalchemy import SQLAlchemy
+from flask import _app_ctx_stack
+from sqlalchemy import create_engine, event, inspect, orm, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool
 
-from flaskr import create_app
-from models import Category, Question, setup_db
+import benchmark
+import database
+from flaskr import create_app, dedup, migrations, serialization, signals, stats
+from flaskr.cache import MemoryBackend, SharedCounters, response_cache
+from flaskr.catalogue import category_catalogue
+from flaskr.projection import QuestionItem
+from flaskr.sampling import IdBucket, sampler
+from flaskr.search import search_index
+from flaskr.snapshot import question_snapshots
+from models import Category, Question, db
+
+IN_MEMORY_URIS = ("sqlite://", "sqlite:///:memory:")
+
+
+def worker_database_uri(uri, worker=None):
+    """Return the database of this pytest-xdist worker: uri with the worker id, e.g. gw0,
+    appended to the database name. Outside xdist, and in memory, uri itself"""
+    worker = worker or os.getenv("PYTEST_XDIST_WORKER")
+    if not worker or not uri or uri in IN_MEMORY_URIS:
+        return uri
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite":
+        root, extension = os.path.splitext(url.database)
+        url.database = f"{root}_{worker}{extension}"
+    else:
+        url.database = f"{url.database}_{worker}"
+    return str(url)
+
+
+def create_database(uri):
+    """Create the PostgreSQL database of uri unless it exists"""
+    url = make_url(uri)
+    if url.get_backend_name() != "postgresql":
+        return
+    name, url.database = url.database, "postgres"
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    with engine.connect() as connection:
+        if not connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), name=name).scalar():
+            connection.execute(f'CREATE DATABASE "{name}"')
+    engine.dispose()
+
+
+TEST_DB_URI = worker_database_uri(os.getenv("TEST_DB_URI"))
+if TEST_DB_URI:
+    os.environ["TEST_DB_URI"] = TEST_DB_URI
+IN_MEMORY = TEST_DB_URI in IN_MEMORY_URIS
+# Config of the apps under test. A background thread would not see the rows of the per test
+# transactions, so the near duplicate index is loaded on the request instead
+APP_CONFIG = {"DB_CREATE_SCHEMA": False, "DEDUP_NEAR_BACKGROUND_LOAD": False}
+_engine = None
+
+
+def shared_engine():
+    """Return the engine of the per test transactions, creating the schema once per process"""
+    global _engine
+    if _engine is None:
+        if not TEST_DB_URI:
+            raise RuntimeError("Set TEST_DB_URI to the test database, e.g. TEST_DB_URI=sqlite:// for an in-memory one")
+        create_database(TEST_DB_URI)
+        if IN_MEMORY:
+            # One connection for the whole process, an in-memory database lives as long as its connection
+            engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        else:
+            engine = create_engine(TEST_DB_URI)
+        if engine.dialect.name == "sqlite":
+            # pysqlite begins transactions on its own and breaks SAVEPOINT, let SQLAlchemy emit BEGIN instead
+            event.listen(engine, "connect", lambda dbapi_connection, record: setattr(
+                dbapi_connection, "isolation_level", None))
+            event.listen(engine, "begin", lambda connection: connection.execute("BEGIN"))
+        db.Model.metadata.create_all(engine)
+        _engine = engine
+    return _engine
+
+
+def transactional_session(connection):
+    """Return a scoped session whose sessions all run in SAVEPOINTs of the transaction of connection.
+    Their commits release the savepoint, their rollbacks roll back to it, and a new one begins"""
+    factory = db.create_session({"bind": connection, "binds": {}})
+
+    @event.listens_for(factory, "after_transaction_end")
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
+
+    def create_session():
+        session = factory()
+        session.begin_nested()
+        return session
+
+    return orm.scoped_session(create_session, scopefunc=_app_ctx_stack.__ident_func__)
+
+
+def commits(test):
+    """Mark a test whose writes must really be committed, e.g. to be read by other connections,
+    threads or processes. It runs outside the per test transaction, and not on the in-memory database"""
+    test = unittest.skipIf(IN_MEMORY, "needs a database shared between connections")(test)
+    test.commits = True
+    return test
 
 
 class TriviaTestCase(unittest.TestCase):
-    """This class represents the trivia test case"""
+    """This class represents the trivia test case.
 
-    def create_data_in_database(self):
-        """Create 4 test categories"""
-        category_art = Category(type="Art").insert()
-        category_tech = Category(type="Technology").insert()
-        category_science = Category(type="Science").insert()
-        self.category_science = Category(type="Science").insert()
+    Every test runs in a transaction rolled back when it ends, so its writes never need
+    deleting. The schema is created once per process, by shared_engine()."""
+
+    def create_data_in_database(self, suffix=""):
+        """Create 4 test categories, and 5 test questions ending with suffix, in one commit"""
+        categories = [Category(type=type_) for type_ in ("Art", "Technology", "Science", "Science")]
+        db.session.add_all(categories)
+        db.session.flush()
+        category_art, category_tech, category_science, self.category_science = (category.id for category in categories)
 
         # Create 5 test questions
-        Question(
-            question="test question 1",
-            answer="test answer 1",
-            category=category_art,
-            difficulty=3,
-        ).insert()
-        Question(
-            question="test question 2",
-            answer="test answer 2",
-            category=category_science,
-            difficulty=2,
-        ).insert()
-        Question(
-            question="test question 3",
-            answer="test answer 3",
-            category=category_tech,
-            difficulty=3,
-        ).insert()
-        Question(
-            question="test question 4",
-            answer="test answer 4",
-            category=category_tech,
-            difficulty=2,
-        ).insert()
-        Question(
-            question="test question 5",
-            answer="test answer 5",
-            category=category_art,
-            difficulty=3,
-        ).insert()
+        db.session.add_all(
+            Question(question=f"test question {number}{suffix}", answer=f"test answer {number}",
+                     category=category, difficulty=difficulty)
+            for number, category, difficulty in (
+                (1, category_art, 3),
+                (2, category_science, 2),
+                (3, category_tech, 3),
+                (4, category_tech, 2),
+                (5, category_art, 3),
+            )
+        )
+        db.session.commit()
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app(test_config=True)
+        engine = shared_engine()
+        self.committing = getattr(getattr(self, self._testMethodName), "commits", False)
+        if not self.committing:
+            self.connection = engine.connect()
+            self.transaction = self.connection.begin()
+            self.session = db.session
+            db.session = transactional_session(self.connection)
+        self.app = create_app(test_config=APP_CONFIG)
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        setup_db(self.app, os.getenv("TEST_DB_URI"))
 
         # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-
-            # create all tables
-            self.db.create_all()
             self.create_data_in_database()
 
     def tearDown(self):
         """Executed after reach test"""
-        # Delete all rows in both tables.
-        Category.query.delete()
-        Question.query.delete()
+        if self.committing:
+            # Delete all rows in both tables.
+            with self.app.app_context():
+                db.session.rollback()
+                Question.query.delete()
+                Category.query.delete()
+                db.session.commit()
+            return
+        db.session.remove()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+        # The in-process indexes and caches were told about commits that are now rolled back
+        signals.invalidate()
+        category_catalogue.invalidate()
 
     # GET /categories
     def test_200_list_of_all_categories(self):
@@ -83,6 +188,21 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue("Technology" in resp.json["categories"].values())
         self.assertTrue("Science" in resp.json["categories"].values())
 
+    def test_categories_added_by_other_processes_are_accepted_and_listed(self):
+        self.assertEqual(len(self.client().get("/categories").json["categories"]), 4)
+        # Added by another worker: no commit of this process invalidates the catalogue
+        with self.app.app_context():
+            db.session.execute(Category.__table__.insert(), {"type": "History"})
+            db.session.commit()
+            category_id = db.session.query(Category.id).filter(Category.type == "History").scalar()
+        resp = self.client().post("/questions", json={
+            "question": "Who came first?", "answer": "Nobody", "category": category_id, "difficulty": 1})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.client().post("/questions", json={
+            "question": "Where?", "answer": "Here", "category": category_id + 1, "difficulty": 1}).status_code, 400)
+        with unittest.mock.patch.object(category_catalogue, "ttl", 0):
+            self.assertEqual(len(self.client().get("/categories").json["categories"]), 5)
+
     # GET /categories if db returns no category
     def test_400_list_of_all_categories(self):
         Category.query.delete()
@@ -95,8 +215,23 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue("Technology" not in resp.json["categories"].values())
         self.assertTrue("Science" not in resp.json["categories"].values())
 
+    def test_304_list_of_all_categories_with_matching_etag(self):
+        resp = self.client().get("/categories")
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag)
+
+        resp = self.client().get("/categories", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers["ETag"], etag)
+
+        Category(type="History").insert()
+        resp = self.client().get("/categories", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertTrue("History" in resp.json["categories"].values())
+
     def test_200_get_paginated_questions_list(self, page=1):
-        self.create_data_in_database()
+        self.create_data_in_database(" again")
         resp = self.client().get("/questions?page=1")
         self.assertEqual(resp.json["status"], "success")
         self.assertTrue(len(resp.json["categories"]))
@@ -105,6 +240,127 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(resp.json["status"], "success")
         self.assertEqual(resp.status_code, 200)
 
+    def test_200_walk_questions_list_with_next_cursor(self):
+        for round_number in range(3):
+            self.create_data_in_database(f" round {round_number}")
+        resp = self.client().get("/questions")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["total_questions"], 20)
+        seen = [question["id"] for question in resp.json["questions"]]
+        cursor = resp.json["next_cursor"]
+        while cursor:
+            resp = self.client().get(f"/questions?cursor={cursor}")
+            self.assertEqual(resp.status_code, 200)
+            seen += [question["id"] for question in resp.json["questions"]]
+            cursor = resp.json["next_cursor"]
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(set(seen)), 20)
+
+        page_2 = self.client().get("/questions?page=2")
+        self.assertEqual([q["id"] for q in page_2.json["questions"]], seen[10:20])
+        self.assertIsNone(page_2.json["next_cursor"])
+
+    def test_404_get_questions_list_with_invalid_cursor(self):
+        resp = self.client().get("/questions?cursor=not-a-cursor")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json["status"], "fail")
+
+    def test_200_questions_list_is_cached_until_a_question_write(self):
+        first = self.client().get("/questions")
+        self.assertEqual(first.json["total_questions"], 5)
+
+        # A raw SQL write does not bump any generation, so the cached page is served
+        with self.app.app_context():
+            db.session.execute("DELETE FROM questions")
+            db.session.execute("DELETE FROM category_stats")
+            db.session.commit()
+        self.assertEqual(self.client().get("/questions").json, first.json)
+
+        resp = self.client().post(
+            "/questions",
+            json={
+                "question": "Cached?",
+                "answer": "No",
+                "category": self.category_science,
+                "difficulty": 1,
+            },
+        )
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.client().get("/questions").json["total_questions"], 1)
+
+    def test_writes_bump_each_cached_scope_once_for_every_worker_of_the_host(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "generations")
+            worker, other_worker = (MemoryBackend(shared=SharedCounters(path)) for _ in range(2))
+            worker.incr("questions")
+            self.assertEqual(other_worker.counters(["questions", "epoch"]), [1, 0])
+
+        operations = [{"op": "create", "question": f"Scoped {number}", "answer": "a",
+                       "category": self.category_science, "difficulty": 1} for number in range(3)]
+        with unittest.mock.patch.object(response_cache.backend, "incr") as incr:
+            self.assertEqual(self.client().post("/questions/batch", json={"operations": operations}).status_code, 200)
+        self.assertEqual(sorted(call.args[0] for call in incr.call_args_list),
+                         [f"category:{self.category_science}", "questions"])
+
+    @commits
+    def test_concurrent_identical_reads_share_one_computation(self):
+        app = create_app(test_config=dict(APP_CONFIG, RESPONSE_CACHE=None))
+        computations = []
+        started = threading.Event()
+
+        def compute():
+            computations.append(1)
+            started.set()
+            time.sleep(0.2)
+            return {"status": "success"}, 200
+
+        def read(path):
+            with app.test_request_context(path):
+                return response_cache.memoize(["questions"], compute)
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            leader = executor.submit(read, "/questions?page=2")
+            started.wait()
+            followers = [executor.submit(read, "/questions?page=2") for _ in range(4)]
+            other = executor.submit(read, "/questions?page=3")
+            results = [future.result() for future in [leader, *followers]]
+            other.result()
+        self.assertEqual(len(computations), 2)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(response_cache.flights.shared, 4)
+
+    def test_200_questions_list_with_selected_fields_and_cached_categories(self):
+        resp = self.client().get("/questions?fields=id,category")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual({tuple(question) for question in resp.json["questions"]}, {("id", "category")})
+        self.assertIn("categories", resp.json)
+
+        etag = self.client().get("/categories").headers["ETag"]
+        resp = self.client().get(f"/questions?categories_etag={etag}")
+        self.assertNotIn("categories", resp.json)
+        self.assertIn("categories", self.client().get("/questions?categories_etag=stale").json)
+
+        search = self.client().post(f"/questions?fields=question&categories_etag={etag}",
+                                    json={"searchTerm": "test question"})
+        self.assertEqual(search.json["questions"][0], {"question": "test question 1"})
+        self.assertNotIn("categories", search.json)
+        category_page = self.client().get(f"/categories/{self.category_science}/questions?fields=bogus")
+        self.assertEqual(category_page.status_code, 400)
+
+    def test_large_responses_are_compressed_for_clients_accepting_gzip(self):
+        app = create_app(test_config=dict(APP_CONFIG, RESPONSE_COMPRESSION_MIN_SIZE=200))
+        client = app.test_client()
+        plain = client.get("/questions")
+        resp = client.get("/questions", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+        self.assertNotIn("Content-Encoding", plain.headers)
+
+        etag = client.get("/categories").headers["ETag"]
+        small = client.get(f"/questions?fields=id&categories_etag={etag}", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", small.headers)
+
     def test_400_get_paginated_questions_list_with_no_questions_in_db(self, page=1):
         Question.query.delete()
         resp = self.client().get("/questions")
@@ -144,7 +400,7 @@ class TriviaTestCase(unittest.TestCase):
         new_question = {
             "question": "Capital of CA?",
             "answer": "Sacramento",
-            "category": "2",
+            "category": str(self.category_science),
             "difficulty": 3,
         }
         resp = self.client().post(
@@ -159,16 +415,33 @@ class TriviaTestCase(unittest.TestCase):
         ).one_or_none()
         self.assertIsNotNone(read_from_db)
         self.assertEqual(read_from_db.answer, "Sacramento")
-        self.assertEqual(read_from_db.category, "2")
+        self.assertEqual(read_from_db.category, self.category_science)
         self.assertEqual(read_from_db.difficulty, 3)
 
         # response json payload
         self.assertEqual(resp.get_json()["status"], "success")
         self.assertEqual(resp.get_json()["question"], "Capital of CA?")
         self.assertEqual(resp.get_json()["answer"], "Sacramento")
-        self.assertEqual(resp.get_json()["category"], "2")
+        self.assertEqual(resp.get_json()["category"], self.category_science)
         self.assertEqual(resp.get_json()["difficulty"], 3)
 
+    def test_400_add_new_question_with_a_difficulty_that_is_not_an_integer(self):
+        resp = self.client().post("/questions", json={
+            "question": "How hard?", "answer": "Very", "category": self.category_science, "difficulty": "hard"})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["message"], "difficulty must be an integer.")
+
+    def test_400_add_new_question_with_blank_text_a_bool_or_a_fraction(self):
+        question = {"question": "How hard?", "answer": "Very", "category": self.category_science, "difficulty": 2}
+        for change, message in [({"question": "   "}, "Missing required fields: question."),
+                                ({"difficulty": 2.9}, "difficulty must be an integer."),
+                                ({"difficulty": True}, "difficulty must be an integer."),
+                                ({"category": True}, "category must be an integer category id.")]:
+            resp = self.client().post("/questions", json=dict(question, **change))
+            self.assertEqual((resp.status_code, resp.json["message"]), (400, message))
+        resp = self.client().post("/questions", json=dict(question, difficulty=2.0))
+        self.assertEqual((resp.status_code, resp.json["difficulty"]), (201, 2))
+
     def test_400_add_new_question_no_json_in_request(self):
         headers = {"Content-Type": "application/json"}
         resp = self.client().post("/questions", headers=headers, data="DSFGHF")
@@ -190,6 +463,161 @@ class TriviaTestCase(unittest.TestCase):
         # response code
         self.assertEqual(resp.status_code, 400)
 
+    # Bulk import Tests:
+    def test_201_bulk_import_ndjson_in_batches(self):
+        lines = [
+            json.dumps({"question": f"bulk {n}", "answer": "a", "category": self.category_science, "difficulty": 2})
+            for n in range(5)
+        ]
+        lines.insert(2, json.dumps({"question": "no answer", "category": self.category_science, "difficulty": 2}))
+        lines.insert(4, "not json")
+        resp = self.client().post(
+            "/questions/bulk?batch_size=2",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["inserted"], 5)
+        self.assertEqual(resp.json["rejected"], 2)
+        self.assertEqual([error["line"] for error in resp.json["errors"]], [3, 5])
+        self.assertEqual(
+            Question.query.filter(Question.question.like("bulk %")).count(), 5
+        )
+
+    def test_201_bulk_import_csv(self):
+        body = (
+            "question,answer,category,difficulty\n"
+            f"CSV one,a,{self.category_science},1\n"
+            f"CSV two,b,{self.category_science},x\n"
+        )
+        resp = self.client().post(
+            "/questions/bulk", data=body, content_type="text/csv"
+        )
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["inserted"], 1)
+        self.assertEqual(resp.json["errors"][0]["line"], 3)
+
+    def test_bulk_import_reports_undecodable_lines_and_non_string_text(self):
+        row = {"answer": "a", "category": self.category_science, "difficulty": 2}
+        body = b"\n".join([
+            json.dumps(dict(row, question="Decoded")).encode(),
+            b"\xff\xfe",
+            json.dumps(dict(row, question=[1])).encode(),
+        ])
+        resp = self.client().post("/questions/bulk", data=body, content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["inserted"], 1)
+        self.assertEqual(
+            [(error["line"], error["message"]) for error in resp.json["errors"]],
+            [(2, "Invalid UTF-8 text."), (3, "question must be a string.")],
+        )
+
+        body = f"question,answer,category,difficulty\nCSV one,a,{self.category_science},1\n".encode() \
+            + b"\xff\xfe,a,1,1\n"
+        resp = self.client().post("/questions/bulk", data=body, content_type="text/csv")
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["errors"], [{"line": 3, "message": "Invalid UTF-8 text."}])
+
+    def test_400_bulk_import_without_valid_rows(self):
+        resp = self.client().post(
+            "/questions/bulk", data="{}", content_type="application/x-ndjson"
+        )
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["status"], "fail")
+
+    def test_import_questions_cli_command(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(
+            args=["import-questions", "--format", "csv", "--batch-size", "1", "-"],
+            input=(
+                "question,answer,category,difficulty\n"
+                f"CLI one,a,{self.category_science},1\n"
+                f"CLI two,b,{self.category_science},3\n"
+            ),
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Imported 2 questions", result.output)
+        with self.app.app_context():
+            self.assertEqual(
+                Question.query.filter(Question.question.like("CLI %")).count(), 2
+            )
+
+    # Batch write Tests:
+    def test_200_batch_applies_operations_in_one_transaction(self):
+        with self.app.app_context():
+            ids = {question.question: question.id for question in Question.query}
+        operations = [
+            {"op": "delete", "id": ids["test question 1"]},
+            {"op": "update", "id": ids["test question 2"], "answer": "new answer", "difficulty": 5},
+            {"op": "create", "question": "batch one", "answer": "a", "category": self.category_science,
+             "difficulty": 1},
+            {"op": "delete", "id": 999999},
+            {"op": "create", "question": "Test question 3!", "answer": "a", "category": self.category_science,
+             "difficulty": 1},
+            {"op": "delete", "id": ids["test question 1"]},
+            {"op": "rename"},
+        ]
+        with unittest.mock.patch.object(question_snapshots, "enabled", True), \
+                unittest.mock.patch.object(question_snapshots, "bump") as bump:
+            resp = self.client().post("/questions/batch", json={"operations": operations})
+        # The host snapshot is retired once per commit, not once per written row
+        bump.assert_called_once_with()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual((resp.json["applied"], resp.json["failed"]), (3, 4))
+        self.assertEqual([result["code"] for result in resp.json["results"]], [204, 200, 201, 404, 409, 400, 400])
+        self.assertEqual(resp.json["results"][4]["duplicate_of"], ids["test question 3"])
+
+        with self.app.app_context():
+            self.assertIsNone(Question.query.get(ids["test question 1"]))
+            updated = Question.query.get(ids["test question 2"])
+            self.assertEqual((updated.answer, updated.difficulty), ("new answer", 5))
+            created = Question.query.get(resp.json["results"][2]["id"])
+            self.assertEqual(created.content_hash, dedup.content_hash("batch one"))
+            self.assertEqual(stats.get()[self.category_science], {1: 1})
+            self.assertEqual(stats.get()[updated.category], {5: 1})
+        search = self.client().post("/questions", json={"searchTerm": "batch one"})
+        self.assertEqual(search.json["total_questions"], 1)
+
+    def test_400_batch_without_applicable_operations(self):
+        resp = self.client().post("/questions/batch", json={"operations": [{"op": "delete", "id": 999999}]})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["results"][0]["code"], 404)
+        self.assertEqual(self.client().post("/questions/batch", json={"operations": []}).status_code, 400)
+        resp = self.client().post("/questions/batch", json=[{"op": "delete", "id": 1}])
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["message"], "A non empty list of operations must be sent to server.")
+
+    # Bulk export Tests:
+    def test_200_export_questions_as_ndjson_filtered_by_difficulty(self):
+        resp = self.client().get("/questions/export?difficulty=3")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertIsNotNone(resp.last_modified)
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(row["difficulty"] == 3 for row in rows))
+        self.assertEqual([row["id"] for row in rows], sorted(row["id"] for row in rows))
+
+    def test_200_export_questions_as_csv(self):
+        resp = self.client().get("/questions/export?format=csv")
+        self.assertEqual(resp.status_code, 200)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], "id,question,answer,category,difficulty")
+        self.assertEqual(len(lines), 6)
+
+    def test_304_export_questions_not_modified_since(self):
+        resp = self.client().get(
+            "/questions/export",
+            headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"},
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client().get(
+            "/questions/export",
+            headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 5)
+
     # Search Tests:
     def test_200_search_questions_returns_5_results(self):
 
@@ -212,6 +640,44 @@ class TriviaTestCase(unittest.TestCase):
         self.assertFalse(resp.json["questions"])
         self.assertEquals(len(resp.json["questions"]), 0)
 
+    def test_400_search_with_a_search_term_that_is_not_a_string(self):
+        for search_term in (5, ["question"]):
+            resp = self.client().post("/questions", json={"searchTerm": search_term})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json["message"], "searchTerm must be a string.")
+
+    def test_200_search_without_searchable_words_finds_nothing(self):
+        for search_term in ("   ", "?!", "the"):
+            resp = self.client().post("/questions", json={"searchTerm": search_term})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"status": "success", "questions": [], "total_questions": 0,
+                                         "current_category": None, "categories": {}})
+        # Stop words are skipped like PostgreSQL's to_tsquery does
+        with_stop_word = self.client().post("/questions", json={"searchTerm": "the test ques"}).json
+        self.assertEqual(with_stop_word["total_questions"], 5)
+
+    def test_200_search_matches_answers_and_ranks_best_match_first(self):
+        Question(
+            question="Which planet is the red planet?",
+            answer="Mars",
+            category=self.category_science,
+            difficulty=1,
+        ).insert()
+        Question(
+            question="Name a planet",
+            answer="Earth",
+            category=self.category_science,
+            difficulty=1,
+        ).insert()
+        resp = self.client().post("/questions", json={"searchTerm": "plan"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["total_questions"], 2)
+        self.assertEqual(resp.json["questions"][0]["answer"], "Mars")
+
+        resp = self.client().post("/questions", json={"searchTerm": "earth"})
+        self.assertEqual(resp.json["total_questions"], 1)
+        self.assertEqual(resp.json["questions"][0]["question"], "Name a planet")
+
     # Playing Game e.g. Taking Quiz Test
     def test_200_get_questions_to_play_the_quiz(self):
         """  TEST: In the "Play" tab, after a user selects "All" or a category, one question
@@ -226,6 +692,500 @@ class TriviaTestCase(unittest.TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertTrue(resp.json["status"], "success")
 
+    def test_200_quiz_plays_every_question_once_then_force_ends(self):
+        request_body = {
+            "previous_questions": [],
+            "quiz_category": {"type": "click", "id": 0},
+        }
+        for _ in range(5):
+            resp = self.client().post("/quizzes", json=request_body)
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(resp.json["forceEnd"])
+            request_body["previous_questions"] = resp.json["previousQuestions"]
+        self.assertEqual(len(set(request_body["previous_questions"])), 5)
+
+        resp = self.client().post("/quizzes", json=request_body)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.json["forceEnd"])
+        self.assertIsNone(resp.json["question"])
+
+    def test_200_quiz_sampler_follows_inserts_and_deletes(self):
+        Question.query.delete()
+        self.client().post("/quizzes", json={"previous_questions": [], "quiz_category": {"id": 0}})
+        question = Question(
+            question="Only question", answer="Yes", category=self.category_science, difficulty=1
+        )
+        question.insert()
+        request_body = {"previous_questions": [], "quiz_category": {"id": self.category_science}}
+        resp = self.client().post("/quizzes", json=request_body)
+        self.assertEqual(resp.json["question"]["question"], "Only question")
+
+        question.delete()
+        resp = self.client().post("/quizzes", json=request_body)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.json["forceEnd"])
+
+    def test_quiz_and_search_indexes_reload_writes_of_other_processes(self):
+        body = {"previous_questions": [], "quiz_category": {"id": self.category_science}}
+        self.assertTrue(self.client().post("/quizzes", json=body).json["forceEnd"])
+        # Written by another worker: no signal reaches the indexes of this process
+        with self.app.app_context():
+            self.assertEqual(search_index.search("elsewhere"), [])
+            db.session.execute(Question.__table__.insert(), {
+                "question": "Written elsewhere", "answer": "Yes", "category": self.category_science,
+                "difficulty": 1, "content_hash": dedup.content_hash("Written elsewhere")})
+            db.session.commit()
+        with unittest.mock.patch.object(sampler, "ttl", 0), unittest.mock.patch.object(search_index, "ttl", 0):
+            resp = self.client().post("/quizzes", json=body)
+            self.assertEqual(resp.json["question"]["question"], "Written elsewhere")
+            with self.app.app_context():
+                self.assertEqual(len(search_index.search("elsewhere")), 1)
+
+    def test_200_adaptive_quiz_follows_answers_through_difficulties(self):
+        body = {"previous_questions": [], "quiz_category": {"id": 0}, "mode": "adaptive"}
+        resp = self.client().post("/quizzes", json=body)
+        self.assertEqual(resp.status_code, 200)
+        # Test questions have difficulties 2 and 3, the first round targets the median
+        self.assertEqual(resp.json["question"]["difficulty"], 3)
+
+        body.update(previous_questions=resp.json["previousQuestions"], difficulty=3, correct=False)
+        resp = self.client().post("/quizzes", json=body)
+        self.assertEqual(resp.json["question"]["difficulty"], 2)
+
+        body.update(previous_questions=resp.json["previousQuestions"], difficulty=2, correct=False)
+        resp = self.client().post("/quizzes", json=body)
+        self.assertEqual(resp.json["question"]["difficulty"], 2)
+
+        # Once difficulty 2 is played out the nearest difficulty is used
+        body.update(previous_questions=resp.json["previousQuestions"], difficulty=2, correct=False)
+        resp = self.client().post("/quizzes", json=body)
+        self.assertEqual(resp.json["question"]["difficulty"], 3)
+
+        uniform = self.client().post("/quizzes", json={"previous_questions": [], "quiz_category": {"id": 0}})
+        self.assertNotIn("difficulty", uniform.json["question"])
+        self.assertEqual(self.client().post("/quizzes", json=dict(body, mode="hardest")).status_code, 400)
+
+    def test_quiz_picks_do_not_walk_the_played_questions(self):
+        class Played(set):
+            def __iter__(self):
+                raise AssertionError("the played questions were listed")
+
+        bucket = IdBucket()
+        for question_id in range(1000):
+            bucket.add(question_id)
+        played = Played(range(0, 1000, 2))
+        self.assertEqual(bucket.choice(played) % 2, 1)
+        self.assertIsNone(IdBucket().choice(played))
+
+    def test_200_quiz_batch_returns_distinct_unplayed_questions(self):
+        body = {"previous_questions": [], "quiz_category": {"id": 0}, "count": 3}
+        resp = self.client().post("/quizzes", json=body)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json["questions"]), 3)
+        self.assertEqual(len(set(resp.json["previousQuestions"])), 3)
+        self.assertEqual(resp.json["question"], resp.json["questions"][0])
+
+        body.update(previous_questions=resp.json["previousQuestions"])
+        resp = self.client().post("/quizzes", json=body)
+        self.assertEqual(len(resp.json["questions"]), 2)
+        self.assertEqual(len(set(resp.json["previousQuestions"])), 5)
+        self.assertFalse(resp.json["forceEnd"])
+
+        body.update(previous_questions=resp.json["previousQuestions"])
+        resp = self.client().post("/quizzes", json=body)
+        self.assertEqual(resp.json["questions"], [])
+        self.assertTrue(resp.json["forceEnd"])
+
+        for count in (0, -1, 2.5, "3", True, 10 ** 6):
+            resp = self.client().post("/quizzes", json=dict(body, count=count))
+            self.assertEqual(resp.status_code, 400)
+            self.assertTrue(resp.json["message"].startswith("count must be an integer between 1 and"))
+
+    def test_quiz_session_pops_every_question_of_category_once(self):
+        resp = self.client().post(
+            "/quizzes/sessions", json={"quiz_category": {"id": self.category_science}}
+        )
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["total_questions"], 0)
+
+        resp = self.client().post("/quizzes/sessions", json={"quiz_category": {"id": 0}})
+        self.assertEqual(resp.json["total_questions"], 5)
+        session_id = resp.json["session_id"]
+
+        played = []
+        for remaining in range(4, -1, -1):
+            resp = self.client().post(f"/quizzes/sessions/{session_id}/next")
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(resp.json["forceEnd"])
+            self.assertEqual(resp.json["remaining"], remaining)
+            played.append(resp.json["question"]["id"])
+        self.assertEqual(len(set(played)), 5)
+
+        resp = self.client().post(f"/quizzes/sessions/{session_id}/next")
+        self.assertTrue(resp.json["forceEnd"])
+        self.assertIsNone(resp.json["question"])
+
+    def test_404_next_question_of_unknown_quiz_session(self):
+        resp = self.client().post("/quizzes/sessions/does-not-exist/next")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json["status"], "fail")
+
+    # Database connections
+    def test_engine_options_read_pool_settings_from_environment(self):
+        environ = {"DB_POOL_SIZE": "7", "DB_MAX_OVERFLOW": "3", "DB_STATEMENT_TIMEOUT_MS": "2500"}
+        with unittest.mock.patch.dict(os.environ, environ):
+            options = database.engine_options("postgresql://localhost/trivia")
+            self.assertEqual(options["pool_size"], 7)
+            self.assertEqual(options["max_overflow"], 3)
+            self.assertIs(options["poolclass"], database.InstrumentedQueuePool)
+            self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=2500"})
+            with unittest.mock.patch.dict(os.environ, {"DB_PGBOUNCER": "true"}):
+                self.assertNotIn("connect_args", database.engine_options("postgresql://localhost/trivia"))
+            self.assertEqual(database.engine_options("sqlite://"), {})
+
+    @commits
+    def test_get_requests_read_from_replica(self):
+        with unittest.mock.patch.dict(os.environ, {"REPLICA_DB_URI": "sqlite://"}):
+            app = create_app(test_config=True)
+        with app.test_request_context("/questions", method="GET"):
+            self.assertEqual(str(db.session.get_bind().url), "sqlite://")
+            db.session.remove()
+        with app.test_request_context("/questions", method="GET"), database.primary():
+            self.assertEqual(db.session.get_bind().url, db.get_engine(app).url)
+            db.session.remove()
+        with app.test_request_context("/questions", method="POST"):
+            self.assertEqual(db.session.get_bind().url, db.get_engine(app).url)
+            db.session.remove()
+
+    def test_instrumented_pool_reports_checkout_wait_and_saturation(self):
+        metrics = database.PoolMetrics()
+        engine = create_engine("sqlite://", poolclass=database.InstrumentedQueuePool, pool_size=2, max_overflow=0)
+        with unittest.mock.patch.object(database, "pool_metrics", metrics):
+            connection = engine.connect()
+            snapshot = metrics.snapshot({"primary": engine})
+            connection.close()
+        self.assertEqual(snapshot["checkouts"], 1)
+        self.assertEqual(snapshot["pools"]["primary"]["checked_out"], 1)
+        self.assertEqual(snapshot["pools"]["primary"]["saturation"], 0.5)
+
+        resp = self.client().get("/db/pool")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("primary", resp.json["database_pool"]["pools"])
+
+    # Question snapshot
+    def test_snapshot_serves_the_same_pages_and_quizzes_as_the_database(self):
+        pages = ["/questions?page=1", "/questions?page=2", f"/categories/{self.category_science}/questions"]
+        expected = {page: self.client().get(page).json for page in pages}
+        # enabled is restored on exit, so the writes of tearDown do not touch the snapshot directory anymore
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch.object(question_snapshots, "enabled", False), \
+                unittest.mock.patch.object(question_snapshots, "_build_in_background"):
+            app = create_app(test_config=dict(
+                APP_CONFIG, RESPONSE_CACHE=None, QUESTION_SNAPSHOT=True, QUESTION_SNAPSHOT_DIR=directory))
+            client = app.test_client()
+            with app.app_context():
+                self.assertIsNone(question_snapshots.current())
+                question_snapshots.build()
+                snapshot = question_snapshots.current()
+                self.assertEqual(snapshot.count(), 5)
+            with unittest.mock.patch("flaskr.resources.paginate", side_effect=AssertionError("database read")):
+                for page in pages:
+                    self.assertEqual(client.get(page).json, expected[page])
+                quiz = client.post("/quizzes", json={"previous_questions": [], "count": 5,
+                                                     "quiz_category": {"id": 0, "type": "click"}})
+                self.assertEqual(len({question["question"] for question in quiz.json["questions"]}), 5)
+
+            # A write retires the snapshot until the next build swaps a new one in
+            client.post("/questions", json={"question": "snapshot question", "answer": "a",
+                                            "category": str(self.category_science), "difficulty": 4})
+            with app.app_context():
+                self.assertIsNone(question_snapshots.current())
+                self.assertEqual(client.get("/questions?page=1").json["total_questions"], 6)
+                question_snapshots.build()
+                self.assertEqual(question_snapshots.current().count(self.category_science), 1)
+                self.assertEqual(question_snapshots.current().difficulties(self.category_science), [4])
+            self.assertEqual(len([name for name in os.listdir(directory) if name.endswith(".snapshot")]), 1)
+
+    # Duplicate questions
+    def test_409_add_question_with_the_same_normalized_text(self):
+        question = {"question": "What is the capital of France?", "answer": "Paris",
+                    "category": str(self.category_science), "difficulty": 1}
+        self.assertEqual(self.client().post("/questions", json=question).status_code, 201)
+
+        resp = self.client().post("/questions", json=dict(question, question="  what is the CAPITAL of france "))
+        self.assertEqual(resp.status_code, 409)
+        with self.app.app_context():
+            original = Question.query.filter(Question.question == "What is the capital of France?").one()
+        self.assertEqual(resp.json["duplicate_of"], original.id)
+
+        resp = self.client().post("/questions", json=dict(question, question="What is the capital city of France?"))
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual([similar["id"] for similar in resp.json["similar_questions"]], [original.id])
+
+    def test_bulk_import_rejects_duplicates_and_reports_them(self):
+        lines = "\n".join(json.dumps({"question": text, "answer": "a", "category": self.category_science,
+                                       "difficulty": 1})
+                           for text in ["Test question 1!", "Brand new question", "brand new question?"])
+        resp = self.client().post("/questions/bulk", data=lines, content_type="application/x-ndjson")
+        self.assertEqual(resp.json["inserted"], 1)
+        self.assertEqual([error["line"] for error in resp.json["errors"]], [1, 3])
+
+        with self.app.app_context():
+            db.session.execute(
+                "INSERT INTO questions (question, answer, category, difficulty) VALUES ('Test Question 2', 'a', 1, 1)")
+            db.session.commit()
+            findings = list(dedup.report_duplicates(batch_size=2))
+            new_id = Question.query.filter(Question.question == "Test Question 2").one().id
+            original_id = Question.query.filter(Question.question == "test question 2").one().id
+        self.assertIn(("exact", new_id, original_id, 1.0), findings)
+        self.assertTrue(all(kind == "exact" or similarity >= dedup.DEDUP_NEAR_THRESHOLD
+                            for kind, _, _, similarity in findings))
+
+    def test_bulk_import_reports_similar_questions_only_when_asked(self):
+        def ndjson(*texts):
+            return "\n".join(json.dumps({"question": text, "answer": "a", "category": self.category_science,
+                                         "difficulty": 1}) for text in texts)
+
+        self.client().post("/questions", json={"question": "What is the capital of France?", "answer": "Paris",
+                                               "category": str(self.category_science), "difficulty": 1})
+        with self.app.app_context():
+            original_id = Question.query.filter(Question.question == "What is the capital of France?").one().id
+
+        resp = self.client().post("/questions/bulk", data=ndjson("What is the capital city of France?"),
+                                  content_type="application/x-ndjson")
+        self.assertEqual((resp.json["inserted"], resp.json["similar"]), (1, []))
+
+        resp = self.client().post("/questions/bulk?similar=true", content_type="application/x-ndjson",
+                                  data=ndjson("Name the deepest lake", "What is the capital of France, then?"))
+        self.assertEqual(resp.json["inserted"], 2)
+        self.assertEqual([(match["line"], match["question_id"]) for match in resp.json["similar"]],
+                         [(2, original_id)])
+
+    def test_near_duplicate_index_is_built_in_the_background(self):
+        app = create_app(test_config=dict(APP_CONFIG, DEDUP_NEAR_BACKGROUND_LOAD=True))
+        with app.app_context():
+            with unittest.mock.patch.object(dedup.near_duplicates, "load") as load:
+                self.assertEqual(dedup.near_duplicates.similar("What is the capital city of France?"), [])
+                dedup.near_duplicates._loader.join()
+            load.assert_called_once_with()
+
+    # Category statistics
+    def test_200_category_stats_follow_creates_deletes_and_imports(self):
+        resp = self.client().get("/categories/stats")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["total_questions"], 5)
+        science = next(category for category in resp.json["categories"] if category["id"] == self.category_science)
+        self.assertEqual(science, {"id": self.category_science, "type": "Science", "total_questions": 0,
+                                   "difficulties": {}})
+
+        created = self.client().post("/questions", json={
+            "question": "q", "answer": "a", "category": str(self.category_science), "difficulty": 4})
+        self.assertEqual(created.status_code, 201)
+        lines = "\n".join(json.dumps({"question": f"q{number}", "answer": "a",
+                                       "category": self.category_science, "difficulty": 1}) for number in range(3))
+        self.client().post("/questions/bulk", data=lines, content_type="application/x-ndjson")
+        with self.app.app_context():
+            Question.query.filter(Question.question == "test question 1").first().delete()
+
+        resp = self.client().get("/categories/stats")
+        self.assertEqual(resp.json["total_questions"], 8)
+        science = next(category for category in resp.json["categories"] if category["id"] == self.category_science)
+        self.assertEqual(science["total_questions"], 4)
+        self.assertEqual(science["difficulties"], {"1": 3, "4": 1})
+        with self.app.app_context():
+            self.assertEqual(stats.total(self.category_science), 4)
+            Question.query.filter(Question.difficulty == 1).delete()
+            self.assertEqual(stats.get()[self.category_science], {4: 1})
+
+    # Column projected reads
+    def test_question_totals_count_questions_without_category_or_difficulty(self):
+        with self.app.app_context():
+            db.session.execute(Question.__table__.insert(), [
+                {"question": "No category", "answer": "a", "category": None, "difficulty": 1},
+                {"question": "No difficulty", "answer": "a", "category": self.category_science, "difficulty": None},
+            ])
+            db.session.commit()
+            self.assertEqual(stats.total(), 7)
+            self.assertEqual(stats.total(self.category_science), 1)
+        self.assertEqual(self.client().get("/questions").json["total_questions"], 7)
+
+    def test_list_pages_serve_the_same_objects_as_question_format(self):
+        with self.app.app_context():
+            expected = [question.format() for question in Question.query.order_by(Question.id)]
+        resp = self.client().get("/questions?page=1")
+        self.assertEqual(resp.json["questions"], expected)
+
+        item = QuestionItem(1, "q", "a", 2, 3)
+        for encoder in (serialization.orjson, None):
+            with unittest.mock.patch.object(serialization, "orjson", encoder):
+                self.assertEqual(json.loads(serialization.dumps({1: [item]})), {"1": [item.format()]})
+
+    # Instrumentation
+    def test_server_timing_and_metrics_when_instrumentation_enabled(self):
+        instrumentation = importlib.import_module("flaskr.instrumentation")
+        with unittest.mock.patch.object(instrumentation, "INSTRUMENTATION", True):
+            app = create_app(test_config=True)
+        client = app.test_client()
+        resp = client.get("/questions?page=1")
+        self.assertEqual(resp.status_code, 200)
+        server_timing = resp.headers["Server-Timing"]
+        for name in ("sql;", "hydrate;", "serialize;", "app;"):
+            self.assertIn(name, server_timing)
+
+        metrics = client.get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'trivia_request_duration_seconds_count{resource="questions",method="GET",status="200"}', metrics)
+        self.assertIn('trivia_request_sql_statements_bucket{resource="questions",method="GET",le="+Inf"}', metrics)
+        self.assertIn("trivia_db_checkouts_total", metrics)
+
+    def test_no_server_timing_or_metrics_when_instrumentation_disabled(self):
+        resp = self.client().get("/questions?page=1")
+        self.assertNotIn("Server-Timing", resp.headers)
+        self.assertEqual(self.client().get("/metrics").status_code, 404)
+
+    # Benchmark
+    @commits
+    def test_benchmark_reports_latency_percentiles_of_every_scenario(self):
+        with self.assertRaisesRegex(RuntimeError, "did not seed"):
+            benchmark.seed(self.app, questions=50, categories=3, reset=True)
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), 5)
+            Question.query.delete()
+            Category.query.delete()
+            db.session.commit()
+
+        report = benchmark.run(self.app, questions=50, categories=3, concurrency=2, requests=10, quiz_rounds=3)
+        self.assertEqual(set(report["scenarios"]), set(benchmark.SCENARIOS))
+        for scenario in report["scenarios"].values():
+            self.assertEqual(scenario["errors"], 0, scenario["first_error"])
+            self.assertGreaterEqual(scenario["requests"], 10)
+            self.assertLessEqual(scenario["latency_ms"]["p50"], scenario["latency_ms"]["p99"])
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), 50)
+        self.assertGreater(report["peak_rss_mb"], 0)
+        with self.assertRaisesRegex(RuntimeError, "--reset"):
+            benchmark.seed(self.app, questions=60, categories=3)
+
+    @commits
+    def test_benchmark_cold_start_times_every_startup_phase(self):
+        with unittest.mock.patch.dict(os.environ, {"DEV_DB_URI": os.getenv("TEST_DB_URI")}):
+            report = benchmark.cold_start(runs=1)
+        self.assertEqual(set(report["startup_ms"]), {"import", "create_app", "first_request", "total"})
+
+    # Async serving mode
+    @unittest.skipUnless(
+        importlib.util.find_spec("asyncpg")
+        and os.getenv("TEST_DB_URI", "").startswith("postgres"),
+        "needs asyncpg and a PostgreSQL TEST_DB_URI",
+    )
+    @commits
+    def test_asgi_app_serves_same_json_as_flask_app(self):
+        from asgi import TriviaASGI
+
+        async def get(app, path, query_string=b"", method="GET", body=b""):
+            messages = [{"type": "http.request", "body": body}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {"type": "http", "method": method, "path": path,
+                     "query_string": query_string, "headers": [(b"content-type", b"application/json")]}
+            await app(scope, receive, send)
+            return sent[0]["status"], json.loads(sent[1]["body"])
+
+        invalid_questions = [
+            {"question": 42, "answer": "a", "category": self.category_science, "difficulty": 1},
+            {"question": "  ", "answer": "a", "category": self.category_science, "difficulty": 1},
+            {"question": "q", "answer": "a", "category": self.category_science, "difficulty": "hard"},
+            {"question": "q", "answer": "a", "category": 999999, "difficulty": 1},
+        ]
+
+        async def run():
+            app = TriviaASGI(os.getenv("TEST_DB_URI"))
+            await app.startup()
+            try:
+                invalid = [await get(app, "/questions", method="POST", body=json.dumps(question).encode())
+                           for question in invalid_questions]
+                return await get(app, "/questions", b"page=1"), await get(app, "/categories"), invalid
+            finally:
+                await app.shutdown()
+
+        (questions_status, questions), (categories_status, categories), invalid = asyncio.run(run())
+        for question, (status, response) in zip(invalid_questions, invalid):
+            resp = self.client().post("/questions", json=question)
+            self.assertEqual((status, response), (resp.status_code, resp.json))
+        self.assertEqual(questions_status, 200)
+        self.assertEqual(questions, self.client().get("/questions?page=1").json)
+        self.assertEqual(categories_status, 200)
+        self.assertEqual(categories, self.client().get("/categories").json)
+
+    # Schema migrations
+    def test_upgrade_legacy_schema_to_integer_category_foreign_key(self):
+        engine = create_engine("sqlite://")
+        engine.execute("CREATE TABLE categories (id INTEGER PRIMARY KEY, type VARCHAR)")
+        engine.execute(
+            "CREATE TABLE questions (id INTEGER PRIMARY KEY, question VARCHAR, "
+            "answer VARCHAR, category VARCHAR, difficulty INTEGER)"
+        )
+        engine.execute("INSERT INTO categories VALUES (1, 'Art'), (2, 'Science')")
+        engine.execute(
+            "INSERT INTO questions VALUES (1, 'q1', 'a1', '1', 1), (2, 'q2', 'a2', '2', 2), "
+            "(3, 'q3', 'a3', '9', 3), (4, 'q4', 'a4', '2', 4), (5, 'q5', 'a5', NULL, 5)"
+        )
+
+        applied = migrations.upgrade(engine, batch_size=2)
+        self.assertEqual(applied, [1, 2, 3, 4, 5, 6])
+        self.assertEqual(migrations.upgrade(engine), [])
+
+        columns = {column["name"]: column for column in inspect(engine).get_columns("questions")}
+        self.assertIn("updated_at", columns)
+        self.assertEqual(engine.execute("SELECT count(*) FROM questions WHERE updated_at IS NULL").scalar(), 0)
+        self.assertEqual(str(columns["category"]["type"]), "INTEGER")
+        indexes = {index["name"] for index in inspect(engine).get_indexes("questions")}
+        self.assertTrue({"ix_questions_category", "ix_questions_difficulty", "ux_questions_content_hash"} <= indexes)
+        self.assertEqual(
+            engine.execute("SELECT content_hash FROM questions WHERE id = 1").scalar(), dedup.content_hash("q1"))
+        self.assertEqual(
+            engine.execute("SELECT id, category FROM questions ORDER BY id").fetchall(),
+            [(1, 1), (2, 2), (3, None), (4, 2), (5, None)],
+        )
+        self.assertEqual(
+            engine.execute("SELECT category, difficulty, questions FROM category_stats ORDER BY 1, 2").fetchall(),
+            [(1, 1, 1), (2, 2, 1), (2, 4, 1)],
+        )
+
+    def test_upgrade_keeps_categories_changed_during_the_backfill(self):
+        engine = create_engine("sqlite://")
+        engine.execute("CREATE TABLE categories (id INTEGER PRIMARY KEY, type VARCHAR)")
+        engine.execute("CREATE TABLE questions (id INTEGER PRIMARY KEY, question VARCHAR, "
+                       "answer VARCHAR, category VARCHAR, difficulty INTEGER)")
+        engine.execute("INSERT INTO categories VALUES (1, 'Art'), (2, 'Science')")
+        engine.execute("INSERT INTO questions VALUES (1, 'q1', 'a1', '1', 1), (2, 'q2', 'a2', '2', 2)")
+        backfill = migrations._backfill
+
+        def backfill_then_recategorise(engine, statement, batch_size, **parameters):
+            backfill(engine, statement, batch_size, **parameters)
+            if "category_id" in statement:
+                engine.execute("UPDATE questions SET category = '1' WHERE id = 2")
+
+        with unittest.mock.patch.object(migrations, "_backfill", backfill_then_recategorise):
+            migrations.upgrade(engine)
+        self.assertEqual(engine.execute("SELECT id, category FROM questions ORDER BY id").fetchall(), [(1, 1), (2, 1)])
+
+    @commits
+    def test_upgrade_creates_schema_skipped_at_startup(self):
+        with unittest.mock.patch.dict(os.environ, {"TEST_DB_URI": "sqlite://"}):
+            app = create_app(test_config=APP_CONFIG)
+        with app.app_context():
+            self.assertEqual(inspect(db.engine).get_table_names(), [])
+            self.assertEqual(migrations.upgrade(db.engine), [1, 2, 3, 4, 5, 6])
+            self.assertTrue({"categories", "questions", "category_stats"} <= set(inspect(db.engine).get_table_names()))
+            self.assertEqual(app.test_client().get("/categories").json["categories"], {})
+
 
 if __name__ == "__main__":
     unittest.main()